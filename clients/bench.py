@@ -0,0 +1,321 @@
+#!/usr/bin/python
+# $id$
+# pyCVS benchmarks, against the fake pserver of library/fakepserver.py
+#
+# python clients/bench.py [--files N --size BYTES --depth D ...] [scenario..]
+#
+# every scenario runs in its own process (for its peak RSS, which
+# includes the in-process server) and prints one JSON line.
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "library"))
+
+import pycvs
+from fakepserver import Crepository, Cfakepserver, checkoutreply
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+g_scenarios = ("login", "checkout", "update", "parallel", "multi", "parse",
+               "tagsync", "export", "lazy")
+
+
+class CBenchClient(pycvs.BaseCVSClient):
+    """ counts the files and the time between them """
+    def __init__(self):
+        pycvs.BaseCVSClient.__init__(self)
+        self.reset()
+
+    def hprotocol(self, response):
+        # takes the responses of a Cprotocvs with no server around it
+        if response.get_name() == "updatedfile":
+            self.on_updatedfile(pycvs.Cevent("updatedfile",
+                                             response.get_data(), None))
+
+    def reset(self):
+        self.files = 0
+        self.bytes = 0
+        self.start = self.last = time.perf_counter()
+        self.intervals = []
+
+    def on_updatedfile(self, event):
+        now = time.perf_counter()
+        self.files += 1
+        self.bytes += event.get_params().get_size()
+        self.intervals.append(now - self.last)
+        self.last = now
+
+    on_patchedfile = on_updatedfile
+
+    def result(self, **extra):
+        seconds = time.perf_counter() - self.start
+        intervals = sorted(self.intervals)
+        stats = {
+            "files": self.files,
+            "bytes": self.bytes,
+            "seconds": round(seconds, 6),
+            "files_per_s": round(self.files / seconds, 1),
+            "mb_per_s": round(self.bytes / seconds / 1e6, 3),
+            "file_p50_ms": round(pycvs.percentile(intervals, 0.5) * 1e3, 3),
+            "file_p99_ms": round(pycvs.percentile(intervals, 0.99) * 1e3, 3),
+        }
+        stats.update(extra)
+        return stats
+
+
+def newsession(client, port, args):
+    srv = client.newserver("127.0.0.1", port, 1)
+    srv.set_compression(args.compression)
+    srv.login("/cvsroot")
+    return srv
+
+
+def waits(*servers):
+    # where the time went: waiting for the socket or in handlers,
+    # summed over the servers and their parallel checkout sessions
+    totals = {"socket_wait_s": 0, "handler_s": 0, "reconnects": 0}
+    for srv in servers:
+        metrics = srv.get_metrics()
+        for session in [metrics] + metrics.get("workers", []):
+            for key in totals:
+                totals[key] = round(totals[key] + session[key], 6)
+    return totals
+
+
+def bench_login(client, port, args, destdir):
+    # fresh connections, the pool would hide what a login costs
+    times = []
+    start = time.perf_counter()
+    for i in range(args.logins):
+        t = time.perf_counter()
+        srv = client.newserver("127.0.0.1", port, 1)
+        srv.set_connpool(None)
+        srv.login("/cvsroot")
+        srv.logout()
+        times.append(time.perf_counter() - t)
+    seconds = time.perf_counter() - start
+    times.sort()
+    return {"logins": args.logins, "seconds": round(seconds, 6),
+            "logins_per_s": round(args.logins / seconds, 1),
+            "login_p50_ms": round(pycvs.percentile(times, 0.5) * 1e3, 3),
+            "login_p99_ms": round(pycvs.percentile(times, 0.99) * 1e3, 3)}
+
+
+def bench_checkout(client, port, args, destdir):
+    srv = newsession(client, port, args)
+    srv.set_filesink(destdir, args.chunk_size)
+    client.reset()
+    srv.checkout("mod")
+    return client.result(**waits(srv))
+
+
+def bench_update(client, port, args, destdir):
+    srv = newsession(client, port, args)
+    srv.set_filesink(destdir, args.chunk_size)
+    srv.checkout("mod")
+    changed = client.repository.change(args.changed)
+    client.reset()
+    srv.update(destdir)
+    return client.result(changed=len(changed), **waits(srv))
+
+
+def bench_parallel(client, port, args, destdir):
+    srv = newsession(client, port, args)
+    srv.set_filesink(destdir, args.chunk_size)
+    client.reset()
+    srv.parallelcheckout("mod", args.connections)
+    return client.result(connections=args.connections, **waits(srv))
+
+
+def bench_multi(client, port, args, destdir):
+    # $servers asynchronous sessions checking out at once, driven
+    # by one CVS.checkio_all loop
+    servers = []
+    for i in range(args.servers):
+        srv = client.newserver("127.0.0.1", port, 0)
+        srv.set_compression(args.compression)
+        srv.set_filesink(os.path.join(destdir, str(i)), args.chunk_size)
+        srv.login("/cvsroot")
+        servers.append(srv)
+    while not all(srv.is_loggedin() and srv.is_idle() for srv in servers):
+        client.cvs.checkio_all(0.05)
+
+    client.reset()
+    for srv in servers:
+        srv.checkout("mod")
+    expected = args.servers * len(client.repository.files)
+    while client.files < expected:
+        client.cvs.checkio_all(0.05)
+        if all(srv.is_idle() for srv in servers):
+            break
+    return client.result(servers=args.servers,
+                         select_wait_s=round(client.cvs.waittime, 6),
+                         **waits(*servers))
+
+
+def bench_parse(client, port, args, destdir):
+    # the reply to a checkout fed in --chunk-size pieces, no sockets:
+    # the bare Cresponseparser, then Cprotocvs handling the responses
+    reply = checkoutreply(client.repository, args.compression)
+    chunks = [reply[i:i + args.chunk_size]
+              for i in range(0, len(reply), args.chunk_size)]
+
+    parser = pycvs.Cresponseparser()
+    start = time.perf_counter()
+    events = 0
+    for chunk in chunks:
+        events += len(parser.parse(chunk))
+    parsing = time.perf_counter() - start
+
+    proto = pycvs.Cprotocvs(client.hprotocol, "127.0.0.1", 0)
+    client.reset()
+    for chunk in chunks:
+        proto.datareceived(chunk)
+    return client.result(events=events, stream_bytes=len(reply),
+                         parser_mb_per_s=round(len(reply) / parsing / 1e6,
+                                               3))
+
+
+def bench_tagsync(client, port, args, destdir):
+    # a checkout moved from one tag to the next by rdiff, against a
+    # fresh checkout of the new tag
+    repository = client.repository
+    repository.tag("R1")
+    changed = repository.change(args.changed)
+    repository.tag("R2")
+    srv = newsession(client, port, args)
+    srv.set_filesink(os.path.join(destdir, "old"), args.chunk_size)
+    srv.checkout("mod", "-rR1")
+    received = srv.get_metrics()["bytes_in"]
+
+    client.reset()
+    srv.set_filesink(os.path.join(destdir, "new"), args.chunk_size)
+    srv.checkout("mod", "-rR2")
+    checkout = time.perf_counter() - client.start
+    checkoutbytes = srv.get_metrics()["bytes_in"] - received
+    received += checkoutbytes
+
+    srv.set_filesink(os.path.join(destdir, "old"), args.chunk_size)
+    client.reset()
+    sync = srv.sync_to_tag("mod", "R1", "R2")
+    return client.result(changed=len(changed), fetched=len(sync.fetch),
+                         checkout_s=round(checkout, 6),
+                         checkout_bytes=checkoutbytes,
+                         sync_bytes=srv.get_metrics()["bytes_in"] - received)
+
+
+def bench_export(client, port, args, destdir):
+    # the module exported into one tar file instead of a tree
+    srv = newsession(client, port, args)
+    path = os.path.join(destdir, "mod.tar")
+    with open(path, "wb") as writable:
+        sink = pycvs.Ctarsink(writable)
+        srv.set_filesink(sink, args.chunk_size)
+        client.reset()
+        srv.export("mod", "-rHEAD")
+        sink.finish()
+    return client.result(archive_bytes=os.path.getsize(path), **waits(srv))
+
+
+def bench_lazy(client, port, args, destdir):
+    # --touched of the files read through a Clazytree, picked at
+    # random, instead of checking the module out
+    srv = newsession(client, port, args)
+    tree = srv.lazytree("mod", prefetch=args.prefetch)
+    paths = sorted(client.repository.files)
+    rnd = random.Random(args.seed)
+    picked = rnd.sample(paths, max(1, int(len(paths) * args.touched)))
+    client.reset()
+    for path in picked:
+        data = tree.read(path[len("mod/"):])
+        client.on_updatedfile(pycvs.Cevent("updatedfile", pycvs.Cfile(
+            path, "", "", len(data), data), None))
+    stats = tree.get_stats()
+    stats["bytes_in"] = tree.session.get_metrics()["bytes_in"]
+    tree.close()
+    return client.result(touched=len(picked), **stats)
+
+
+def runscenario(name, args):
+    repository = Crepository(args.files, args.size, args.depth,
+                             args.fanout, seed=args.seed)
+    server = Cfakepserver(repository)
+    port = server.start()
+
+    client = CBenchClient()
+    client.repository = repository
+    destdir = tempfile.mkdtemp(prefix="pycvs-bench-")
+    try:
+        result = globals()["bench_" + name](client, port, args, destdir)
+    finally:
+        server.stop()
+        shutil.rmtree(destdir, ignore_errors=True)
+
+    result["scenario"] = name
+    result["compression"] = args.compression
+    if resource:
+        # kilobytes on linux, bytes on macos
+        result["peak_rss_kb"] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pyCVS benchmarks")
+    parser.add_argument("scenarios", nargs="*",
+                        help="some of %s, default: all of them"
+                        % ", ".join(g_scenarios))
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=8192,
+                        help="mean file size")
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--fanout", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=65536)
+    parser.add_argument("-z", "--compression", type=int, default=0)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--changed", type=float, default=0.01,
+                        help="fraction of the files changed for update "
+                        "and tagsync")
+    parser.add_argument("-j", "--connections", type=int, default=4)
+    parser.add_argument("--servers", type=int, default=8)
+    parser.add_argument("--touched", type=float, default=0.05,
+                        help="fraction of the files lazy reads")
+    parser.add_argument("--prefetch", type=int, default=8,
+                        help="siblings lazy fetches along")
+    parser.add_argument("--inprocess", action="store_true",
+                        help="don't fork a process per scenario")
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in g_scenarios:
+            parser.error("unknown scenario %s" % name)
+
+    scenarios = args.scenarios or g_scenarios
+    if args.inprocess or len(scenarios) == 1:
+        for name in scenarios:
+            print(json.dumps(runscenario(name, args)))
+            sys.stdout.flush()
+        return 0
+
+    options = [x for x in (argv if argv is not None else sys.argv[1:])
+               if x not in g_scenarios]
+    for name in scenarios:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                               name] + options)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -193,6 +193,8 @@ class CSampleFrame(wxFrame):
         self.myserver = self.cvsobj.newserver(self.hostname,
                             int(self.port),
                             0)
+        # stream the files straight to the destination directory
+        self.myserver.set_filesink(self.destdir)
         self.myserver.login(self.cvsroot)
 
         return
@@ -219,6 +221,9 @@ class CSampleFrame(wxFrame):
 
     def on_cvsupdatedfile(self, event):
         file = event.get_params()
+        if file.get_data() is None:
+            # already written by the server's file sink
+            return
 
         # check all directories in the path exist
         fullpath = self.destdir
@@ -231,7 +236,7 @@ class CSampleFrame(wxFrame):
                 os.mkdir(fullpath)
 
         fullpath += "/" + name + ext
-        with open(fullpath, 'w') as fd:
+        with open(fullpath, 'wb') as fd:
             fd.write(file.get_data())
 
     def ParseFile(self, file):
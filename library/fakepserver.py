@@ -0,0 +1,842 @@
+#!/usr/bin/python
+# $id$
+# pyCVS a python library for the Concurrent Versions System (CVS) protocol.
+# Copyright (C) 2003 rad2k Argentina.
+#
+# pyCVS is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+# For Contact information read the AUTHORS file.
+
+import socket
+import threading
+import random
+import math
+import difflib
+import posixpath
+import zlib
+import gzip
+
+from pycvs import Cprotocvs, g_encoding, parselogdate, unparselogdate
+
+"""
+a stand-in for a CVS pserver, serving a synthetic repository from
+memory over localhost. it speaks enough of the protocol for pyCVS:
+login, checkout (of a tag too), export, update, rlist, rlog, rdiff,
+expand-modules and compression.
+
+    repository = Crepository(files=1000, meansize=8192, depth=2)
+    server = Cfakepserver(repository)
+    port = server.start()
+    ...
+    server.stop()
+"""
+
+
+class Crepository:
+    """
+    Class name: Crepository
+    Description:
+        a synthetic repository of $files files in module $module, in
+        directories $depth levels deep with $fanout subdirectories
+        each. file sizes follow a log-normal distribution around
+        $meansize bytes. the same $seed gives the same repository.
+        a file body is text unique to its path, and each new revision
+        appends a line, so revisions diff like real ones. revisions
+        are dated by a clock ticking at every add() and change(), and
+        committed by one of $authors.
+
+    """
+    authors = ("alice", "bob", "carol", "dave", "erin")
+
+    def __init__(self, files=100, meansize=8192, depth=1, fanout=8,
+                 module="mod", root="/cvsroot", seed=0):
+        self.module = module
+        self.root = root
+        self.lock = threading.Lock()
+
+        # path (module/dir/name) -> [base size, number of revisions],
+        # or explicit bodies set with add()
+        self.files = {}
+        self.bodies = {}
+        # subdirectory paths, with the module itself
+        self.dirs = [module]
+        # path -> {revision number: date}, the dates of the revisions
+        # made after the first one; tag -> {path: revision}
+        self.epoch = self.clock = 1000000000
+        self.dates = {}
+        self.tags = {}
+
+        rnd = random.Random(seed)
+        level = [module]
+        for i in range(depth):
+            nextlevel = []
+            for parent in level:
+                for j in range(fanout):
+                    nextlevel.append("%s/d%d" % (parent, j))
+            self.dirs.extend(nextlevel)
+            level = nextlevel
+
+        # mu of the log-normal giving $meansize on average
+        sigma = 1.0
+        mu = math.log(max(meansize, 1)) - sigma * sigma / 2
+        for i in range(files):
+            dirname = rnd.choice(self.dirs)
+            size = int(rnd.lognormvariate(mu, sigma)) if meansize else 0
+            self.files["%s/f%d.c" % (dirname, i)] = [size, 1]
+
+        # the text bodies are cut from
+        words = [b"alpha", b"beta", b"gamma", b"delta", b"epsilon",
+                 b"zeta", b"eta", b"theta", b"iota", b"kappa"]
+        lines = []
+        for i in range(4096):
+            lines.append(b" ".join(rnd.choice(words)
+                                   for j in range(rnd.randint(1, 12))))
+        self.text = b"\n".join(lines) * 16 + b"\n"
+
+    def add(self, path, data):
+        """ adds or changes file $path, with body $data """
+        with self.lock:
+            if path in self.files:
+                self.files[path][1] += 1
+            else:
+                self.files[path] = [len(data), 1]
+            self.bodies.setdefault(path, {})[self.files[path][1]] = data
+            self.clock += 60
+            self.dates.setdefault(path, {})[self.files[path][1]] = self.clock
+            dirname = posixpath.dirname(path)
+            while dirname and dirname not in self.dirs:
+                self.dirs.append(dirname)
+                dirname = posixpath.dirname(dirname)
+
+    def remove(self, path):
+        with self.lock:
+            self.files.pop(path, None)
+
+    def change(self, fraction, seed=1):
+        """ makes a new revision of $fraction of the files, returns
+        their paths """
+        rnd = random.Random(seed)
+        with self.lock:
+            paths = sorted(self.files)
+            count = max(1, int(len(paths) * fraction)) if fraction else 0
+            changed = rnd.sample(paths, min(count, len(paths)))
+            self.clock += 3600
+            for path in changed:
+                self.files[path][1] += 1
+                self.dates.setdefault(path, {})[self.files[path][1]] = \
+                    self.clock
+        return changed
+
+    def tag(self, name, paths=None):
+        """ tags the current revision of $paths (all files by default)
+        with $name, moving the tag if it was there """
+        with self.lock:
+            tagged = self.tags.setdefault(name, {})
+            for path in paths if paths is not None else list(self.files):
+                tagged[path] = self.revision(path)
+
+    def filetags(self, path):
+        """ {tag: revision} of $path """
+        return {name: tagged[path] for name, tagged in self.tags.items()
+                if path in tagged}
+
+    def loginfo(self, path, number):
+        """ (date, author, message) of revision 1.$number of $path """
+        date = self.dates.get(path, {}).get(number, self.epoch)
+        key = ("%s %d" % (path, number)).encode(g_encoding)
+        author = self.authors[zlib.crc32(key) % len(self.authors)]
+        if number == 1:
+            return date, author, "initial revision"
+        return date, author, "change %d" % number
+
+    def revision(self, path):
+        return "1.%d" % self.files[path][1]
+
+    def body(self, path, revision=None):
+        """ the body of $path at $revision (the latest by default),
+        None if there is no such file or revision """
+        info = self.files.get(path)
+        if not info:
+            return None
+        number = info[1]
+        if revision is not None:
+            try:
+                number = int(revision.split(".")[1])
+            except (IndexError, ValueError):
+                return None
+            if number < 1 or number > info[1]:
+                return None
+
+        explicit = self.bodies.get(path)
+        if explicit:
+            while number not in explicit and number > 1:
+                number -= 1
+            return explicit.get(number)
+
+        header = ("%s\n" % path).encode(g_encoding)
+        size = max(0, info[0] - len(header))
+        start = zlib.crc32(path.encode(g_encoding)) % (len(self.text) // 2)
+        size = min(size, len(self.text) - start)
+        changes = b"".join(b"change %d\n" % i for i in range(2, number + 1))
+        return header + self.text[start:start + size] + changes
+
+    def listdir(self, dirname):
+        """ the files (names) and subdirectories (names) of $dirname """
+        prefix = dirname + "/"
+        names = sorted(p[len(prefix):] for p in self.files
+                       if p.startswith(prefix) and "/" not in p[len(prefix):])
+        subdirs = sorted({d[len(prefix):] for d in self.dirs
+                          if d.startswith(prefix) and
+                          "/" not in d[len(prefix):]})
+        return names, subdirs
+
+    def isdir(self, dirname):
+        return dirname in self.dirs
+
+
+def rcsdiff(old, new):
+    """ an RCS format diff (see pycvs.applyrcsdiff) from $old to $new """
+    a = old.splitlines(True)
+    b = new.splitlines(True)
+    out = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(
+            None, a, b, autojunk=False).get_opcodes():
+        if tag in ("delete", "replace"):
+            out.append(b"d%d %d\n" % (i1 + 1, i2 - i1))
+        if tag in ("insert", "replace"):
+            out.append(b"a%d %d\n" % (i2, j2 - j1))
+            out.extend(b[j1:j2])
+    return b"".join(out)
+
+
+class Cfakeconnection:
+    """
+    Class name: Cfakeconnection
+    Description: the socket of a session, buffered, compressed both
+        ways once the client sends Gzip-stream.
+
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = b""
+        self.compressor = None
+        self.decompressor = None
+        # bytes left to send before hanging up, None for no limit
+        self.limit = None
+
+    def more(self):
+        data = self.sock.recv(65536)
+        if not data:
+            return 0
+        if self.decompressor:
+            data = self.decompressor.decompress(data)
+        self.buf += data
+        return 1
+
+    def readline(self):
+        # a line without its newline, None once the client is gone
+        while b"\n" not in self.buf:
+            if not self.more():
+                return None
+        line, sep, self.buf = self.buf.partition(b"\n")
+        return line.decode(g_encoding, "surrogateescape")
+
+    def read(self, size):
+        while len(self.buf) < size:
+            if not self.more():
+                break
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def send(self, data):
+        if self.limit is not None:
+            data = data[:self.limit]
+            self.limit -= len(data)
+        if self.compressor:
+            data = self.compressor.compress(data) + \
+                self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.sock.sendall(data)
+        if self.limit == 0:
+            raise OSError("hung up")
+
+    def startcompression(self, level):
+        self.compressor = zlib.compressobj(level)
+        self.decompressor = zlib.decompressobj()
+        self.buf = self.decompressor.decompress(self.buf)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class Cfakesession:
+    """
+    Class name: Cfakesession
+    Description: serves one client connection of a Cfakepserver.
+
+    """
+    # requests we answer, see valid-requests
+    validrequests = ("Root", "Valid-responses", "valid-requests",
+                     "UseUnchanged", "Argument", "Argumentx", "Directory",
+                     "Entry", "Unchanged", "Modified", "Global_option",
+                     "Set", "Gzip-stream", "gzip-file-contents",
+                     "expand-modules", "co", "update", "rlist", "rlog",
+                     "rdiff", "export")
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.repository = server.repository
+        self.conn = Cfakeconnection(sock)
+        self.responses = set()
+        self.gzipfiles = 0
+        self.reset()
+
+    def reset(self):
+        # what the requests since the last command said
+        self.args = []
+        self.dirs = []          # (local directory, repository path)
+        self.entries = {}       # repository path -> {name: entry line}
+        self.unchanged = {}     # repository path -> set of names
+        self.tag = None         # co -rTAG
+
+    def run(self):
+        try:
+            if self.authenticate():
+                self.serve()
+        except OSError:
+            pass
+        self.conn.close()
+
+    def authenticate(self):
+        begin = self.conn.readline()
+        root = self.conn.readline()
+        username = self.conn.readline()
+        password = self.conn.readline()
+        end = self.conn.readline()
+        if end is None:
+            return 0
+
+        ok = root == self.repository.root and \
+            self.server.checkpassword(username, password)
+        self.server.count("logins")
+        self.conn.send(b"I LOVE YOU\n" if ok else b"I HATE YOU\n")
+        # a verification request is all the connection is for
+        return ok and begin == "BEGIN AUTH REQUEST"
+
+    def serve(self):
+        while True:
+            line = self.conn.readline()
+            if line is None:
+                return
+            request, sep, rest = line.partition(" ")
+            self.server.count(request)
+            if self.server.takestall(request):
+                # a stuck server: never answer, read until the client
+                # gives up on us
+                while self.conn.readline() is not None:
+                    pass
+                return
+            self.conn.limit = self.server.takehangup(request)
+            method = getattr(self, "req_" + request.replace("-", "_"), None)
+            if request not in self.validrequests or not method:
+                self.conn.send(("error  unrecognized request `%s'\n"
+                                % request).encode(g_encoding))
+                continue
+            method(rest)
+
+    def send(self, text):
+        self.conn.send(text.encode(g_encoding, "surrogateescape"))
+
+    # requests ####################################################
+
+    def req_Root(self, rest):
+        if rest != self.repository.root:
+            self.send("error  bad root %s\n" % rest)
+
+    def req_Valid_responses(self, rest):
+        self.responses = set(rest.split())
+
+    def req_valid_requests(self, rest):
+        self.send("Valid-requests %s\nok\n" % " ".join(self.validrequests))
+
+    def req_UseUnchanged(self, rest):
+        return
+
+    def req_Global_option(self, rest):
+        return
+
+    def req_Set(self, rest):
+        return
+
+    def req_Argument(self, rest):
+        self.args.append(rest)
+
+    def req_Argumentx(self, rest):
+        if self.args:
+            self.args[-1] += "\n" + rest
+
+    def req_Directory(self, rest):
+        repository = self.conn.readline()
+        self.dirs.append((rest, repository))
+        self.entries.setdefault(repository, {})
+        self.unchanged.setdefault(repository, set())
+
+    def currentdir(self):
+        return self.dirs[-1][1] if self.dirs else self.repository.root
+
+    def req_Entry(self, rest):
+        name = rest.split("/")[1]
+        self.entries.setdefault(self.currentdir(), {})[name] = rest
+
+    def req_Unchanged(self, rest):
+        self.unchanged.setdefault(self.currentdir(), set()).add(rest)
+
+    def req_Modified(self, rest):
+        self.conn.readline()
+        size = self.conn.readline()
+        self.conn.read(int(size.lstrip("z")))
+
+    def req_Gzip_stream(self, rest):
+        self.conn.startcompression(int(rest))
+
+    def req_gzip_file_contents(self, rest):
+        self.gzipfiles = int(rest) or 6
+
+    def req_expand_modules(self, rest):
+        out = []
+        for arg in self.args:
+            if self.repository.isdir(arg.rstrip("/")):
+                out.append("Module-expansion %s\n" % arg.rstrip("/"))
+        self.send("".join(out) + "ok\n")
+        self.reset()
+
+    def req_rlist(self, rest):
+        options, paths = self.splitargs()
+        out = []
+        for path in paths:
+            if not self.repository.isdir(path.rstrip("/")):
+                self.send("E cvs server: cannot find module `%s'\n"
+                          "error  \n" % path)
+                self.reset()
+                return
+            names, subdirs = self.repository.listdir(path.rstrip("/"))
+            for name in subdirs:
+                out.append("M D/%s////\n" % name)
+            if "-e" in options:
+                for name in names:
+                    out.append("M /%s/%s////\n" % (
+                        name, self.repository.revision(path + "/" + name)))
+        self.send("".join(out) + "ok\n")
+        self.reset()
+
+    def req_rlog(self, rest):
+        # -d>date or -ddate< (revisions since), -S, -N, -h and -l
+        options, paths = self.splitargs()
+        since = None
+        for option in options:
+            if option.startswith("-d>"):
+                since = parselogdate(option[3:])
+            elif option.startswith("-d") and option.endswith("<"):
+                since = parselogdate(option[2:-1])
+
+        files = []
+        for path in paths:
+            path = path.rstrip("/")
+            if path in self.repository.files:
+                files.append(path)
+            elif self.repository.isdir(path):
+                self.listfiles(files, path, "-l" not in options)
+            else:
+                self.send("E cvs server: cannot find module `%s'\n"
+                          "error  \n" % path)
+                self.reset()
+                return
+
+        out = []
+        for path in files:
+            self.filelog(out, path, since, options)
+        self.send("".join(out) + "ok\n")
+        self.reset()
+
+    def req_rdiff(self, rest):
+        # -u with -rFROM and -rTO (the head if there is no second)
+        options, paths = self.splitargs()
+        tags = [x[2:] for x in options if x.startswith("-r")]
+        if "-u" not in options or not 1 <= len(tags) <= 2 or \
+                any(x not in self.repository.tags for x in tags):
+            self.send("E cvs server: only rdiff -u -rTAG [-rTAG]\n"
+                      "error  \n")
+            self.reset()
+            return
+
+        old = self.repository.tags[tags[0]]
+        if len(tags) == 2:
+            new = self.repository.tags[tags[1]]
+        else:
+            new = {x: self.repository.revision(x)
+                   for x in self.repository.files}
+        out = []
+        for path in sorted(set(old) | set(new)):
+            if not any(path.startswith(x.rstrip("/") + "/") for x in paths):
+                continue
+            if old.get(path) != new.get(path):
+                self.filediff(out, path, old.get(path), new.get(path))
+        self.send("".join(out) + "ok\n")
+        self.reset()
+
+    def req_co(self, rest):
+        options, paths = self.splitargs()
+        for option in options:
+            if option.startswith("-r") and option != "-rHEAD":
+                self.tag = option[2:]
+        out = []
+        for path in paths:
+            path = path.rstrip("/")
+            if "-p" in options:
+                files = [path] if path in self.repository.files else []
+                if self.repository.isdir(path):
+                    self.listfiles(files, path, "-l" not in options)
+                for name in files:
+                    self.printed(out, name)
+                if not files:
+                    out.append(("E cvs server: cannot find module `%s'\n"
+                                "error  \n" % path).encode(g_encoding))
+                    self.conn.send(b"".join(x for x in out if x))
+                    self.reset()
+                    return
+            elif path in self.repository.files:
+                self.updated(out, posixpath.dirname(path) + "/", path)
+            elif self.repository.isdir(path):
+                self.checkoutdir(out, path + "/", path, "-l" not in options)
+            else:
+                out.append("E cvs server: cannot find module `%s'\n" % path)
+        self.reply(out)
+
+    def req_export(self, rest):
+        # a checkout, the client leaves out the administrative files
+        self.req_co(rest)
+
+    def req_update(self, rest):
+        options, paths = self.splitargs()
+        newdirs = "-d" in options
+        out = []
+        sent = {repository for local, repository in self.dirs}
+        for local, repository in self.dirs:
+            dirname = self.relative(repository)
+            if dirname is None or not self.selected(local, paths):
+                continue
+            localdir = local.rstrip("/") + "/" if local != "." else ""
+            if dirname and self.repository.isdir(dirname):
+                self.updatedir(out, localdir, dirname, repository)
+            if not newdirs:
+                continue
+
+            # directories the client doesn't have yet
+            if dirname:
+                names, subdirs = self.repository.listdir(dirname)
+                candidates = [(sub, dirname + "/" + sub) for sub in subdirs]
+            else:
+                candidates = [(p, p) for p in paths
+                              if self.repository.isdir(p.rstrip("/"))]
+            for sub, path in candidates:
+                path = path.rstrip("/")
+                if self.repository.root + "/" + path in sent:
+                    continue
+                self.checkoutdir(out, localdir + sub.rstrip("/") + "/",
+                                 path, 1)
+        self.reply(out)
+
+    # helpers ######################################################
+
+    def splitargs(self):
+        options = [x for x in self.args if x.startswith("-")]
+        paths = [x for x in self.args if not x.startswith("-")]
+        return options, paths
+
+    def reply(self, out):
+        self.server.count("files", sum(1 for x in out if x is None))
+        self.conn.send(b"".join(x for x in out if x is not None) + b"ok\n")
+        self.reset()
+
+    def relative(self, repository):
+        # the repository path of a Directory request, relative to the
+        # root, "" for the root itself, None for somewhere else
+        root = self.repository.root
+        if repository == root:
+            return ""
+        if repository.startswith(root + "/"):
+            return repository[len(root) + 1:]
+        return None
+
+    def selected(self, local, paths):
+        # with arguments, only the directories they name and below
+        if not paths or local == ".":
+            return 1
+        return any(local == p.rstrip("/") or local.startswith(
+            p.rstrip("/") + "/") for p in paths)
+
+    def listfiles(self, files, dirname, recursive):
+        names, subdirs = self.repository.listdir(dirname)
+        files.extend(dirname + "/" + name for name in names)
+        if recursive:
+            for name in subdirs:
+                self.listfiles(files, dirname + "/" + name, 1)
+
+    def filelog(self, out, path, since, options):
+        # the rlog text of $path, newer cvs style
+        head = int(self.repository.revision(path).split(".")[1])
+        revisions = []
+        for number in range(head, 0, -1):
+            date, author, message = self.repository.loginfo(path, number)
+            if since is None or date >= since:
+                revisions.append((number, date, author, message))
+        if not revisions and "-S" in options:
+            return
+
+        lines = ["", "RCS file: %s/%s,v" % (self.repository.root, path),
+                 "head: 1.%d" % head, "branch:", "locks: strict",
+                 "access list:"]
+        if "-N" not in options:
+            lines.append("symbolic names:")
+            for name, revision in sorted(
+                    self.repository.filetags(path).items()):
+                lines.append("\t%s: %s" % (name, revision))
+        lines += ["keyword substitution: kv",
+                  "total revisions: %d;\tselected revisions: %d"
+                  % (head, len(revisions)), "description:"]
+        if "-h" not in options:
+            for number, date, author, message in revisions:
+                fields = "date: %s;  author: %s;  state: Exp;" % (
+                    unparselogdate(date), author)
+                if number > 1:
+                    fields += "  lines: +1 -0;"
+                lines += ["-" * 28, "revision 1.%d" % number, fields,
+                          message]
+        lines.append("=" * 77)
+        out.append("".join("M %s\n" % x for x in lines))
+
+    def filediff(self, out, path, oldrev, newrev):
+        # the rdiff -u of $path, like cvs 1.12 words it
+        # a file removed since has no bodies left, none are needed
+        old = oldrev and self.repository.body(path, oldrev) or b""
+        new = newrev and self.repository.body(path, newrev) or b""
+        a = old.decode(g_encoding, "surrogateescape").splitlines(True)
+        b = new.decode(g_encoding, "surrogateescape").splitlines(True)
+        fromspec = "%s:%s" % (path, oldrev) if oldrev else "/dev/null"
+        tospec = "%s:%s" % (path, newrev) if newrev else "%s:removed" % path
+        lines = ["Index: %s" % path, "diff -u %s %s" % (fromspec, tospec)]
+        for line in difflib.unified_diff(a, b, fromspec, tospec):
+            if line.endswith("\n"):
+                lines.append(line[:-1])
+            else:
+                lines += [line, "\\ No newline at end of file"]
+        out.append("".join("M %s\n" % x for x in lines))
+
+    def checkoutdir(self, out, localdir, dirname, recursive):
+        names, subdirs = self.repository.listdir(dirname)
+        for name in names:
+            self.updated(out, localdir, dirname + "/" + name)
+        if recursive:
+            for sub in subdirs:
+                self.checkoutdir(out, localdir + sub + "/",
+                                 dirname + "/" + sub, 1)
+
+    def updatedir(self, out, localdir, dirname, repository):
+        names, subdirs = self.repository.listdir(dirname)
+        entries = self.entries.get(repository, {})
+        unchanged = self.unchanged.get(repository, set())
+        for name in names:
+            path = dirname + "/" + name
+            line = entries.get(name)
+            if line is None:
+                self.updated(out, localdir, path, "Created")
+                continue
+            revision = line.split("/")[2]
+            if revision == self.repository.revision(path):
+                continue
+            old = self.repository.body(path, revision)
+            if "Rcs-diff" in self.responses and name in unchanged and \
+               old is not None:
+                self.patched(out, localdir, path, old)
+            else:
+                self.updated(out, localdir, path)
+        for name in entries:
+            if name not in names:
+                out.append(("Removed %s\n%s/%s\n" % (
+                    localdir or "./", repository, name)).encode(g_encoding))
+
+    def revision(self, path):
+        # the revision checked out, the one of the tag of a co -r
+        if self.tag:
+            return self.repository.tags.get(self.tag, {}).get(path)
+        return self.repository.revision(path)
+
+    def fileheader(self, response, localdir, path, size):
+        name = posixpath.basename(path)
+        sticky = "T" + self.tag if self.tag else ""
+        return ("%s %s\n%s/%s\n/%s/%s///%s\nu=rw,g=r,o=r\n%s\n" % (
+            response, localdir or "./", self.repository.root, path, name,
+            self.revision(path), sticky, size)).encode(g_encoding)
+
+    def updated(self, out, localdir, path, response="Updated"):
+        revision = self.revision(path)
+        data = revision and self.repository.body(path, revision)
+        if data is None:
+            return      # not in the tag, or removed since
+        size = "%d" % len(data)
+        if self.gzipfiles:
+            data = gzip.compress(data, self.gzipfiles)
+            size = "z%d" % len(data)
+        out.append(("M U %s%s\n" % (localdir, posixpath.basename(path)))
+                   .encode(g_encoding))
+        out.append(self.fileheader(response, localdir, path, size))
+        out.append(data)
+        out.append(None)    # counts a file
+
+    def printed(self, out, path):
+        # co -p: what goes to stderr, then the body on stdout
+        revision = self.revision(path)
+        data = revision and self.repository.body(path, revision)
+        if data is None:
+            return
+        out.append(("E ===================================================="
+                    "===============\nE Checking out %s\nE RCS:  %s/%s,v\n"
+                    "E VERS: %s\nE ***************\n" % (
+                        path, self.repository.root, path, revision))
+                   .encode(g_encoding))
+        if "Mbinary" in self.responses:
+            out.append(b"Mbinary\n%d\n" % len(data) + data)
+        else:
+            out.append(b"".join(b"M " + x + b"\n"
+                                for x in data.splitlines()))
+        out.append(None)
+
+    def patched(self, out, localdir, path, old):
+        diff = rcsdiff(old, self.repository.body(path))
+        out.append(("M P %s%s\n" % (localdir, posixpath.basename(path)))
+                   .encode(g_encoding))
+        out.append(self.fileheader("Rcs-diff", localdir, path,
+                                   "%d" % len(diff)))
+        out.append(diff)
+        out.append(None)
+
+
+class Cfakepserver:
+    """
+    Class name: Cfakepserver
+    Description:
+        serves $repository (a Crepository) on $address:$port, 0 for
+        any free port, one thread per connection. with $users (a
+        dictionary of user -> password) only they may log in, else
+        anyone can. counters has how many times each request was
+        received, logins, files sent and connections. stall() makes
+        it hang on some requests, hangup() close the connection in
+        the middle of a reply.
+
+    """
+    def __init__(self, repository, address="127.0.0.1", port=0, users=None):
+        self.repository = repository
+        self.address = address
+        self.port = port
+        self.users = users
+        self.sock = None
+        self.thread = None
+        self.counters = {}
+        self.lock = threading.Lock()
+        # request name -> how many more of them to hang on, and to
+        # hang up on after sending some of the reply
+        self.stalls = {}
+        self.hangups = {}
+        # the client's password scrambling, to check against
+        self.scramble = Cprotocvs(None, address, port).encodepassword
+
+    def start(self):
+        """ starts serving, returns the port """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.address, self.port))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.acceptloop)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def acceptloop(self):
+        while self.sock:
+            try:
+                sock, peer = self.sock.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.count("connections")
+            t = threading.Thread(target=Cfakesession(self, sock).run)
+            t.daemon = True
+            t.start()
+
+    def checkpassword(self, username, scrambled):
+        if self.users is None:
+            return 1
+        return username in self.users and \
+            self.scramble(self.users[username]) == scrambled
+
+    def stall(self, request, n=1):
+        """ the sessions receiving the next $n $request requests
+        never answer them, nor anything after them """
+        with self.lock:
+            self.stalls[request] = self.stalls.get(request, 0) + n
+
+    def hangup(self, request, after=64, n=1):
+        """ the sessions receiving the next $n $request requests close
+        the connection once they sent $after bytes of the reply """
+        with self.lock:
+            self.hangups.setdefault(request, []).extend([after] * n)
+
+    def takehangup(self, request):
+        # the bytes to send before hanging up, None to go on
+        with self.lock:
+            if not self.hangups.get(request):
+                return None
+            return self.hangups[request].pop(0)
+
+    def takestall(self, request):
+        with self.lock:
+            if not self.stalls.get(request):
+                return 0
+            self.stalls[request] -= 1
+            return 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+
+def checkoutreply(repository, gzipfiles=0):
+    """ the bytes a checkout of the whole module of $repository is
+    answered with, file bodies gzipped at level $gzipfiles, for
+    feeding a parser without any server """
+    session = Cfakesession(Cfakepserver(repository), None)
+    session.gzipfiles = gzipfiles
+    out = []
+    module = repository.module
+    session.checkoutdir(out, module + "/", module, 1)
+    return b"".join(x for x in out if x is not None) + b"ok\n"
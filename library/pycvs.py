@@ -21,8 +21,39 @@
 
 import socket
 import select
+import selectors
 import bisect
+import heapq
+import itertools
 import time
+import calendar
+import random
+import os
+import asyncio
+import threading
+import concurrent.futures
+import io
+import zlib
+import gzip
+import tarfile
+import zipfile
+import tempfile
+import hashlib
+import sqlite3
+import shutil
+import posixpath
+import email.utils
+import logging
+import argparse
+import json
+import sys
+import http.server
+from collections import deque, OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 """
  _^_      -----------------------------------------------------------------
@@ -37,12 +68,63 @@ TODO:
     * check blocking version works as expected
 """
 
+g_encoding = "utf-8"    # encoding of the text parts of the protocol
+
+FICLONE = 0x40049409    # linux ioctl making a reflink of a file
+
+# one logger per subsystem, silent unless the application configures
+# logging. the per-file and per-request messages are DEBUG.
+g_log = logging.getLogger("pycvs")
+g_log.addHandler(logging.NullHandler())
+g_lognet = logging.getLogger("pycvs.net")          # connections
+g_logproto = logging.getLogger("pycvs.proto")      # requests, responses
+g_logevents = logging.getLogger("pycvs.events")    # thrown events
+g_logserver = logging.getLogger("pycvs.server")    # server drivers
+
 g_cvsevents = [    # list of supported cvs events
     "loginok",
     "loginfail",
-    "updatedfile"
+    "updatedfile",
+    "patchedfile",
+    "removedfile",
+    "newentry",
+    "dirinfo",
+    "moduleexpansion",
+    "checkoutdone",
+    "syncdone",
+    "message",
+    "taggedmessage",
+    "binarymessage",
+    "errormessage",
+    "sinkerror",
+    "timeout"
 ]
 
+g_fileevents = (    # cvs events about a single file
+    "updatedfile",
+    "patchedfile",
+    "removedfile",
+    "newentry"
+)
+
+g_idempotent = (    # requests we may send again if their reply never came
+    "valid-requests",
+    "expand-modules",
+    "co",
+    "update",
+    "rlist",
+    "rlog",
+    "rdiff",
+    "export"
+)
+
+g_sessionrequests = (    # every new connection sends its own
+    "Root",
+    "Valid-responses",
+    "Gzip-stream",
+    "gzip-file-contents"
+)
+
 
 class BaseCVSClient:
     """
@@ -57,8 +139,9 @@ class BaseCVSClient:
 
         # register all callbacks/event handlers for all servers
         for eventname in g_cvsevents:
-            m = "on_" + eventname
-            self.cvs.addevent(eventname, getattr(self, m), 0)
+            m = getattr(self, "on_" + eventname, None)
+            if m:
+                self.cvs.addevent(eventname, m, 0)
 
     def newserver(self, address, port, sync):
         return self.cvs.newserver(address, port, sync)
@@ -83,24 +166,49 @@ class CVS:
     def __init__(self):
         """ list of Cservercvs objs """
         self.cvsobjs = []
-        """ global handlers dictionary """
-        self.ghandlers = {}
+        """ global handlers, every server looks them up here """
+        self.ghandlers = Chandlers()
         self.exiting = 0
 
+        """ one selector (epoll, kqueue..) watching every server
+        socket. a ready server handles what one read brings, so no
+        server holds up the others. """
+        self.selector = selectors.DefaultSelector()
+
+        """ the arguments of set_executor, for new servers too """
+        self.executorargs = None
+
+        """ seconds checkio_all spent waiting in select """
+        self.waittime = 0.0
+
     def checkio_all(self, timeout=0):
-        """ calls checkio on every Cservercvs obj and returns. """
+        """ sends the pending requests of every Cservercvs obj, waits
+        up to $timeout for any of them to have data and dispatches
+        only the ready ones. """
         if not self.cvsobjs:
             time.sleep(timeout)
+            return
 
-        for srv in self.cvsobjs:
-            try:
+        try:
+            for srv in self.cvsobjs:
                 if srv.asyncversion:
-                    srv.checkio(timeout)
+                    srv.checkio_send()
                 else:
                     srv.checkio(-1)
 
-            except:    # should we exit here? fix this later
-                raise CVSException("checkio_all: checkio failed")
+            for srv in self.cvsobjs:
+                wait = srv.objprotocvs.nexttimer()
+                if wait is not None and wait < timeout:
+                    timeout = wait
+            start = time.perf_counter()
+            events = self.selector.select(timeout)
+            self.waittime += time.perf_counter() - start
+
+            for key, mask in events:
+                key.data.checkio_ready()
+
+        except:    # should we exit here? fix this later
+            raise CVSException("checkio_all: checkio failed")
         return
 
     def checkio_loop_all(self, timeout=0.2):
@@ -125,43 +233,73 @@ class CVS:
 
         self.cvsobjs.append(newobj)
 
-        """ register the existing events in the new server """
-        for en in g_cvsevents:
-            for h in self.ghandlers.get(en, []):
-                try:
-                    newobj.addevent(en, h[1], h[0])
-                except:    # should we exit here?
-                    raise CVSException("newserver: srv.addevent failed")
-
-        return newobj
+        """ asynchronous servers are driven by our selector """
+        if newobj.asyncversion:
+            newobj.set_selector(self.selector)
 
-    def addevent(self, eventname, handler, priority=0):
-        """ used to globally add event handlers for all servers
-        which are instanced through this CVS interface.
-        The event handlers (callbacks) are stored locally in order
-        to keep new servers (created after the call to this
-        method) updated. """
+        if self.executorargs:
+            newobj.set_executor(*self.executorargs)
 
-        """
-        check if the event name doesn't exist in the dictionary.
-        if it doesn't add an entry as a list.
-        """
-        if eventname not in self.ghandlers:
-            self.ghandlers[eventname] = []
+        """ the new server sees the global handlers, present and
+        future ones """
+        newobj.objdispa.set_globalhandlers(self.ghandlers)
 
-        """ sort by priority inside the list by calling
-        bisect.insort_right """
+        return newobj
 
-        bisect.insort(self.ghandlers[eventname], (priority, handler))
+    def set_executor(self, workers, maxqueue=256, events=None, ordered=1):
+        """ every server runs the handlers of the file events on one
+        pool of $workers threads, see Ceventdispa.set_executor.
+        each server keeps its own queue of $maxqueue events. """
+        executor = workers
+        if isinstance(workers, int):
+            executor = workers and \
+                concurrent.futures.ThreadPoolExecutor(workers)
+        self.executorargs = (executor, maxqueue, events, ordered)
+        for srv in self.cvsobjs:
+            srv.set_executor(*self.executorargs)
 
-        """ register the existing events in each server dispatcher """
+    def drain(self):
+        """ waits for the handlers of every server """
         for srv in self.cvsobjs:
-            for en in g_cvsevents:
-                for h in self.ghandlers.get(en, []):
-                    try:
-                        srv.addevent(en, h[1], h[0])
-                    except:    # should we exit here?
-                        raise CVSException("addevent: srv.addevent failed")
+            srv.drain()
+
+    def get_metrics(self):
+        """ the Cservercvs.get_metrics() of every server """
+        return [srv.get_metrics() for srv in self.cvsobjs]
+
+    def prometheus(self):
+        """ the metrics of every server in the Prometheus text format """
+        return prometheustext(self.cvsobjs, self.waittime)
+
+    def writemetrics(self, path):
+        """ writes prometheus() to $path, replacing it at once so a
+        collector (node_exporter's textfile) never reads half of it """
+        tmppath = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmppath, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmppath, path)
+
+    def servemetrics(self, port=0, address="127.0.0.1"):
+        """ serves prometheus() on http://$address:$port/metrics from
+        a thread, returns the started Cmetricsserver """
+        server = Cmetricsserver(self.prometheus, address, port)
+        server.start()
+        return server
+
+    def addevent(self, eventname, handler, priority=0):
+        """ used to globally add event handlers for all servers
+        which are instanced through this CVS interface.
+        The event handlers (callbacks) are stored once, in a
+        registry every server dispatcher looks up, so servers
+        created after the call to this method get them too.
+        returns 0 if $handler was already registered for $eventname,
+        its priority is updated. """
+        return self.ghandlers.add(eventname, handler, priority)
+
+    def removeevent(self, eventname, handler):
+        """ removes a global event handler, returns 0 if it wasn't
+        registered """
+        return self.ghandlers.remove(eventname, handler)
 
 """
 Singleton implementation for python.
@@ -217,36 +355,198 @@ class DispaException(Exception):
     pass
 
 
+class Chandlers:
+    """
+    Class name: Chandlers
+    Description:
+        event handlers by event name, sorted by priority and, for the
+        same priority, by the order they were added in. a handler is
+        registered once per event. the sorted lists are replaced, not
+        changed, so they can be walked while handlers come and go.
+
+    """
+    # registration order, shared so handlers of different registries
+    # (global and per server) merge in the order they were added.
+    sequence = itertools.count()
+
+    def __init__(self):
+        # event name -> sorted list of (priority, seq, handler), and
+        # (event name, handler) -> its tuple there.
+        self.byname = {}
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def add(self, eventname, handler, priority=0):
+        with self.lock:
+            old = self.entries.get((eventname, handler))
+            if old and old[0] == priority:
+                return 0
+            handlers = [x for x in self.byname.get(eventname, ())
+                        if x is not old]
+            # seq is unique, handlers themselves are never compared
+            entry = (priority, next(Chandlers.sequence), handler)
+            bisect.insort(handlers, entry)
+            self.byname[eventname] = handlers
+            self.entries[(eventname, handler)] = entry
+            return 0 if old else 1
+
+    def remove(self, eventname, handler):
+        with self.lock:
+            old = self.entries.pop((eventname, handler), None)
+            if not old:
+                return 0
+            self.byname[eventname] = [x for x in self.byname[eventname]
+                                      if x is not old]
+            return 1
+
+    def get(self, eventname):
+        return self.byname.get(eventname, ())
+
+    def __contains__(self, key):
+        # (event name, handler) in handlers
+        return key in self.entries
+
+
 class Ceventdispa:
     """
     Class name: Ceventdispa
     Description:    * we create a dispatcher per servercvs instance.
+                    * the handlers of some events can be run by an
+                      executor instead, see set_executor().
 
     """
     def __init__(self):
-        self.ehandlers = {}
+        self.ehandlers = Chandlers()
+        # a Chandlers shared by every server, see CVS.addevent
+        self.ghandlers = None
+
+        # the executor running the handlers of the events in offload,
+        # None to run every handler in the calling thread.
+        self.executor = None
+        self.offload = ()
+        self.ordered = 1
+        self.maxqueue = 0
+
+        """ events waiting for (or being run by) the executor, one
+        lane per event name when ordered. a lane has a single runner
+        submitted at a time. queued counts the events of every lane,
+        errors what their handlers raised. """
+        self.cond = threading.Condition()
+        self.lanes = {}
+        self.queued = 0
+        self.errors = []
+        self.local = threading.local()
 
     def addeventhook(self, eventname, handler, priority=0):
         """ adds 1 or more event handlers for eventname.
         if there are more than one handler for an event,
-         they are sorted and called by $priority """
-
-        """
-        check if the event name doesn't exist in the dictionary.
-        if it doesn't add an entry as a list.
-        """
-        if eventname not in self.ehandlers:
-            self.ehandlers[eventname] = []
-
-        """ sort by priority inside the list by calling
-        bisect.insort_right """
-
-        bisect.insort(self.ehandlers[eventname], (priority, handler))
+         they are sorted and called by $priority, the ones with
+         the same priority in the order they were added. """
+        return self.ehandlers.add(eventname, handler, priority)
+
+    def removeeventhook(self, eventname, handler):
+        return self.ehandlers.remove(eventname, handler)
+
+    def set_globalhandlers(self, ghandlers):
+        self.ghandlers = ghandlers
+
+    def gethandlers(self, eventname):
+        # our handlers and the global ones, merged by priority
+        local = self.ehandlers.get(eventname)
+        if self.ghandlers is None:
+            return local
+        shared = self.ghandlers.get(eventname)
+        if not local:
+            return shared
+        if not shared:
+            return local
+        return heapq.merge(local, shared)
 
     def calleventhook(self, event):
-        for h in self.ehandlers.get(event.get_name(), []):
+        if self.executor and event.get_name() in self.offload:
+            self.queueevent(event)
+            return
+
+        for h in self.gethandlers(event.get_name()):
             """ is there a handler function? """
-            h[1](event)
+            h[2](event)
+
+    def set_executor(self, executor, maxqueue=256, events=None, ordered=1):
+        """ runs the handlers of $events (the file events by default)
+        on $executor, a concurrent.futures executor or a number of
+        worker threads, 0 or None running them inline again.
+        when $maxqueue events are waiting the caller blocks, so the
+        reader stops reading until the handlers catch up, 0 or None
+        letting the queue grow without bound. with $ordered the
+        events of each name are handled one at a time, in order.
+        other events are handled right away, drain() waits for the
+        queued ones. """
+        self.drain()
+        if isinstance(executor, int):
+            executor = executor and \
+                concurrent.futures.ThreadPoolExecutor(executor)
+        self.executor = executor or None
+        self.maxqueue = maxqueue
+        self.offload = frozenset(g_fileevents if events is None else events)
+        self.ordered = ordered
+
+    def queueevent(self, event):
+        with self.cond:
+            """ backpressure. not for events thrown by our own
+            handlers, the workers waiting on themselves would never
+            wake up. """
+            if not getattr(self.local, "worker", 0):
+                while self.maxqueue and self.queued >= self.maxqueue:
+                    self.cond.wait()
+
+            if self.ordered:
+                key = event.get_name()
+            else:
+                key = object()
+            self.queued += 1
+            lane = self.lanes.get(key)
+            if lane:
+                lane.append(event)
+                return
+            self.lanes[key] = deque([event])
+        self.executor.submit(self.runlane, key)
+
+    def runlane(self, key):
+        # handles one event of lane $key, and submits itself again
+        # while the lane has more, so lanes share the workers.
+        self.local.worker = 1
+        with self.cond:
+            event = self.lanes[key][0]
+        try:
+            for h in self.gethandlers(event.get_name()):
+                h[2](event)
+        except Exception as x:
+            with self.cond:
+                self.errors.append(x)
+
+        with self.cond:
+            lane = self.lanes[key]
+            lane.popleft()
+            self.queued -= 1
+            self.cond.notify_all()
+            if not lane:
+                del self.lanes[key]
+                return
+        self.executor.submit(self.runlane, key)
+
+    def drain(self, errors=1):
+        """ waits for the queued events to be handled. with $errors
+        raises DispaException if a handler failed meanwhile. """
+        with self.cond:
+            if not getattr(self.local, "worker", 0):
+                while self.queued:
+                    self.cond.wait()
+            if not errors or not self.errors:
+                return
+            failed = self.errors
+            self.errors = []
+        raise DispaException("%d event handlers failed, first: %r"
+                             % (len(failed), failed[0]))
 
 
 class NetworkException(Exception):
@@ -264,12 +564,87 @@ class Cnetwork:
     Description: we create a network interface per servercvs instance
 
     """
-    def __init__(self):
+    def __init__(self, bufsize=65536):
         self.socket = 0
         self.address = ""
         self.port = 0
 
+        # the most we take from the socket at a time. what comes is
+        # handed to the protocol parser as is, nothing is buffered here.
+        self.bufsize = bufsize
+
+        # send buffer. writes accumulate here and go out in as few
+        # send() calls as possible on flush(), or right away unless
+        # we are corked.
+        self.wbuf = bytearray()
+        self.corked = 0
+
+        # zlib streams once Gzip-stream is on, for each direction
+        self.compressor = None
+        self.decompressor = None
+        self.zdirty = 0
+
+        # selector to keep our socket registered in, if any
+        self.selector = None
+        self.selectordata = None
+
+        # what went through the socket (compressed, as sent), the
+        # seconds spent waiting for it and the connections made
+        self.bytesin = 0
+        self.bytesout = 0
+        self.waittime = 0.0
+        self.connects = 0
+
+        # seconds a connect() or a read may block, None is forever
+        self.timeout = None
+
+        self.set_connected(0)
+
+    def set_timeout(self, timeout):
+        """ bounds how long connecting and each read may block """
+        self.timeout = timeout
+        if self.get_connected() and self.socket:
+            self.socket.settimeout(timeout)
+
+    def set_selector(self, selector, data=None):
+        """ keeps the socket registered in $selector (with $data)
+        while it is connected. """
+        self.unregister()
+        self.selector = selector
+        self.selectordata = data
+        if self.get_connected():
+            self.register()
+
+    def register(self):
+        if self.selector:
+            self.selector.register(self.socket, selectors.EVENT_READ,
+                                   self.selectordata)
+
+    def unregister(self):
+        if self.selector and self.get_connected():
+            try:
+                self.selector.unregister(self.socket)
+            except (KeyError, ValueError):
+                pass
+
+    def adopt(self, sock, address, port):
+        """ takes over the already connected socket $sock """
+        self.address = address
+        self.port = port
+        self.socket = sock
+        self.socket.settimeout(self.timeout)
+        self.clearbuffer()
+        self.set_connected(1)
+        self.register()
+
+    def detach(self):
+        """ gives away our connected socket without closing it """
+        sock = self.socket
+        self.unregister()
         self.set_connected(0)
+        self.clearbuffer()
+        self.socket = 0
+        return sock
 
     def connect(self, address, port):
         """ connects to a given server address and port """
@@ -277,11 +652,17 @@ class Cnetwork:
         self.port = port
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.settimeout(self.timeout)
+        self.clearbuffer()
 
         """ now try to connect """
         try:
             self.socket.connect((self.address, self.port))
+            # we coalesce writes ourselves, don't let Nagle delay them
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.set_connected(1)
+            self.connects += 1
+            self.register()
 
         except socket.error as x:
             self.set_connected(0)
@@ -293,55 +674,141 @@ class Cnetwork:
 
     def close(self):
         """ closes the local socket """
+        self.unregister()
         self.set_connected(0)
+        self.clearbuffer()
         try:
             self.socket.close()
-        except socket.error as x:
+        except socket.error:
             raise NetworkException
 
     def send(self, data):
+        """ writes $data and flushes it unless we are corked """
+        self.write(data)
+        if not self.corked:
+            self.flush()
+
+    def write(self, data):
+        """ appends $data to the send buffer """
+        if isinstance(data, str):
+            data = data.encode(g_encoding, "surrogateescape")
+        if self.compressor:
+            data = self.compressor.compress(data)
+            self.zdirty = 1
+        self.wbuf += data
+
+    def syncflush(self):
+        # ends the compressed block so the server can inflate
+        # everything written so far.
+        if self.compressor and self.zdirty:
+            self.wbuf += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.zdirty = 0
+
+    def set_compression(self, level):
+        """ compresses everything written from now on (Gzip-stream) """
+        self.compressor = zlib.compressobj(level)
+        self.zdirty = 0
+
+    def set_decompression(self):
+        """ inflates everything received from now on. what was
+        received already is the caller's, see inflate(). """
+        self.decompressor = zlib.decompressobj()
+
+    def inflate(self, data):
+        if self.decompressor:
+            return self.decompressor.decompress(data)
+        return data
+
+    def flush(self):
+        """ sends the whole send buffer, handling partial writes.
+        whatever couldn't be sent stays in the buffer. """
+        if not self.get_connected():
+            return
+        self.syncflush()
+        if not self.wbuf:
+            return
+
+        sent = 0
+        view = memoryview(self.wbuf)
         try:
-            self.socket.send(data)
+            while sent < len(view):
+                sent += self.socket.send(view[sent:])
         except socket.error as x:
             raise NetworkException("Failed sending to %s port %s\n%s" %
                                    (self.address, self.port, x))
+        finally:
+            view.release()
+            del self.wbuf[:sent]
+            self.bytesout += sent
+
+    def cork(self):
+        """ holds back writes until the matching uncork() """
+        self.corked += 1
+
+    def uncork(self):
+        self.corked -= 1
+        if not self.corked:
+            self.flush()
+
+    def receive(self):
+        """ one recv() of up to bufsize bytes, inflated if the stream
+        is compressed (maybe to nothing yet). raises NetworkException
+        on errors and once the server closed the connection. """
+        start = time.perf_counter()
+        try:
+            data = self.socket.recv(self.bufsize)
+        except socket.timeout as x:
+            self.timedout(x)
+        except socket.error as x:
+            raise NetworkException("Failed reading from %s port %s\n%s" %
+                                   (self.address, self.port, x))
+        finally:
+            self.waittime += time.perf_counter() - start
+        self.bytesin += len(data)
+
+        if not data:
+            # the server closed the connection, so do we.
+            self.close()
+            raise NetworkException("Failed reading from %s port %s\n"
+                                   "Error while reading from socket (EOF?)\n" %
+                                   (self.address, self.port))
+        return self.inflate(data)
 
-    def read(self, size):
-        readbuf = ""
+    def receive_into(self, view):
+        """ one recv_into() of up to len($view) bytes straight into
+        the writable $view, for an uncompressed stream. returns how
+        many came, raises NetworkException like receive(). """
+        start = time.perf_counter()
         try:
-            readbuf = self.socket.recv(size)
+            size = self.socket.recv_into(view)
+        except socket.timeout as x:
+            self.timedout(x)
         except socket.error as x:
             raise NetworkException("Failed reading from %s port %s\n%s" %
                                    (self.address, self.port, x))
+        finally:
+            self.waittime += time.perf_counter() - start
+        self.bytesin += size
 
-        if readbuf == "":
+        if not size:
+            self.close()
             raise NetworkException("Failed reading from %s port %s\n"
                                    "Error while reading from socket (EOF?)\n" %
                                    (self.address, self.port))
+        return size
 
-        return readbuf
+    def timedout(self, x):
+        # a read gave up half way through a response, what comes
+        # next can't be parsed any more.
+        self.close()
+        raise NetworkException("Timed out reading from %s port %s\n%s" %
+                               (self.address, self.port, x))
 
-    def read_nl(self):
-        # read until we meet a newline
-        x = out = ""
-        while x != "\n":
-            out += x
-            try:
-                x = self.read(1)
-            except:
-                raise NetworkException
-        return out
-
-    def read_cmd(self):
-        # read until we meet a 0x20
-        out = x = ""
-        while x != " ":
-            out += x
-            try:
-                x = self.read(1)
-            except:
-                raise NetworkException
-        return out
+    def clearbuffer(self):
+        # buffers and compression belong to a single connection
+        self.wbuf = bytearray()
+        self.compressor = None
+        self.decompressor = None
 
     def socketready(self, timeout=0):
         """
@@ -351,7 +818,9 @@ class Cnetwork:
         if not self.socket:
             raise NetworkException("socket not connected.")
 
+        start = time.perf_counter()
         r, w, e = select.select([self.socket], [], [], timeout)
+        self.waittime += time.perf_counter() - start
         if self.socket not in r:
             raise NetworkException("socket not ready.")
 
@@ -367,18 +836,200 @@ class Cnetwork:
         self.connected = value
 
 
+class Cconnpool:
+    """
+    Class name: Cconnpool
+    Description:
+        keeps authenticated pserver connections alive to be reused by
+        any Cprotocvs logging in with the same (address, port, cvsroot,
+        username, scrambled password). connections idle for more than
+        $maxidle seconds are closed, and at most $maxperkey are kept
+        per key.
+
+    """
+    def __init__(self, maxidle=60, maxperkey=4):
+        self.maxidle = maxidle
+        self.maxperkey = maxperkey
+        # key -> deque of (socket, time it was released), newest last
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        """ returns a healthy idle socket for $key, or None """
+        with self.lock:
+            self.evict()
+            conns = self.idle.get(key)
+            while conns:
+                sock, since = conns.pop()
+                if self.healthy(sock):
+                    return sock
+                self.closesocket(sock)
+        return None
+
+    def release(self, key, sock):
+        """ keeps $sock, an authenticated idle connection, for $key """
+        with self.lock:
+            conns = self.idle.setdefault(key, deque())
+            if len(conns) >= self.maxperkey:
+                self.closesocket(sock)
+                return
+            conns.append((sock, time.time()))
+
+    def evict(self, now=None):
+        """ closes the connections idle for too long """
+        if now is None:
+            now = time.time()
+        for key in list(self.idle):
+            conns = self.idle[key]
+            # oldest first
+            while conns and now - conns[0][1] > self.maxidle:
+                self.closesocket(conns.popleft()[0])
+            if not conns:
+                del self.idle[key]
+
+    def healthy(self, sock):
+        # an idle connection has nothing to say. if the socket is
+        # readable the server either closed it or sent garbage.
+        try:
+            r, w, e = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return 0
+        return not r
+
+    def closesocket(self, sock):
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+    def close(self):
+        """ closes every idle connection """
+        with self.lock:
+            for conns in self.idle.values():
+                for sock, since in conns:
+                    self.closesocket(sock)
+            self.idle = {}
+
+
+""" connections are shared by every server unless told otherwise """
+g_connpool = Cconnpool()
+
+
+class Caionetwork(Cnetwork):
+    """
+    Class name: Caionetwork
+    Description:
+        Cnetwork on top of asyncio streams. a reader task hands what
+        it receives to handler.aio_data(data), there is nothing to
+        read from us. aio_closed() is called on EOF or errors.
+
+    """
+    def __init__(self, handler, bufsize=65536):
+        Cnetwork.__init__(self, bufsize)
+        self.handler = handler
+        self.writer = None
+        self.task = None
+
+    def connect(self, address, port):
+        """ starts connecting in the background, sends are queued
+        until the connection is up. """
+        self.address = address
+        self.port = port
+        self.clearbuffer()
+        self.set_connected(1)
+        self.task = asyncio.ensure_future(self.readloop())
+
+    async def readloop(self):
+        # we stop as soon as close() or a new connect() replaced us
+        me = asyncio.current_task()
+        try:
+            reader, writer = await asyncio.open_connection(self.address,
+                                                           self.port)
+        except OSError as x:
+            if self.task is not me:
+                return
+            self.set_connected(0)
+            self.handler.aio_closed(NetworkException(
+                "Unable to connect to %s port %s: %s" %
+                (self.address, self.port, x)))
+            return
+
+        if self.task is not me:
+            writer.close()
+            return
+
+        # send what was written while connecting
+        self.writer = writer
+        if not self.corked:
+            self.flush()
+
+        while 1:
+            try:
+                data = await reader.read(self.bufsize)
+            except OSError:
+                data = b""
+
+            if not data:
+                break
+            self.bytesin += len(data)
+            self.handler.aio_data(self.inflate(data))
+            if self.task is not me:
+                return
+
+        self.close()
+        self.handler.aio_closed(NetworkException(
+            "Failed reading from %s port %s\n"
+            "Error while reading from socket (EOF?)\n" %
+            (self.address, self.port)))
+
+    def close(self):
+        self.set_connected(0)
+        self.clearbuffer()
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        if self.task:
+            task = self.task
+            self.task = None
+            if task is not asyncio.current_task():
+                task.cancel()
+
+    def flush(self):
+        # the transport takes care of partial writes. until we are
+        # connected the data waits in the send buffer.
+        if not self.writer:
+            return
+        self.syncflush()
+        if self.wbuf:
+            self.writer.write(bytes(self.wbuf))
+            self.bytesout += len(self.wbuf)
+            self.wbuf = bytearray()
+
+    def receive(self):
+        raise NetworkException("a Caionetwork can't be read")
+
+    def socketready(self, timeout=0):
+        raise NetworkException("socket not ready.")
+
+
 class Cfile:
     """
     Class name: Cfile
-    Description: a file
+    Description: a file. size is an int and data a bytes-like
+        object (a read-only memoryview for received files), or None
+        when the body was streamed to a Cfilesink.
 
     """
-    def __init__(self, path, entries, mode, size, data):
+    def __init__(self, path, entries, mode, size, data, localdir="",
+                 response="Updated", modtime=None):
         self.path = path
         self.entries = entries
         self.mode = mode
         self.size = size
         self.data = data
+        self.localdir = localdir
+        self.response = response
+        self.modtime = modtime
 
     def get_path(self):
         return self.path
@@ -395,137 +1046,1835 @@ class Cfile:
     def get_data(self):
         return self.data
 
+    def get_localdir(self):
+        return self.localdir
 
-class Crequest:
-    """
-    Class name: Crequest
-    Description: a CVS request
+    def get_response(self):
+        # the response which brought the file (Updated, Merged..)
+        return self.response
 
-    """
-    def __init__(self, data=0):
-        self.reqdata = data
-        self.sent = 0
-        self.retries = 5
-        self.replied = 0
+    def get_modtime(self):
+        # seconds since the epoch, or None if the server didn't say
+        return self.modtime
 
-    def get_data(self):
-        return self.reqdata
+    def get_name(self):
+        # the entries line looks like /name/revision/timestamp/options/tag
+        if self.entries:
+            return self.entries.split("/")[1]
+        return self.path.split("/")[-1]
+
+    def get_localpath(self):
+        # where the file goes in the client's working directory
+        return os.path.join(self.localdir, self.get_name())
+
+
+def parsecvsdate(date):
+    """ converts a CVS date (18 Oct 2026 10:00:00 -0000) into seconds
+    since the epoch, None if it can't be parsed """
+    parsed = email.utils.parsedate_tz(date)
+    if not parsed:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+
+def parselogdate(date):
+    """ converts a log date (2026/10/18 10:00:00, or 2026-10-18
+    10:00:00 +0000 from newer servers) into seconds since the epoch,
+    None if it can't be parsed """
+    fields = date.replace("/", "-").split()
+    try:
+        year, month, day = [int(x) for x in fields[0].split("-")]
+        hour, minute, second = [int(x) for x in fields[1].split(":")]
+        seconds = calendar.timegm((year, month, day, hour, minute, second))
+        if len(fields) > 2:
+            zone = fields[2]
+            offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+            seconds -= -offset if zone[0] == "-" else offset
+    except (IndexError, ValueError):
+        return None
+    return seconds
+
+
+def unparselogdate(seconds):
+    """ the log date of $seconds since the epoch, as rlog -d takes it """
+    return time.strftime("%Y-%m-%d %H:%M:%S +0000", time.gmtime(seconds))
+
+
+def unparsemode(bits):
+    """ converts permission bits into a CVS mode line """
+    parts = []
+    for who, shift in (("u", 6), ("g", 3), ("o", 0)):
+        what = ""
+        for ch, bit in (("r", 4), ("w", 2), ("x", 1)):
+            if (bits >> shift) & bit:
+                what += ch
+        parts.append(who + "=" + what)
+    return ",".join(parts)
+
+
+def parsemode(mode):
+    """ converts a CVS mode line (u=rw,g=r,o=r) into permission bits """
+    bits = 0
+    shifts = {"u": 6, "g": 3, "o": 0}
+    perms = {"r": 4, "w": 2, "x": 1}
+    for part in mode.split(","):
+        who, sep, what = part.partition("=")
+        if not sep or who not in shifts:
+            continue
+        for ch in what:
+            bits |= perms.get(ch, 0) << shifts[who]
+    return bits
+
+
+def firstline(data):
+    """ the first line of a request, for the log """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data[:200]).decode(g_encoding, "replace")
+    return data.split("\n", 1)[0]
+
+
+def describe(data):
+    """ what the log says about the data of an event, a Cfile is
+    its path and size, never its body """
+    if isinstance(data, Cfile):
+        return "%s (%d bytes)" % (data.get_path(), data.get_size())
+    return repr(data)
+
+
+class SinkException(Exception):
+    """
+    Class name: SinkException
+    Description: Cfilesink exception
 
-    def set_sent(self, value=1):
-        self.sent = value
+    """
+    pass
 
-    def get_sent(self):
-        return self.sent
 
-    def set_retries(self, retries):
-        self.retries = retries
+def entrytimestamp(mtime):
+    """ the timestamp CVS keeps in CVS/Entries for a file modified
+    at $mtime (seconds since the epoch) """
+    return time.asctime(time.gmtime(int(mtime)))
+
+
+def applyrcsdiff(data, diff):
+    """ applies an RCS format diff (Rcs-diff response) to $data.
+    the commands are "dN M", delete M lines from line N, and "aN M",
+    add the M following lines after line N. line numbers refer to
+    the original data. """
+    old = bytes(data).splitlines(True)
+    lines = bytes(diff).splitlines(True)
+    out = []
+    pos = 0     # lines of old copied or deleted so far
+    i = 0
+    while i < len(lines):
+        cmd = lines[i]
+        i += 1
+        try:
+            start, count = [int(x) for x in cmd[1:].split()]
+        except ValueError:
+            raise SinkException("bad rcs diff command: %r" % cmd)
+
+        if cmd[:1] == b"d":
+            out.extend(old[pos:start - 1])
+            pos = start - 1 + count
+        elif cmd[:1] == b"a":
+            out.extend(old[pos:start])
+            pos = start
+            out.extend(lines[i:i + count])
+            i += count
+        else:
+            raise SinkException("bad rcs diff command: %r" % cmd)
+
+    out.extend(old[pos:])
+    return b"".join(out)
+
+
+def applyunifieddiff(data, hunks):
+    """ applies the hunks of a unified diff (see Crdiffparser) to
+    $data. the context and the lines removed have to be there as
+    they are, there is no fuzz. """
+    old = bytes(data).splitlines(True)
+    out = []
+    pos = 0     # lines of old copied or deleted so far
+    for start, count, lines in hunks:
+        # a hunk removing nothing goes after line $start
+        begin = start - 1 if count else start
+        if begin < pos or begin > len(old):
+            raise SinkException("hunk out of place at line %d" % start)
+        out.extend(old[pos:begin])
+        pos = begin
+        for i, line in enumerate(lines):
+            kind = line[:1]
+            if kind == "\\":
+                continue
+            text = line[1:].encode(g_encoding, "surrogateescape")
+            if i + 1 == len(lines) or lines[i + 1][:1] != "\\":
+                text += b"\n"
+            if kind in (" ", "-"):
+                if pos >= len(old) or old[pos] != text:
+                    raise SinkException("hunk doesn't apply at line %d"
+                                        % (pos + 1))
+                pos += 1
+            if kind in (" ", "+"):
+                out.append(text)
+    out.extend(old[pos:])
+    return b"".join(out)
+
+
+class Centries:
+    """
+    Class name: Centries
+    Description:
+        the CVS administrative files of a working directory: CVS/Entries
+        (plus what CVS/Entries.Log added or removed since) and
+        CVS/Repository. changes are appended to Entries.Log, like cvs
+        does, so updating one file doesn't rewrite the whole Entries.
 
-    def get_retries(self):
-        return self.retries
+    """
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        self.admdir = os.path.join(dirpath, "CVS")
+        # file name -> entries line, and the subdirectory names
+        self.files = {}
+        self.subdirs = set()
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.admdir, "Entries"))
+
+    def load(self):
+        self.files = {}
+        self.subdirs = set()
+        for line in self.readlines("Entries"):
+            self.apply(line, 1)
+        for line in self.readlines("Entries.Log"):
+            op, sep, line = line.partition(" ")
+            if op in ("A", "R"):
+                self.apply(line, op == "A")
+        return self
+
+    def readlines(self, name):
+        try:
+            with open(os.path.join(self.admdir, name), "r",
+                      encoding=g_encoding, errors="surrogateescape") as fd:
+                return fd.read().splitlines()
+        except OSError:
+            return []
+
+    def apply(self, line, add):
+        if line.startswith("D/"):
+            name = line.split("/")[1]
+            if add:
+                self.subdirs.add(name)
+            else:
+                self.subdirs.discard(name)
+        elif line.startswith("/"):
+            name = line.split("/")[1]
+            if add:
+                self.files[name] = line
+            else:
+                self.files.pop(name, None)
+
+    def save(self):
+        """ writes Entries with everything in Entries.Log merged """
+        os.makedirs(self.admdir, exist_ok=True)
+        lines = list(self.files.values())
+        lines.extend("D/%s////" % x for x in sorted(self.subdirs))
+        path = os.path.join(self.admdir, "Entries")
+        with open(path + ".Backup", "w", encoding=g_encoding,
+                  errors="surrogateescape") as fd:
+            fd.write("".join(x + "\n" for x in lines))
+        os.replace(path + ".Backup", path)
+        try:
+            os.unlink(os.path.join(self.admdir, "Entries.Log"))
+        except OSError:
+            pass
 
-    def set_replied(self, value=1):
-        self.replied = value
+    def log(self, op, line):
+        # appends an A(dd) or R(emove) line to Entries.Log
+        self.apply(line, op == "A")
+        with open(os.path.join(self.admdir, "Entries.Log"), "a",
+                  encoding=g_encoding, errors="surrogateescape") as fd:
+            fd.write("%s %s\n" % (op, line))
+
+    def add(self, line):
+        self.log("A", line)
+
+    def remove(self, name):
+        line = self.files.get(name)
+        if line:
+            self.log("R", line)
+
+    def adddir(self, name):
+        if name not in self.subdirs:
+            self.log("A", "D/%s////" % name)
+
+    def get_repository(self, cvsroot=""):
+        """ the repository path of this directory, made absolute with
+        $cvsroot if CVS/Repository is relative """
+        lines = self.readlines("Repository")
+        if not lines:
+            return ""
+        repository = lines[0]
+        if cvsroot and not repository.startswith("/"):
+            repository = cvsroot.rstrip("/") + "/" + repository
+        return repository
+
+    def set_repository(self, repository, cvsroot=""):
+        os.makedirs(self.admdir, exist_ok=True)
+        with open(os.path.join(self.admdir, "Repository"), "w",
+                  encoding=g_encoding, errors="surrogateescape") as fd:
+            fd.write(repository + "\n")
+        if cvsroot:
+            with open(os.path.join(self.admdir, "Root"), "w",
+                      encoding=g_encoding, errors="surrogateescape") as fd:
+                fd.write(cvsroot + "\n")
+        if not self.exists():
+            open(os.path.join(self.admdir, "Entries"), "w").close()
+
+    def filestate(self, name):
+        """ "missing", "unchanged" or "modified", comparing the file
+        with the timestamp of its entry """
+        path = os.path.join(self.dirpath, name)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return "missing"
 
-    def get_replied(self):
-        return self.replied
+        fields = self.files[name].split("/")
+        if fields[3] == entrytimestamp(mtime):
+            return "unchanged"
+        return "modified"
 
 
-class Cresponse:
+class Crevcache:
     """
-    Class name: Cresponse
-    Description: a CVS response
+    Class name: Crevcache
+    Description:
+        an on-disk cache of file revisions, shared by every checkout
+        using the same $cachedir. bodies are kept once, named by their
+        sha256, and found from (cvsroot, path, revision, options). the
+        least recently used bodies go once the cache holds more than
+        $maxsize bytes. it also remembers the last entries line seen
+        for each file, so a new checkout can be laid out from the
+        cache and then only needs what changed since (Cdirsink).
+        $link says how bodies get into a working directory: "copy"
+        (a reflink where the filesystem can, else a copy) or "hard"
+        (a hardlink, editing such a file in place spoils the cached
+        body, which is then found out and dropped on its next use).
 
     """
-    def __init__(self, name, data=0):
-        self.resname = name
-        self.resdata = data
+    def __init__(self, cachedir, maxsize=1 << 30, link="copy"):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.link = link
+        self.lock = threading.Lock()
+
+        for name in ("objects", "tmp"):
+            os.makedirs(os.path.join(cachedir, name), exist_ok=True)
+
+        """ the index. it can be rebuilt by checking out again, so it
+        isn't worth an fsync per file. """
+        self.db = sqlite3.connect(os.path.join(cachedir, "index.db"),
+                                  check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY, size INTEGER, used REAL);
+            CREATE INDEX IF NOT EXISTS blobsused ON blobs (used);
+            CREATE TABLE IF NOT EXISTS revisions (
+                root TEXT, path TEXT, revision TEXT, options TEXT,
+                hash TEXT, mode INTEGER,
+                PRIMARY KEY (root, path, revision, options));
+            CREATE INDEX IF NOT EXISTS revisionshash ON revisions (hash);
+            CREATE TABLE IF NOT EXISTS latest (
+                root TEXT, path TEXT, entryline TEXT,
+                PRIMARY KEY (root, path));
+        """)
+        self.size = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def blobpath(self, blobhash):
+        return os.path.join(self.cachedir, "objects", blobhash[:2], blobhash)
+
+    def revkey(self, root, path, entryline):
+        # the revision and keyword options of an entries line
+        fields = entryline.split("/")
+        if len(fields) < 6 or not fields[2] or fields[2].startswith("-"):
+            return None
+        return (root, path, fields[2], fields[4])
+
+    def lookup(self, root, path, entryline):
+        """ the hash and mode of the cached body of the revision in
+        $entryline, None if we don't have it """
+        key = self.revkey(root, path, entryline)
+        if not key:
+            return None
+        with self.lock:
+            return self.db.execute(
+                "SELECT hash, mode FROM revisions WHERE root=? AND path=? "
+                "AND revision=? AND options=?", key).fetchone()
+
+    def store(self, root, path, entryline, srcpath, mode=0):
+        """ keeps the file at $srcpath as the revision in $entryline
+        and remembers it as the latest one of $path """
+        key = self.revkey(root, path, entryline)
+        if not key:
+            return None
+
+        tmppath = os.path.join(self.cachedir, "tmp", "%d.%d" % (
+            os.getpid(), threading.get_ident()))
+        digest = hashlib.sha256()
+        size = 0
+        with open(srcpath, "rb") as src:
+            if self.link == "hard":
+                for chunk in iter(lambda: src.read(1 << 16), b""):
+                    digest.update(chunk)
+                    size += len(chunk)
+            else:
+                with open(tmppath, "wb") as dst:
+                    for chunk in iter(lambda: src.read(1 << 16), b""):
+                        digest.update(chunk)
+                        dst.write(chunk)
+                        size += len(chunk)
+        blobhash = digest.hexdigest()
+
+        blobpath = self.blobpath(blobhash)
+        try:
+            if os.path.exists(blobpath):
+                size = 0
+            else:
+                os.makedirs(os.path.dirname(blobpath), exist_ok=True)
+                if self.link == "hard":
+                    os.link(srcpath, blobpath)
+                else:
+                    os.replace(tmppath, blobpath)
+        finally:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?, ?)",
+                            (blobhash, size, time.time()))
+            self.db.execute(
+                "INSERT OR REPLACE INTO revisions VALUES (?, ?, ?, ?, ?, ?)",
+                key + (blobhash, mode))
+            self.db.execute("INSERT OR REPLACE INTO latest VALUES (?, ?, ?)",
+                            (root, path, entryline))
+            self.db.commit()
+            self.size += size
+        if self.size > self.maxsize:
+            self.evict()
+        return blobhash
+
+    def forget(self, root, path):
+        """ $path is no longer in the repository """
+        with self.lock:
+            self.db.execute("DELETE FROM latest WHERE root=? AND path=?",
+                            (root, path))
+            self.db.commit()
+
+    def manifest(self, root, repository):
+        """ the (path, entryline) last seen of every file below the
+        repository directory $repository """
+        prefix = repository.rstrip("/") + "/"
+        with self.lock:
+            return self.db.execute(
+                "SELECT path, entryline FROM latest WHERE root=? "
+                "AND substr(path, 1, ?)=? ORDER BY path",
+                (root, len(prefix), prefix)).fetchall()
+
+    def place(self, blobhash, destpath, mode=0):
+        """ puts the body $blobhash at $destpath, checking it against
+        its hash first. returns 0 if it is gone or was spoilt. """
+        blobpath = self.blobpath(blobhash)
+        digest = hashlib.sha256()
+        try:
+            with open(blobpath, "rb") as fd:
+                for chunk in iter(lambda: fd.read(1 << 16), b""):
+                    digest.update(chunk)
+        except OSError:
+            self.drop(blobhash)
+            return 0
+        if digest.hexdigest() != blobhash:
+            self.drop(blobhash)
+            return 0
+
+        if os.path.lexists(destpath):
+            os.unlink(destpath)
+        if self.link == "hard":
+            os.link(blobpath, destpath)
+        else:
+            self.clone(blobpath, destpath)
+        if mode:
+            os.chmod(destpath, mode)
+
+        with self.lock:
+            self.db.execute("UPDATE blobs SET used=? WHERE hash=?",
+                            (time.time(), blobhash))
+            self.db.commit()
+        return 1
+
+    def clone(self, srcpath, destpath):
+        # a reflink shares the blocks until either copy is written
+        with open(srcpath, "rb") as src, open(destpath, "wb") as dst:
+            if fcntl:
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    return
+                except OSError:
+                    pass
+            shutil.copyfileobj(src, dst, 1 << 16)
+
+    def drop(self, blobhash):
+        # forgets the body $blobhash and every revision kept in it
+        with self.lock:
+            row = self.db.execute("SELECT size FROM blobs WHERE hash=?",
+                                  (blobhash,)).fetchone()
+            self.db.execute("DELETE FROM blobs WHERE hash=?", (blobhash,))
+            self.db.execute("DELETE FROM revisions WHERE hash=?",
+                            (blobhash,))
+            self.db.commit()
+            if row:
+                self.size -= row[0]
+        try:
+            os.unlink(self.blobpath(blobhash))
+        except OSError:
+            pass
 
-    def get_data(self):
-        return self.resdata
+    def evict(self):
+        """ drops the least recently used bodies until the cache is
+        back under 90% of $maxsize """
+        with self.lock:
+            self.size = self.db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            goal = self.maxsize * 9 // 10
+            victims = []
+            size = self.size
+            for blobhash, blobsize in self.db.execute(
+                    "SELECT hash, size FROM blobs ORDER BY used"):
+                if size <= goal:
+                    break
+                victims.append(blobhash)
+                size -= blobsize
+        for blobhash in victims:
+            self.drop(blobhash)
 
-    def get_name(self):
-        return self.resname
+    def close(self):
+        with self.lock:
+            self.db.close()
 
 
-class ProtocolException(Exception):
+class Chistory:
     """
-    Class name: ProtocolException
-    Description: Cprotocol exception
+    Class name: Chistory
+    Description:
+        the history of one repository in the SQLite database $dbpath,
+        loaded from rlog replies (Cservercvs.rlog). revisions are
+        indexed by file, revision, author and date, and tags by name,
+        so "what changed since" or "who touched" questions are asked
+        here instead of the server. loading a file again replaces
+        what was known of it; updateoptions() gives the rlog options
+        that only fetch what is newer than what is here.
 
     """
-    pass
+    def __init__(self, dbpath):
+        self.lock = threading.Lock()
+        self.files = 0
+        self.revisions = 0
+
+        """ like the Crevcache index, rlog can always fill it again """
+        self.db = sqlite3.connect(dbpath, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, head TEXT);
+            CREATE TABLE IF NOT EXISTS revisions (
+                path TEXT, revision TEXT, date INTEGER, author TEXT,
+                state TEXT, added INTEGER, removed INTEGER,
+                commitid TEXT, message TEXT,
+                PRIMARY KEY (path, revision));
+            CREATE INDEX IF NOT EXISTS revisionsdate ON revisions (date);
+            CREATE INDEX IF NOT EXISTS revisionsauthor
+                ON revisions (author, date);
+            CREATE TABLE IF NOT EXISTS tags (
+                tag TEXT, path TEXT, revision TEXT,
+                PRIMARY KEY (tag, path));
+            CREATE INDEX IF NOT EXISTS tagspath ON tags (path);
+        """)
+
+    def below(self, path):
+        # an SQL condition for the files at or below $path
+        path = path.strip("/")
+        if not path:
+            return "1", ()
+        return "(path = ? OR (path >= ? AND path < ?))", \
+            (path, path + "/", path + "0")
+
+    # loading #####################################################
+
+    def add(self, path, head, tags, revisions):
+        """ a file of an rlog reply, see Crlogparser. it is committed
+        with the rest of the reply, by done(). """
+        rows = []
+        for rev in revisions:
+            added, removed = rev["lines"] or (None, None)
+            rows.append((path, rev["revision"], rev["date"], rev["author"],
+                         rev["state"], added, removed, rev["commitid"],
+                         rev["message"]))
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?)",
+                            (path, head))
+            self.db.executemany("INSERT OR REPLACE INTO revisions VALUES "
+                                "(?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            if tags is not None:
+                self.db.execute("DELETE FROM tags WHERE path=?", (path,))
+                self.db.executemany(
+                    "INSERT INTO tags VALUES (?, ?, ?)",
+                    [(tag, path, rev) for tag, rev in tags.items()])
+            self.files += 1
+            self.revisions += len(rows)
+
+    def done(self, request, reply):
+        # the rlog request was replied (or given up on), what came
+        # of it is kept either way
+        self.commit()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def latest(self):
+        """ the date of the newest revision known, None if none is """
+        with self.lock:
+            return self.db.execute(
+                "SELECT MAX(date) FROM revisions").fetchone()[0]
+
+    def updateoptions(self):
+        """ rlog options for the files changed since latest(). their
+        tags come along, tags moved on files that didn't change
+        need a full rlog. """
+        latest = self.latest()
+        if latest is None:
+            return []
+        return ["-S", "-d>" + unparselogdate(latest)]
+
+    # queries #####################################################
+
+    def changedsince(self, date, path=""):
+        """ the revisions at or below $path committed at or after
+        $date (seconds since the epoch), oldest first, as (path,
+        revision, date, author, message) tuples """
+        where, args = self.below(path)
+        with self.lock:
+            return self.db.execute(
+                "SELECT path, revision, date, author, message FROM "
+                "revisions WHERE date >= ? AND " + where +
+                " ORDER BY date, path", (date,) + args).fetchall()
+
+    def touched(self, path):
+        """ who committed to the files at or below $path, as (author,
+        revisions, last date) tuples, the latest first """
+        where, args = self.below(path)
+        with self.lock:
+            return self.db.execute(
+                "SELECT author, COUNT(*), MAX(date) FROM revisions WHERE " +
+                where + " GROUP BY author ORDER BY MAX(date) DESC",
+                args).fetchall()
+
+    def log(self, path):
+        """ the revisions of file $path, the newest first, as
+        (revision, date, author, state, message) tuples """
+        with self.lock:
+            return self.db.execute(
+                "SELECT revision, date, author, state, message FROM "
+                "revisions WHERE path=? ORDER BY date DESC",
+                (path,)).fetchall()
+
+    def tagged(self, tag):
+        """ {path: revision} of the files tagged $tag """
+        with self.lock:
+            return dict(self.db.execute(
+                "SELECT path, revision FROM tags WHERE tag=?", (tag,)))
+
+    def tags(self, path):
+        """ {tag: revision} of file $path """
+        with self.lock:
+            return dict(self.db.execute(
+                "SELECT tag, revision FROM tags WHERE path=?", (path,)))
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
 
 
-class Cprotocvs:
+class Cfilesink:
     """
-    Class name: Cprotocvs
-    Description: takes care of the CVS protocol implementation.
+    Class name: Cfilesink
+    Description:
+        receives file bodies chunk by chunk instead of as a whole.
+        inherit from this class and define open() returning a writable
+        object for each file; close() is called once the body is done.
+        the other methods are told about the rest of the changes to
+        the working copy, by default they are ignored.
 
     """
-    def __init__(self, adaptercallback, address, port, replycallback=None):
-        # our queue of outgoing Crequests
-        self.sendqueue = []
+    def open(self, cfile):
+        raise SinkException("open NOT IMPLEMENTED!")
 
-        # create a network interface object
-        self.objnet = Cnetwork()
+    def close(self, cfile, fd):
+        fd.close()
 
-        # store the adapter to use for notifying responses.
-        self.adapter = adaptercallback
+    def abort(self, cfile, fd):
+        """ the body of $cfile didn't come whole """
+        fd.close()
 
-        # used mostly by synchronous server versions
-        self.replycallback = replycallback
+    def remove(self, cfile):
+        """ Removed (the file is gone) or Remove-entry """
+        return
 
-        self.set_loggedin(0)
-        self.set_authorized(0)
-        self.sent_authreq = 0
+    def newentry(self, cfile):
+        """ Checked-in or New-entry, a new entries line only """
+        return
 
-        self.address = address
-        self.port = port
+    def patch(self, cfile):
+        """ Rcs-diff, the data of $cfile is a diff to apply to the
+        file we have """
+        raise SinkException("patch NOT IMPLEMENTED!")
 
-        self.workingpath = ""
+    def dirinfo(self, response, localdir, repository, tagspec):
+        """ Set/Clear-sticky, Set/Clear-static-directory.. """
+        return
 
-        # dictionary for encoding the authentication password
-        self.encoding = {'!': 120, '"': 53, '%': 109,
-                         '&': 72, "'": 108, '(': 70,
-                         ')': 64, '*': 76, '+': 67,
-                         ',': 116, '-': 74, '.': 68,
-                         '/': 87, ': ': 112, ';': 86,
-                         '<': 118, '=': 110, '>': 122,
-                         '?': 105, '_': 56,
 
-                         '0': 111, '1': 52, '2': 75,
-                         '3': 119, '4': 49, '5': 34,
-                         '6': 82, '7': 81, '8': 95,
-                         '9': 65,
+class Cdirsink(Cfilesink):
+    """
+    Class name: Cdirsink
+    Description:
+        writes every received file below a destination directory.
+        with $admin it also keeps the CVS administrative files (see
+        Centries) so the tree can be updated later, and with a
+        $revcache (Crevcache) the revisions written are kept there.
+        the sessions of a parallel checkout may share it.
 
-                         'A': 57, 'B': 83, 'C': 43,
-                         'D': 46, 'E': 102, 'F': 40,
-                         'G': 89, 'H': 38, 'I': 103,
-                         'J': 45, 'K': 50, 'L': 42,
-                         'M': 123, 'N': 91, 'O': 35,
-                         'P': 125, 'Q': 55, 'R': 54,
-                         'S': 66, 'T': 124, 'U': 126,
-                         'V': 59, 'W': 47, 'X': 92,
-                         'Y': 71, 'Z': 115,
+    """
+    def __init__(self, destdir, admin=1, cvsroot="", revcache=None):
+        self.destdir = destdir
+        self.admin = admin
+        self.cvsroot = cvsroot
+        self.revcache = revcache
+        # Centries of the directories seen so far
+        self.dirs = {}
+        # directory -> names of its subdirectories whose files came
+        # before its own, it lists them once it has its Entries
+        self.subdirs = {}
+        # the administrative files are written one session at a time
+        self.lock = threading.RLock()
+        # files laid out from revcache by materialize()
+        self.materialized = 0
+
+    def cacheroot(self):
+        # the revisions of a repository are the same for every user
+        return self.cvsroot.split("@")[-1]
+
+    def entries(self, cfile):
+        # returns the Centries of the directory of $cfile, creating
+        # the directory and its administrative files the first time.
+        dirpath = os.path.normpath(os.path.join(self.destdir,
+                                                cfile.get_localdir()))
+        with self.lock:
+            entries = self.dirs.get(dirpath)
+            if entries:
+                return entries
 
-                         'a': 121, 'b': 117, 'c': 104,
-                         'd': 101, 'e': 100, 'f': 69,
-                         'g': 73, 'h': 99, 'i': 63,
-                         'j': 94, 'k': 93, 'l': 39,
-                         'm': 37, 'n': 61, 'o': 48,
-                         'p': 58, 'q': 113, 'r': 32,
-                         's': 90, 't': 44, 'u': 98,
-                         'v': 60, 'w': 51, 'x': 33,
-                         'y': 97, 'z': 62
-                         }
+            try:
+                os.makedirs(dirpath, exist_ok=True)
+                entries = Centries(dirpath)
+                if self.admin:
+                    if entries.exists():
+                        entries.load()
+                    else:
+                        entries.set_repository(
+                            os.path.dirname(cfile.get_path()), self.cvsroot)
+                        self.adddir(os.path.dirname(dirpath),
+                                    os.path.basename(dirpath))
+                    for name in sorted(self.subdirs.pop(dirpath, ())):
+                        entries.adddir(name)
+            except OSError as x:
+                raise SinkException("unable to create %s: %s" % (dirpath, x))
+
+            self.dirs[dirpath] = entries
+            return entries
+
+    def adddir(self, dirpath, name):
+        # lists the new subdirectory $name in the Entries of $dirpath,
+        # or once they are made if its files didn't come yet
+        parent = self.dirs.get(dirpath)
+        if parent is None:
+            parent = Centries(dirpath)
+            if not parent.exists():
+                self.subdirs.setdefault(dirpath, set()).add(name)
+                return
+            parent.load()
+        parent.adddir(name)
 
-    # cvs internal requests #######################################
-    def encodepassword(self, input):
-        """ used to encode the password the CVS way.
-        Note: Control characters, space, and characters outside
-        the invariant ISO 646 character set are ignored!.
-        """
-        output = "A"
+    def open(self, cfile):
+        entries = self.entries(cfile)
+        return self.create(os.path.join(entries.dirpath, cfile.get_name()))
+
+    def create(self, fullpath):
+        # a file hardlinked from the cache is replaced, not rewritten
+        try:
+            if self.revcache and os.path.lexists(fullpath):
+                os.unlink(fullpath)
+            return open(fullpath, "wb")
+        except OSError as x:
+            raise SinkException("unable to write %s: %s" % (fullpath, x))
+
+    def close(self, cfile, fd):
+        fd.close()
+        bits = parsemode(cfile.get_mode())
+        if bits:
+            os.chmod(fd.name, bits)
+        if cfile.get_modtime() is not None:
+            os.utime(fd.name, (cfile.get_modtime(), cfile.get_modtime()))
+        if self.admin:
+            line = self.addentry(cfile, fd.name)
+            # a merged file isn't the revision it names
+            if line and self.revcache and cfile.get_response() != "Merged":
+                self.revcache.store(self.cacheroot(), cfile.get_path(),
+                                    line, fd.name, bits)
+
+    def addentry(self, cfile, fullpath):
+        # the server leaves the timestamp empty, we fill in the one of
+        # the file as written. a merged file holds local changes.
+        fields = cfile.get_entries().split("/")
+        if len(fields) < 6:
+            return None
+        if cfile.get_response() == "Merged":
+            fields[3] = "Result of merge"
+        else:
+            try:
+                fields[3] = entrytimestamp(os.stat(fullpath).st_mtime)
+            except OSError:
+                fields[3] = "dummy timestamp"
+        line = "/".join(fields)
+        with self.lock:
+            self.entries(cfile).add(line)
+        return line
+
+    def remove(self, cfile):
+        entries = self.entries(cfile)
+        if cfile.get_response() == "Removed":
+            try:
+                os.unlink(os.path.join(entries.dirpath, cfile.get_name()))
+            except OSError:
+                pass
+        if self.admin:
+            with self.lock:
+                entries.remove(cfile.get_name())
+        if self.revcache and cfile.get_response() == "Removed":
+            self.revcache.forget(self.cacheroot(), cfile.get_path())
+
+    def newentry(self, cfile):
+        if self.admin:
+            self.addentry(cfile, os.path.join(self.entries(cfile).dirpath,
+                                              cfile.get_name()))
+
+    def patch(self, cfile):
+        fullpath = os.path.join(self.entries(cfile).dirpath, cfile.get_name())
+        try:
+            with open(fullpath, "rb") as fd:
+                data = applyrcsdiff(fd.read(), cfile.get_data())
+        except OSError as x:
+            raise SinkException("unable to patch %s: %s" % (fullpath, x))
+
+        fd = self.create(fullpath)
+        fd.write(data)
+        self.close(cfile, fd)
+
+    def materialize(self, basedir, repository):
+        """ lays out the files below the repository directory
+        $repository as the revcache last saw them, $basedir being the
+        repository directory of our destination. what the cache lacks
+        is left out, for an update to bring. sticky tags are not
+        kept. returns the number of files laid out. """
+        bydir = {}
+        for path, line in self.revcache.manifest(self.cacheroot(),
+                                                 repository):
+            dirname = posixpath.dirname(path)
+            bydir.setdefault(dirname, []).append((path, line))
+            # and the directories in between, even with no files
+            while dirname != repository and dirname.startswith(repository):
+                dirname = posixpath.dirname(dirname)
+                bydir.setdefault(dirname, [])
+
+        count = 0
+        for dirname in sorted(bydir):
+            localdir = posixpath.relpath(dirname, basedir)
+            entries = self.entries(Cfile(dirname + "/.", "", "", 0, None,
+                                         localdir))
+            for path, line in bydir[dirname]:
+                fields = line.split("/")
+                cached = self.revcache.lookup(self.cacheroot(), path, line)
+                fullpath = os.path.join(entries.dirpath, fields[1])
+                if not cached or not self.revcache.place(cached[0], fullpath,
+                                                         cached[1]):
+                    continue
+                fields[3] = entrytimestamp(os.stat(fullpath).st_mtime)
+                fields[5] = ""
+                entries.apply("/".join(fields), 1)
+                count += 1
+            if self.admin:
+                entries.save()
+        self.materialized += count
+        return count
+
+    def dirinfo(self, response, localdir, repository, tagspec):
+        if not self.admin:
+            return
+        admdir = os.path.join(self.destdir, localdir, "CVS")
+        if not os.path.isdir(admdir):
+            return
+
+        if response == "Set-sticky":
+            with open(os.path.join(admdir, "Tag"), "w") as fd:
+                fd.write(tagspec + "\n")
+        elif response == "Set-static-directory":
+            open(os.path.join(admdir, "Entries.Static"), "w").close()
+        else:
+            name = {"Clear-sticky": "Tag",
+                    "Clear-static-directory": "Entries.Static"}.get(response)
+            if name:
+                try:
+                    os.unlink(os.path.join(admdir, name))
+                except OSError:
+                    pass
+
+
+class Cstreamsink(Cfilesink):
+    """
+    Class name: Cstreamsink
+    Description: writes every received file body to a caller supplied
+        writable object, one after the other. the writable is not closed.
+
+    """
+    def __init__(self, writable):
+        self.writable = writable
+
+    def open(self, cfile):
+        return self.writable
+
+    def close(self, cfile, fd):
+        return
+
+
+class Carchivesink(Cfilesink):
+    """
+    Class name: Carchivesink
+    Description:
+        the base of the sinks writing every received file into one
+        archive, named $prefix and its local path, with no files or
+        directories made on the way. the files of parallel sessions
+        sharing the sink go in one at a time. finish() ends the
+        archive, the writable is not closed.
+
+    """
+    def __init__(self, prefix="", mtime=None):
+        self.prefix = prefix
+        # for the files the server sent no Mod-time for
+        self.mtime = mtime if mtime is not None else time.time()
+        self.lock = threading.Lock()
+        self.files = 0
+
+    def membername(self, cfile):
+        return self.prefix + posixpath.normpath(posixpath.join(
+            cfile.get_localdir(), cfile.get_name()))
+
+    def membermode(self, cfile):
+        return parsemode(cfile.get_mode()) or 0o644
+
+    def membertime(self, cfile):
+        modtime = cfile.get_modtime()
+        return modtime if modtime is not None else self.mtime
+
+    def abort(self, cfile, fd):
+        """ the member already begun stays, a new one follows when
+        the file is sent again """
+        g_logproto.warning("%s: left incomplete in the archive",
+                           self.membername(cfile))
+        self.close(cfile, fd)
+
+    def finish(self):
+        raise SinkException("finish NOT IMPLEMENTED!")
+
+
+class Ctarmember:
+    """
+    Class name: Ctarmember
+    Description: the body of a tar member, written through to the
+        archive of a Ctarsink as it comes.
+
+    """
+    def __init__(self, out):
+        self.out = out
+        self.written = 0
+
+    def write(self, data):
+        self.out.write(data)
+        self.written += len(data)
+
+
+class Ctarsink(Carchivesink):
+    """
+    Class name: Ctarsink
+    Description:
+        writes every received file into a tar archive on $writable (a
+        file or a pipe), compressed with $compression: "", "gz", "bz2"
+        or "xz", at $level. a body whose size is known goes to the
+        archive right after its header as it comes; a gzipped one
+        (gzip-file-contents) is spooled first, its size being known
+        only at its end.
+
+    """
+    def __init__(self, writable, compression="", prefix="", mtime=None,
+                 level=6):
+        Carchivesink.__init__(self, prefix, mtime)
+        self.writable = writable
+        if compression == "gz":
+            self.out = gzip.GzipFile(fileobj=writable, mode="wb",
+                                     compresslevel=level, mtime=0)
+        elif compression == "bz2":
+            import bz2
+            self.out = bz2.BZ2File(writable, "wb", compresslevel=level)
+        elif compression == "xz":
+            import lzma
+            self.out = lzma.LZMAFile(writable, "wb", preset=level)
+        elif not compression:
+            self.out = writable
+        else:
+            raise SinkException("unknown tar compression %s" % compression)
+        # bytes of the archive so far, it ends on a whole record
+        self.offset = 0
+
+    def header(self, cfile, size):
+        info = tarfile.TarInfo(self.membername(cfile))
+        info.size = size
+        info.mode = self.membermode(cfile)
+        info.mtime = int(self.membertime(cfile))
+        buf = info.tobuf(tarfile.PAX_FORMAT, g_encoding, "surrogateescape")
+        self.out.write(buf)
+        self.offset += len(buf)
+
+    def pad(self, size):
+        # a member takes whole blocks
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            self.out.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        self.offset += -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+    def open(self, cfile):
+        if cfile.get_size() is None:
+            return tempfile.SpooledTemporaryFile(1 << 22)
+        self.lock.acquire()
+        self.header(cfile, cfile.get_size())
+        return Ctarmember(self.out)
+
+    def close(self, cfile, fd):
+        if isinstance(fd, Ctarmember):
+            try:
+                if fd.written < cfile.get_size():
+                    # cut short, the header said more
+                    self.out.write(tarfile.NUL *
+                                   (cfile.get_size() - fd.written))
+                self.pad(fd.written)
+            finally:
+                self.lock.release()
+        else:
+            size = fd.tell()
+            fd.seek(0)
+            with self.lock:
+                self.header(cfile, size)
+                shutil.copyfileobj(fd, self.out, 1 << 16)
+                self.pad(size)
+            fd.close()
+        self.files += 1
+
+    def finish(self):
+        """ writes the end of the archive """
+        with self.lock:
+            end = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+            self.offset += len(end)
+            remainder = self.offset % tarfile.RECORDSIZE
+            if remainder:
+                end += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+            self.out.write(end)
+            if self.out is not self.writable:
+                self.out.close()
+            self.writable.flush()
+
+
+class Czipsink(Carchivesink):
+    """
+    Class name: Czipsink
+    Description:
+        writes every received file into a zip archive on $writable,
+        compressed with $compression (a zipfile method, ZIP_STORED
+        for none). bodies are compressed as they come, the archive
+        needs no seeking so a pipe will do.
+
+    """
+    def __init__(self, writable, compression=zipfile.ZIP_DEFLATED,
+                 prefix="", mtime=None):
+        Carchivesink.__init__(self, prefix, mtime)
+        self.writable = writable
+        self.compression = compression
+        self.zip = zipfile.ZipFile(writable, "w", compression)
+
+    def open(self, cfile):
+        info = zipfile.ZipInfo(self.membername(cfile), time.localtime(
+            max(self.membertime(cfile), 315532800))[:6])
+        info.external_attr = (0o100000 | self.membermode(cfile)) << 16
+        info.compress_type = self.compression
+        size = cfile.get_size()
+        info.file_size = size or 0
+        self.lock.acquire()
+        try:
+            return self.zip.open(info, "w", force_zip64=size is None)
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def close(self, cfile, fd):
+        try:
+            fd.close()
+        finally:
+            self.lock.release()
+        self.files += 1
+
+    def finish(self):
+        """ writes the central directory """
+        with self.lock:
+            self.zip.close()
+        self.writable.flush()
+
+
+class Crequest:
+    """
+    Class name: Crequest
+    Description: a CVS request
+
+    """
+    def __init__(self, data=0, expectreply=0, callback=None, collect=0,
+                 output=None):
+        self.reqdata = data
+        self.expectreply = expectreply
+        self.sent = 0
+        self.retries = 5
+        self.replied = 0
+        # time.perf_counter() when sent and replied
+        self.senttime = None
+        self.repliedtime = None
+        # time.monotonic() by which (more of) the reply has to come,
+        # None until it is the oldest request in flight, and the
+        # requests sent with this one, see Cprotocvs.set_timeout
+        self.deadline = None
+        self.batch = None
+        # why the file sink failed on a file of the reply, which then
+        # ends in "error" even if the server says ok
+        self.sinkerror = None
+
+        # callback(request, "ok" or "error") is called once replied,
+        # or callback(request, "sent") once sent if there is no reply.
+        # with collect, the M lines of the reply are kept in output,
+        # a list, or given to $output.append() (see Crlogparser), as
+        # are Mbinary bodies, as bytes. they aren't thrown as
+        # "message" events then.
+        self.callback = callback
+        self.output = output
+        if output is None and collect:
+            self.output = []
+
+    def get_data(self):
+        return self.reqdata
+
+    def get_expectreply(self):
+        return self.expectreply
+
+    def get_callback(self):
+        return self.callback
+
+    def get_output(self):
+        return self.output
+
+    def get_name(self):
+        # the request name, the first word of its data
+        data = self.reqdata
+        if isinstance(data, (bytes, bytearray)):
+            data = bytes(data[:64]).decode(g_encoding, "replace")
+        return data.split("\n", 1)[0].split(" ", 1)[0]
+
+    def set_sent(self, value=1):
+        self.sent = value
+        self.senttime = time.perf_counter() if value else None
+
+    def get_sent(self):
+        return self.sent
+
+    def set_retries(self, retries):
+        self.retries = retries
+
+    def get_retries(self):
+        return self.retries
+
+    def set_replied(self, value=1):
+        self.replied = value
+        self.repliedtime = time.perf_counter() if value else None
+
+    def get_latency(self):
+        # seconds from sent to replied, None if it wasn't both
+        if self.senttime is None or self.repliedtime is None:
+            return None
+        return self.repliedtime - self.senttime
+
+    def get_replied(self):
+        return self.replied
+
+
+class Cresponse:
+    """
+    Class name: Cresponse
+    Description: a CVS response
+
+    """
+    def __init__(self, name, data=0):
+        self.resname = name
+        self.resdata = data
+
+    def get_data(self):
+        return self.resdata
+
+    def get_name(self):
+        return self.resname
+
+
+class Chistogram:
+    """
+    Class name: Chistogram
+    Description: counts observations (seconds) in fixed buckets, the
+        way Prometheus histograms do.
+
+    """
+    # upper bounds of the buckets, the last one is +Inf
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+               0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def cumulative(self):
+        """ (upper bound, observations up to it) pairs, +Inf last """
+        return list(zip(self.buckets + (float("inf"),),
+                        itertools.accumulate(self.counts)))
+
+    def quantile(self, fraction):
+        """ estimates the value below which $fraction of the
+        observations are, interpolating inside its bucket """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        lower = 0.0
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                return min(self.max,
+                           lower + (bound - lower) * (rank - seen) / count)
+            seen += count
+            lower = bound
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count,
+                "sum": round(self.sum, 6),
+                "mean": round(self.sum / self.count, 6) if self.count else 0,
+                "p50": round(self.quantile(0.5), 6),
+                "p99": round(self.quantile(0.99), 6),
+                "max": round(self.max, 6)}
+
+
+class Cmetrics:
+    """
+    Class name: Cmetrics
+    Description:
+        what a Cprotocvs did: send to reply latency per request name,
+        files received, errors and sessions. they are only updated by
+        the thread driving the protocol, snapshot() may be called
+        from any thread.
+
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        # request name -> Chistogram of its send to reply latency
+        self.latency = {}
+        self.requests = 0
+        self.replies = 0
+        self.errors = 0
+        self.files = 0
+        self.filebytes = 0
+        # authenticated connections opened or taken from the pool,
+        # every one after the first is a reconnect
+        self.sessions = 0
+        self.reconnects = 0
+        # requests whose reply didn't come in time, and how many
+        # times they were sent again
+        self.timeouts = 0
+        self.retries = 0
+        # seconds spent in the event handlers
+        self.handlertime = 0.0
+
+    def replied(self, request, ok):
+        self.replies += 1
+        if not ok:
+            self.errors += 1
+        latency = request.get_latency()
+        if latency is None:
+            return
+        name = request.get_name()
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency[name] = Chistogram()
+        histogram.observe(latency)
+
+    def received(self, size):
+        self.files += 1
+        self.filebytes += size
+
+    def newsession(self):
+        if self.sessions:
+            self.reconnects += 1
+        self.sessions += 1
+
+    def snapshot(self):
+        elapsed = time.perf_counter() - self.start
+        latency = dict(self.latency)
+        return {
+            "elapsed_s": round(elapsed, 6),
+            "requests": self.requests,
+            "replies": self.replies,
+            "errors": self.errors,
+            "files": self.files,
+            "file_bytes": self.filebytes,
+            "files_per_s": round(self.files / elapsed, 3) if elapsed else 0,
+            "sessions": self.sessions,
+            "reconnects": self.reconnects,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "handler_s": round(self.handlertime, 6),
+            "latency": dict((name, histogram.snapshot())
+                            for name, histogram in sorted(latency.items())),
+        }
+
+
+class ProtocolException(Exception):
+    """
+    Class name: ProtocolException
+    Description: Cprotocol exception
+
+    """
+    pass
+
+
+class Cresponseparser:
+    """
+    Class name: Cresponseparser
+    Description:
+        splits what a CVS server sends into responses, without doing
+        any I/O: feed() it the bytes as they come, in chunks of any
+        size, and next() returns the events they complete, None
+        once it needs more:
+
+            ("response", name, rest, lines, size)
+                a response line with the lines after it (Updated has
+                four) and, for a response with a body, its size.
+            ("body", chunk)
+                the next piece of the body, a memoryview of the data
+                fed. a body is never buffered, it comes in the pieces
+                it arrived in.
+            ("end", None)
+                the body is complete.
+
+        parsing may stop anywhere, in the middle of the lines of a
+        response or of a body, and go on with the next feed(). the
+        data fed is never joined, only the lines of a response cut
+        between two feeds are. a driver may receive the rest of a
+        body itself, see bodyleft().
+
+    """
+    # response name -> (lines after the response line, 1 if the last
+    # of them is the size of a body following them). a z before the
+    # size means the body is gzipped.
+    shapes = {
+        "Updated": (4, 1),
+        "Created": (4, 1),
+        "Update-existing": (4, 1),
+        "Merged": (4, 1),
+        "Patched": (4, 1),
+        "Rcs-diff": (4, 1),
+        "Checked-in": (2, 0),
+        "New-entry": (2, 0),
+        "Copy-file": (2, 0),
+        "Removed": (1, 0),
+        "Remove-entry": (1, 0),
+        "Set-static-directory": (1, 0),
+        "Clear-static-directory": (1, 0),
+        "Set-sticky": (2, 0),
+        "Clear-sticky": (1, 0),
+        "Template": (2, 1),
+        "Clear-template": (1, 0),
+        "Notified": (1, 0),
+        "Set-checkin-prog": (1, 0),
+        "Set-update-prog": (1, 0),
+        "Mbinary": (1, 1),
+    }
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """ forgets everything, for a new connection """
+        # the data being parsed and how much of it was, and the data
+        # fed after it
+        self.data = b""
+        self.pos = 0
+        self.queue = deque()
+        # the beginning of a response whose lines go on in the next
+        # data, only ever the lines of one response
+        self.carry = b""
+        # bytes of the current body not returned yet, and whether its
+        # "end" is due
+        self.remaining = 0
+        self.bodyend = 0
+
+    def feed(self, data):
+        """ $data (bytes) is what came next from the server """
+        if self.pos < len(self.data):
+            # events not taken yet, $data waits for its turn
+            self.queue.append(data)
+        else:
+            self.data = data
+            self.pos = 0
+
+    def pending(self):
+        """ bytes fed and not parsed yet, plus the rest of the body
+        being received """
+        return len(self.data) - self.pos + sum(map(len, self.queue)) + \
+            len(self.carry) + self.remaining + self.bodyend
+
+    def inbody(self):
+        """ 1 if the events of a body are still to come """
+        return int(bool(self.remaining or self.bodyend))
+
+    def bodyleft(self):
+        """ bytes of the current body still to be received, 0 if
+        there is none or what was fed has to be parsed first. a
+        driver may read them itself and tell skip() how many it did
+        instead of feeding them. """
+        if self.pos < len(self.data) or self.queue:
+            return 0
+        return self.remaining
+
+    def skip(self, size):
+        """ $size bytes of the body were received past feed() """
+        self.remaining -= size
+        if not self.remaining:
+            self.bodyend = 1
+
+    def rewrite(self, function):
+        """ replaces what wasn't parsed yet by function(it), the
+        stream changed its encoding (Gzip-stream) from here on """
+        rest = [self.carry, self.data[self.pos:]] + list(self.queue)
+        self.data = function(b"".join(rest))
+        self.pos = 0
+        self.queue.clear()
+        self.carry = b""
+
+    def next(self):
+        """ the next event, None if there is none until more data is
+        fed """
+        while self.pos >= len(self.data) and self.queue:
+            self.data = self.queue.popleft()
+            self.pos = 0
+        data = self.data
+        pos = self.pos
+        if self.remaining:
+            n = min(self.remaining, len(data) - pos)
+            if not n:
+                return None
+            self.pos = pos + n
+            self.remaining -= n
+            if not self.remaining:
+                self.bodyend = 1
+            return ("body", memoryview(data)[pos:pos + n])
+
+        if self.bodyend:
+            self.bodyend = 0
+            return ("end", None)
+
+        if self.carry:
+            return self.nextcarried()
+
+        # the response line and its lines, all of them or nothing
+        end = data.find(b"\n", pos)
+        if end < 0:
+            return self.cut()
+        line = data[pos:end].decode(g_encoding, "surrogateescape")
+        name, sep, rest = line.partition(" ")
+
+        count = self.shapes.get(name, (0, 0))[0]
+        lines = []
+        for i in range(count):
+            start = end + 1
+            end = data.find(b"\n", start)
+            if end < 0:
+                return self.cut()
+            lines.append(data[start:end].decode(g_encoding,
+                                                "surrogateescape"))
+        self.pos = end + 1
+        return self.response(name, rest, lines)
+
+    def cut(self):
+        # the response goes on in the next data, what there is of it
+        # is kept aside
+        self.carry = self.data[self.pos:]
+        self.pos = len(self.data)
+        return self.next() if self.queue else None
+
+    def nextcarried(self):
+        # a response begun in earlier data: its lines are taken one by
+        # one from the data, which is left alone after them
+        data = self.data
+        while 1:
+            lines = self.carry.split(b"\n")[:-1]
+            if lines:
+                name = lines[0].decode(g_encoding, "surrogateescape")
+                count = self.shapes.get(name.partition(" ")[0], (0, 0))[0]
+                if len(lines) > count:
+                    break
+            end = data.find(b"\n", self.pos)
+            if end < 0:
+                self.carry += data[self.pos:]
+                self.pos = len(data)
+                return self.next() if self.queue else None
+            self.carry += data[self.pos:end + 1]
+            self.pos = end + 1
+
+        lines = [x.decode(g_encoding, "surrogateescape") for x in lines]
+        self.carry = b""
+        name, sep, rest = lines[0].partition(" ")
+        return self.response(name, rest, lines[1:])
+
+    def response(self, name, rest, lines):
+        # the "response" event of a response and its lines
+        hasbody = self.shapes.get(name, (0, 0))[1]
+        size = None
+        if hasbody:
+            try:
+                size = int(lines[-1].lstrip("z"))
+            except ValueError:
+                raise ProtocolException("bad size for %s: %s" %
+                                        (name, lines[-1]))
+            self.remaining = size
+            self.bodyend = 0 if size else 1
+        return ("response", name, rest, lines, size)
+
+    def parse(self, data):
+        """ feeds $data, returns the list of events it completed """
+        self.feed(data)
+        events = []
+        while 1:
+            event = self.next()
+            if event is None:
+                return events
+            events.append(event)
+
+
+class Cbody:
+    """
+    Class name: Cbody
+    Description:
+        gathers a response body of $size bytes in its own buffer and
+        calls done(data) with it once complete, inflated if $gzipped.
+        without done the body is dropped as it comes.
+
+    """
+    def __init__(self, size, gzipped=0, done=None):
+        self.data = bytearray(size) if done else None
+        self.got = 0
+        self.gzipped = gzipped
+        self.done = done
+
+    def write(self, chunk):
+        if self.data is not None:
+            n = len(chunk)
+            self.data[self.got:self.got + n] = chunk
+            self.got += n
+
+    def buffer(self):
+        """ where the rest of the body goes, for the network to
+        receive it in place, None if it is dropped """
+        if self.data is None:
+            return None
+        return memoryview(self.data)[self.got:]
+
+    def wrote(self, size):
+        # $size bytes were received straight into buffer()
+        self.got += size
+
+    def end(self):
+        if not self.done:
+            return
+        data = memoryview(self.data).toreadonly()
+        if self.gzipped:
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        self.done(data)
+
+    def abort(self):
+        """ the body won't come whole """
+        return
+
+
+class Csinkbody:
+    """
+    Class name: Csinkbody
+    Description:
+        writes the body of $cfile to $filesink (a Cfilesink) as it
+        comes, inflating it if $gzipped, and calls done($cfile) once
+        the sink closed it. the size of $cfile becomes what was
+        written, it is None until then if $gzipped.
+
+    """
+    def __init__(self, filesink, cfile, gzipped=0, done=None):
+        self.filesink = filesink
+        self.cfile = cfile
+        if gzipped:
+            cfile.size = None
+        self.fd = filesink.open(cfile)
+        self.inflater = gzipped and zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.written = 0
+        self.done = done
+
+    def write(self, chunk):
+        if self.inflater:
+            chunk = self.inflater.decompress(chunk)
+        self.fd.write(chunk)
+        self.written += len(chunk)
+
+    def buffer(self):
+        # the sink takes the body in chunks as they come
+        return None
+
+    def end(self):
+        if self.inflater:
+            data = self.inflater.flush()
+            self.fd.write(data)
+            self.written += len(data)
+        self.cfile.size = self.written
+        self.filesink.close(self.cfile, self.fd)
+        if self.done:
+            self.done(self.cfile)
+
+    def abort(self):
+        self.filesink.abort(self.cfile, self.fd)
+
+
+class Cprotocvs:
+    """
+    Class name: Cprotocvs
+    Description: takes care of the CVS protocol implementation.
+
+    """
+    # response name -> name of the method handling it, which gets the
+    # rest of the response line; the lines after it are in headerlines
+    # (see Cresponseparser.shapes), and for a response with a body it
+    # returns what takes the body (a Cbody). subclasses extend it with
+    # responses = dict(Cprotocvs.responses, **{"Name": "res_name"})
+    responses = {
+        "I": "res_i",
+        "ok": "res_ok",
+        "error": "res_error",
+        "Valid-requests": "res_validrequests",
+        "Checked-in": "res_checkedin",
+        "New-entry": "res_checkedin",
+        "Checksum": "res_checksum",
+        "Copy-file": "res_copyfile",
+        "Updated": "res_updated",
+        "Created": "res_updated",
+        "Update-existing": "res_updated",
+        "Merged": "res_updated",
+        "Patched": "res_patched",
+        "Rcs-diff": "res_patched",
+        "Mode": "res_mode",
+        "Mod-time": "res_modtime",
+        "Removed": "res_removed",
+        "Remove-entry": "res_removed",
+        "Set-static-directory": "res_dirinfo",
+        "Clear-static-directory": "res_dirinfo",
+        "Set-sticky": "res_setsticky",
+        "Clear-sticky": "res_dirinfo",
+        "Template": "res_template",
+        "Clear-template": "res_dirinfo",
+        "Notified": "res_dirinfo",
+        "Module-expansion": "res_moduleexpansion",
+        "Wrapper-rcsOption": "res_ignore",
+        "M": "res_m",
+        "Mbinary": "res_mbinary",
+        "E": "res_e",
+        "F": "res_ignore",
+        "MT": "res_mt",
+        "Set-checkin-prog": "res_setprog",
+        "Set-update-prog": "res_setprog",
+    }
+
+    # handled if they come, but we can't apply Patched diffs (patch
+    # program format) and "I" isn't a real response.
+    unadvertised = ("I", "Patched")
+
+    def __init__(self, adaptercallback, address, port, replycallback=None):
+        # our queue of outgoing Crequests, oldest first, and the
+        # queue of sent Crequests still waiting for their reply.
+        self.sendqueue = deque()
+        self.inflight = deque()
+
+        # create a network interface object
+        self.objnet = Cnetwork()
+
+        # store the adapter to use for notifying responses.
+        self.adapter = adaptercallback
+
+        # used mostly by synchronous server versions
+        self.replycallback = replycallback
+
+        self.set_loggedin(0)
+        self.set_authorized(0)
+        self.sent_authreq = 0
+        # a login request is waiting for its answer
+        self.loginpending = 0
+
+        self.address = address
+        self.port = port
+
+        # requests the server said it accepts, from Valid-requests
+        self.validrequests = set()
+
+        # zlib level to ask for once the server says it can (0 = off),
+        # and the request after whose reply the server compresses.
+        self.compression = 0
+        self.inflateafter = None
+
+        # where authenticated connections are kept between sessions
+        self.connpool = g_connpool
+        self.connkey = None
+
+        # the Crevcache to check out from, if any
+        self.revcache = None
+
+        # latency, files and sessions, see get_metrics()
+        self.metrics = Cmetrics()
+
+        # seconds a request may wait for its reply (or for more of it)
+        # before the connection is given up and the requests not
+        # replied are sent again on a new one, None waits forever.
+        # the wait before reconnecting doubles from backoff up to
+        # maxbackoff.
+        self.timeout = None
+        self.backoff = 0.5
+        self.maxbackoff = 30.0
+        # heap of (deadline, sequence, request) of the requests in flight
+        self.timers = []
+        self.timerseq = itertools.count()
+        # the requests sent since the last one expecting a reply, they
+        # are sent again with it
+        self.batch = []
+        # when to reconnect and resend, and the reconnections since
+        # the last reply
+        self.retryat = None
+        self.attempts = 0
+
+        self.workingpath = ""
+
+        # where the file bodies go. with no sink whole files are
+        # handed to the adapter, else they are streamed in chunks.
+        self.filesink = None
+        self.chunksize = 65536
+
+        # what the server sent, parsed into responses. the lines after
+        # the response being handled, and what takes its body.
+        self.parser = Cresponseparser()
+        self.headerlines = []
+        self.body = None
+        # the MT text of the line being tagged, see res_mt
+        self.mtline = ""
+
+        # the response being handled, and what Mode/Mod-time said
+        # about the next file.
+        self.response = ""
+        self.nextmode = ""
+        self.nextmodtime = None
+
+        # dictionary for encoding the authentication password
+        self.encoding = {'!': 120, '"': 53, '%': 109,
+                         '&': 72, "'": 108, '(': 70,
+                         ')': 64, '*': 76, '+': 67,
+                         ',': 116, '-': 74, '.': 68,
+                         '/': 87, ': ': 112, ';': 86,
+                         '<': 118, '=': 110, '>': 122,
+                         '?': 105, '_': 56,
+
+                         '0': 111, '1': 52, '2': 75,
+                         '3': 119, '4': 49, '5': 34,
+                         '6': 82, '7': 81, '8': 95,
+                         '9': 65,
+
+                         'A': 57, 'B': 83, 'C': 43,
+                         'D': 46, 'E': 102, 'F': 40,
+                         'G': 89, 'H': 38, 'I': 103,
+                         'J': 45, 'K': 50, 'L': 42,
+                         'M': 123, 'N': 91, 'O': 35,
+                         'P': 125, 'Q': 55, 'R': 54,
+                         'S': 66, 'T': 124, 'U': 126,
+                         'V': 59, 'W': 47, 'X': 92,
+                         'Y': 71, 'Z': 115,
+
+                         'a': 121, 'b': 117, 'c': 104,
+                         'd': 101, 'e': 100, 'f': 69,
+                         'g': 73, 'h': 99, 'i': 63,
+                         'j': 94, 'k': 93, 'l': 39,
+                         'm': 37, 'n': 61, 'o': 48,
+                         'p': 58, 'q': 113, 'r': 32,
+                         's': 90, 't': 44, 'u': 98,
+                         'v': 60, 'w': 51, 'x': 33,
+                         'y': 97, 'z': 62
+                         }
+
+    # cvs internal requests #######################################
+    def encodepassword(self, input):
+        """ used to encode the password the CVS way.
+        Note: Control characters, space, and characters outside
+        the invariant ISO 646 character set are ignored!.
+        """
+        output = "A"
 
         for ch in input:
             tmp = self.encoding.get(ch, [])
@@ -546,13 +2895,12 @@ class Cprotocvs:
             + self.encodedpassword + "\n" + \
             "END AUTH REQUEST" + "\n"
 
-        print("\n", authstring)
-
         try:
             self.objnet.send(authstring)
-            print("request authorization sent.")
+            g_logproto.debug("authorization request sent for %s@%s:%s",
+                             self.username, self.address, self.cvsroot)
         except NetworkException as x:
-            print(x)
+            g_lognet.error("authorization request: %s", x)
             return
 
     def req_login(self):
@@ -567,12 +2915,12 @@ class Cprotocvs:
             + self.encodedpassword + "\n" + \
             "END VERIFICATION REQUEST" + "\n"
 
-        print("\n", loginstring)
-
+        g_logproto.debug("verification request for %s@%s:%s",
+                         self.username, self.address, self.cvsroot)
         try:
             self.objnet.send(loginstring)
         except NetworkException as x:
-            print(x)
+            g_lognet.error("verification request: %s", x)
             return
 
     # more methods ##################################################
@@ -590,168 +2938,437 @@ class Cprotocvs:
 
         # add the request to the send list.
         self.sendqueue.append(requestobj)
-        print("request added to queue.")
 
         if not self.get_authorized() and not self.sent_authreq:
             # send an authorization request right now!.
-            print("sending an authorization request..")
             self.req_auth()
             self.sent_authreq = 1
 
     def processrequests(self):
-        # checks if we have pending requests to send
-
-        for req in self.sendqueue:
-            if not req.get_sent() and self.get_authorized():
-                """ we have an authorized request."""
-                print("sending an authorized request - ")
-                print(req.get_data())
-                self.objnet.send(req.get_data())
-                req.set_sent()
-
-    def timeoutrequests(self):
-        """ called for removing timed out or replied requests """
-        self.tempremoval = []
+        # enforces the deadlines, a timed out request goes again
+        # on a new connection once its backoff is over.
+        self.timeoutrequests()
+        if self.retryat is not None:
+            if time.monotonic() < self.retryat:
+                return
+            self.reconnect()
 
         # checks if we have pending requests to send
-        for req in self.sendqueue:
-            if req.get_sent() and req.get_replied():
-                """ we have a replied request """
-                self.tempremoval.append(req)
-
-        # remove requests. we dont remove items from the
-        # list during the for loop above because it screws things up
-        # this is why we have a new temporal removal list
-        for req in self.tempremoval:
-            self.sendqueue.remove(req)
-
-    def processresponse(self):
-        # called when there is data to read in the socket
-        cmd = rest = ""
-
-        # read the incoming command
-        try:
-            cmd = self.objnet.read_cmd()
-        except:
+        if not self.get_authorized():
             return
 
-        # read the rest of the response
-        try:
-            rest = self.objnet.read_nl()
-        except:
+        if not self.sendqueue:
             return
 
-        if cmd == "I":
-            if rest == "LOVE YOU":
-                if self.get_loggedin():
-                    """ authorization reply """
-                    self.res_auth(1)
-                    return
-                else:
-                    """ login successfull """
-                    self.res_login(1)
-                    return
-
-            elif rest == "HATE YOU":
-                if self.get_loggedin():
-                    """ authorization denied """
-                    self.res_auth(0)
-                    return
-                else:
-                    """ login failed """
-                    self.res_login(0)
-                    return
-            else:
-                raise ServerException("unknown answer during login: %s\n"
-                                      % (cmd + rest))
+        # every pending request goes out in a single write
+        while self.sendqueue:
+            """ we have an authorized request."""
+            req = self.sendqueue.popleft()
+            if g_logproto.isEnabledFor(logging.DEBUG):
+                # the first line only, Modified carries a file body
+                g_logproto.debug("request: %s",
+                                 firstline(req.get_data()))
+            self.objnet.write(req.get_data())
+            req.set_sent()
+            self.metrics.requests += 1
+            if self.timeout:
+                self.batch.append(req)
+
+            # requests without a reply are done once sent
+            if req.get_expectreply():
+                self.inflight.append(req)
+                if self.timeout:
+                    req.batch = self.batch
+                    self.batch = []
+                    # the clock of a pipelined request starts once the
+                    # replies before it are in, see extenddeadline()
+                    if len(self.inflight) == 1:
+                        self.startdeadline(req)
+            elif req.get_callback():
+                req.get_callback()(req, "sent")
+
+        if not self.objnet.corked:
+            self.objnet.flush()
 
-        elif cmd == "Valid-requests":
-            self.res_validrequests(rest)
+    def timeoutrequests(self):
+        """ called for enforcing the deadlines of the requests in
+        flight. replied requests leave the timer heap lazily, a
+        request whose reply is still coming has its deadline moved
+        on and goes back in. """
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, seq, req = heapq.heappop(self.timers)
+            if req.get_replied():
+                continue
+            if req.deadline > deadline:
+                heapq.heappush(self.timers, (req.deadline, seq, req))
+                continue
+
+            self.metrics.timeouts += 1
+            g_lognet.warning("%s:%s: no reply to %s in %ss",
+                             self.address, self.port, req.get_name(),
+                             self.timeout)
+            self.retryrequests()
+            return
 
-        elif cmd == "Updated":
-            self.res_updated(rest)
+    def startdeadline(self, req):
+        # $req is the oldest request in flight, its reply has to start
+        # within the timeout.
+        req.deadline = time.monotonic() + self.timeout
+        heapq.heappush(self.timers, (req.deadline, next(self.timerseq), req))
+
+    def extenddeadline(self):
+        # the reply of the oldest request in flight is coming, or the
+        # one before it is done: it gets its whole timeout again. only
+        # the oldest one runs against a deadline, the others wait for
+        # it however slowly its reply streams in.
+        if not self.timeout or not self.inflight:
+            return
+        req = self.inflight[0]
+        if req.deadline is None:
+            self.startdeadline(req)
         else:
-            print("UNKNOWN - cmd: %s - data: %s" % (cmd, rest))
-            raise ServerException("unknown response received.")
-
-        # read the status of the reply (ok or error)
+            req.deadline = time.monotonic() + self.timeout
+
+    def nexttimer(self):
+        """ seconds until the next deadline or reconnection, None if
+        there is nothing to wait for """
+        if self.retryat is not None:
+            return max(0.0, self.retryat - time.monotonic())
+        if self.timers:
+            return max(0.0, self.timers[0][0] - time.monotonic())
+        return None
+
+    def retryrequests(self):
+        """ gives up the connection and queues the requests not
+        replied yet to be sent again, with the ones sent before them,
+        on a new connection after a growing jittered delay. when one
+        of them isn't idempotent or is out of retries they all fail
+        with a "timeout" reply instead. """
+        requests = [x for req in self.inflight for x in req.batch]
+        requests += self.batch
+        requests += self.sendqueue
+        self.inflight.clear()
+        self.sendqueue.clear()
+        self.batch = []
+        self.timers = []
+        self.inflateafter = None
+        self.resetparser()
         try:
-            reply = self.objnet.read_nl()
-        except:
-            print("error reading reply")
+            self.objnet.close()
+        except NetworkException:
+            pass
+        self.set_authorized(0)
+        self.sent_authreq = 0
+
+        # a new connection sends its own session requests
+        resend = [x for x in requests
+                  if x.get_name() not in g_sessionrequests]
+        waiting = [x for x in requests if x.get_expectreply()]
+        if any(x.get_retries() <= 0 or x.get_name() not in g_idempotent
+               for x in waiting):
+            self.failrequests(waiting)
             return
 
-        if reply == "ok":
-            print("recibi un ok!! con rest", rest)
+        for req in waiting:
+            req.set_retries(req.get_retries() - 1)
+        for req in resend:
+            req.set_sent(0)
+            req.deadline = None
+            req.sinkerror = None
+            if req.get_output() is not None:
+                req.get_output().clear()
+        self.sendqueue.extend(resend)
+
+        delay = min(self.maxbackoff, self.backoff * 2 ** self.attempts)
+        delay *= random.uniform(0.5, 1.0)
+        self.attempts += 1
+        self.metrics.retries += 1
+        self.retryat = time.monotonic() + delay
+        g_lognet.info("%s:%s: sending %d requests again in %.3fs",
+                      self.address, self.port, len(resend), delay)
+
+    def connectionlost(self):
+        """ the connection is gone and nothing will send again what
+        it didn't reply: those requests fail. returns 1 if there
+        were any. """
+        if self.objnet.get_connected() or self.retryat is not None:
+            return 0
+        requests = [x for x in list(self.inflight) + list(self.sendqueue)
+                    if x.get_expectreply()]
+        self.inflight.clear()
+        self.sendqueue.clear()
+        self.batch = []
+        self.timers = []
+        self.resetparser()
+        if not requests:
+            return 0
+        self.failrequests(requests)
+        return 1
+
+    def failrequests(self, requests):
+        # $requests won't get a reply, tell whoever waits for one.
+        g_lognet.error("%s:%s: giving up on %d requests",
+                       self.address, self.port, len(requests))
+        self.retryat = None
+        self.attempts = 0
+        self.adapter(Cresponse("timeout", "%s:%s" % (self.address,
+                                                     self.port)))
+        for req in requests:
+            if req.get_callback():
+                req.get_callback()(req, "timeout")
             if self.replycallback:
-                self.replycallback(reply)
-
-            # set the oldest non replied request to replied.
-            for req in self.sendqueue:
-                if req.get_sent() and not req.get_replied():
-                    req.set_replied()
-                    print("setting request to replied.")
-                    print("req data is: ", req.get_data())
-                    break
-
-        elif reply == "error":
-            print("recibi un error!!")
-            self.replycallback(reply)
+                self.replycallback("timeout")
+
+    def reconnect(self):
+        # a new connection for the requests sent again. it negotiates
+        # the protocol and compression before they go.
+        self.retryat = None
+        pending = self.sendqueue
+        self.sendqueue = deque()
+        try:
+            self.do_connection()
+            if self.compression and self.validrequests:
+                self.startcompression()
+        except NetworkException:
+            self.sendqueue.extend(pending)
+            self.retryrequests()
+            return
+        self.sendqueue.extend(pending)
 
-        else:
-            print("unknown reply received!!!!: %s" % (reply))
+    def datareceived(self, data):
+        """ parses $data, what came next from the server, and handles
+        the responses it completes. """
+        if not data:
+            return
+        self.extenddeadline()
+        self.parser.feed(data)
+        self.handleevents()
+
+    def bodyreceived(self):
+        """ receives the rest of the body coming straight into the
+        buffer of its Cbody, with no copy, and handles what it
+        completes. returns 0 if it has to be fed to the parser. """
+        size = self.parser.bodyleft()
+        if not size or not self.body or self.objnet.decompressor:
+            return 0
+        view = self.body.buffer()
+        if view is None:
+            return 0
+        size = self.objnet.receive_into(view[:size])
+        self.extenddeadline()
+        self.body.wrote(size)
+        self.parser.skip(size)
+        self.handleevents()
+        return 1
+
+    def handleevents(self):
+        # handles the events the data fed completes
+        parser = self.parser
+        while 1:
+            event = parser.next()
+            if event is None:
+                return
+            kind = event[0]
+            try:
+                if kind == "body":
+                    self.body.write(event[1])
+                elif kind == "end":
+                    body = self.body
+                    self.body = None
+                    body.end()
+                else:
+                    self.processresponse(*event[1:])
+            except (SinkException, OSError) as x:
+                self.sinkfailed(x)
+
+    def sinkfailed(self, x):
+        # the file sink couldn't take a file (disk full..): the rest of
+        # its body is dropped and the request it came for fails.
+        g_logproto.error("file sink: %s", x)
+        if self.body:
+            try:
+                self.body.abort()
+            except (SinkException, OSError):
+                pass
+            self.body = None
+        if self.parser.inbody():
+            self.body = Cbody(0)
+        if self.inflight and not self.inflight[0].sinkerror:
+            self.inflight[0].sinkerror = str(x)
+        self.adapter(Cresponse("sinkerror", str(x)))
+
+    def processresponse(self, cmd, rest, lines, size=None):
+        # a response is a line made of the response name and its
+        # arguments, some responses (Updated) carry more lines after it
+        # and a body. "ok" and "error" are responses too, they end the
+        # reply to the request which asked for a reply.
+        handler = self.responses.get(cmd)
+        if not handler:
+            g_logproto.error("unknown response: %s %s", cmd, rest)
+            raise ServerException("unknown response received: %s" % cmd)
+
+        self.response = cmd
+        self.headerlines = lines
+        body = getattr(self, handler)(rest)
+        if size is not None:
+            self.body = body or Cbody(size)
+
+    def resetparser(self):
+        # a new connection, or none: a body half way is lost.
+        if self.body:
+            self.body.abort()
+            self.body = None
+        self.parser.reset()
+        self.mtline = ""
+
+    def addresponse(self, name, handler):
+        """ handles the response $name with the method $handler of
+        this object only, leaving the class table alone. """
+        if "responses" not in self.__dict__:
+            self.responses = dict(self.responses)
+        self.responses[name] = handler
 
     def cycle_check(self, timeout=0):
         # check if we have requests to send
         self.processrequests()
 
+        # nobody waits past the next deadline or reconnection
+        wait = self.nexttimer()
+        if wait is not None and (timeout < 0 or wait < timeout):
+            timeout = wait
+
         # we use a timeout of -1 for blocking server versions
         if timeout >= 0:
+            if self.retryat is not None:
+                # no connection until then
+                time.sleep(timeout)
+                return
             try:
                 # is socket ready? else raise an exception
                 self.objnet.socketready(timeout)
             except:
                 return
-        else:
-            print("blocking version..")
+        self.cycle_ready()
 
+    def cycle_ready(self):
+        # called when the socket is known to be ready to be read,
+        # handles what a single read brings.
         try:
-            # socket is ready to be read.
-            self.processresponse()
+            if not self.bodyreceived():
+                self.datareceived(self.objnet.receive())
 
-        except:
-            pass
+        except NetworkException:
+            g_logproto.debug("response not processed", exc_info=True)
+            # the connection broke, send again what it didn't reply
+            if self.timeout and not self.objnet.get_connected() and \
+               (self.inflight or self.batch):
+                self.retryrequests()
 
     def do_connection(self):
         # used to connect to a cvs server if not connected already
         if not self.address or not self.port:
             raise NetworkException
 
-        if not self.objnet.get_connected():
-            try:
-                self.objnet.connect(self.address, self.port)
-            except NetworkException as x:
-                print(x)
-                raise NetworkException
+        if self.objnet.get_connected():
+            return
+
+        """ logged in, an authenticated connection is as good as new """
+        if self.get_loggedin() and self.adoptconnection():
+            return
+
+        self.resetparser()
+        try:
+            self.objnet.connect(self.address, self.port)
+        except NetworkException as x:
+            g_lognet.error("connection to %s:%s failed: %s",
+                           self.address, self.port, x)
+            raise NetworkException
+
+        """ a new connection needs its own authorization and protocol
+        negotiation before any other request. """
+        self.set_authorized(0)
+        self.sent_authreq = 0
+        if self.get_loggedin():
+            self.metrics.newsession()
+            self.negotiate()
+
+    def adoptconnection(self):
+        # takes an authenticated connection from the pool, if any.
+        if not self.connpool or not self.connkey:
+            return 0
+
+        sock = self.connpool.acquire(self.connkey)
+        if not sock:
+            return 0
+
+        self.resetparser()
+        self.objnet.adopt(sock, self.address, self.port)
+        self.set_authorized(1)
+        self.sent_authreq = 1
+        self.metrics.newsession()
+        return 1
+
+    def negotiate(self):
+        # the first requests of every connection.
+        # send the Root request
+        self.req_root()
+
+        # send our accepted valid responses
+        self.req_validresponses()
+
+    def do_logout(self):
+        # gives our connection back to the pool if it is idle and
+        # authorized, else closes it.
+        if self.objnet.get_connected():
+            # a compressed stream can't be picked up by someone else
+            if self.connpool and self.connkey and self.get_authorized() \
+               and not self.objnet.compressor \
+               and not self.sendqueue and not self.inflight \
+               and not self.parser.pending() and not self.objnet.wbuf:
+                self.connpool.release(self.connkey, self.objnet.detach())
+            else:
+                try:
+                    self.objnet.close()
+                except NetworkException:
+                    pass
+
+        self.set_loggedin(0)
+        self.set_authorized(0)
+        self.sent_authreq = 0
 
     def do_login(self, *args):
         # takes care of connecting and sending a login request
         self.username = args[1]
         self.password = args[2]
         self.cvsroot = self.workingpath = args[0]
+        """ the password is part of the key: a pooled connection was
+        authorized for its own credentials, not for anyone's with the
+        same name """
+        self.connkey = (self.address, self.port, self.cvsroot, self.username,
+                        self.encodepassword(self.password))
+
+        """ a pooled connection is already logged in and authorized,
+        we only ask again for the server's valid requests """
+        if not self.objnet.get_connected() and self.adoptconnection():
+            self.set_loggedin(1)
+            self.req_validrequests()
+            self.adapter(Cresponse("loginok"))
+            return
 
         """ connect to the given server to initiate login """
         try:
             self.do_connection()
         except NetworkException as x:
-            print(x)
+            g_lognet.error("login: %s", x)
             return
 
         """ connection ok, send a login request """
+        self.loginpending = 1
         try:
             self.req_login()
         except ProtocolException as x:
-            print(x)
+            g_logproto.error("login: %s", x)
             return
 
     def do_sessioncheck(self):
@@ -774,20 +3391,163 @@ class Cprotocvs:
         self.req_argument("-N")
         self.req_argument(".")
         self.req_directory(".")
-        self.req_co()
+        self.req_co()
+
+    def do_checkout(self, *args):
+        # args are the module name and any extra co options.
+        modulename = args[0]
+        for option in args[1:]:
+            self.req_argument(option)
+        self.req_argument("-N")
+        self.req_argument(modulename)
+        self.req_directory(".")
+        self.req_co()
+
+    def do_update(self, localdir, *options):
+        # sends what we have below $localdir, as told by the CVS
+        # administrative files, and asks for what changed. only
+        # modified files are uploaded, unchanged ones are just named.
+        self.updatedirs(localdir, localdir, options)
+
+    def do_updatemodule(self, localdir, modulename, *options):
+        # like do_update, for the checkout of $modulename below
+        # $localdir only. new directories are created.
+        self.updatedirs(localdir, os.path.join(localdir, modulename),
+                        ("-d",) + options)
+
+    def updatedirs(self, localdir, top, options):
+        # the update of the working directories from $top down, their
+        # names relative to $localdir.
+        for option in options:
+            self.req_argument(option)
+
+        toplevel = []
+        for dirpath, dirnames, filenames in os.walk(top):
+            entries = Centries(dirpath)
+            if not entries.exists():
+                # not a working directory, nor anything below it,
+                # unless it is the top where modules were checked out
+                if dirpath != top:
+                    dirnames[:] = []
+                continue
+            if "CVS" in dirnames:
+                dirnames.remove("CVS")
+
+            relpath = os.path.relpath(dirpath, localdir).replace(os.sep, "/")
+            if os.path.dirname(relpath) == "":
+                toplevel.append(relpath)
+
+            # fold what the last run appended to Entries.Log
+            entries.load()
+            if os.path.exists(os.path.join(entries.admdir, "Entries.Log")):
+                entries.save()
+            self.req_directory(relpath, entries.get_repository(self.cvsroot))
+            for name in sorted(entries.files):
+                self.req_entry(entries.files[name])
+                state = entries.filestate(name)
+                if state == "unchanged":
+                    self.req_unchanged(name)
+                elif state == "modified":
+                    path = os.path.join(dirpath, name)
+                    with open(path, "rb") as fd:
+                        data = fd.read()
+                    mode = os.stat(path).st_mode
+                    self.req_modified(name, unparsemode(mode), data)
+
+        # a working directory updates itself, else we name the
+        # working directories found right below it.
+        if "." not in toplevel:
+            for name in toplevel:
+                self.req_argument(name)
+            self.req_directory(".")
+        else:
+            self.req_directory(".", Centries(localdir).get_repository(
+                self.cvsroot))
+        self.req_update()
+
+    def do_listdir(self, modulename, callback):
+        # lists the subdirectories of $modulename with rlist.
+        # callback(names) gets them, or None if the listing failed.
+        self.req_argument("-e")
+        self.req_argument(modulename)
+        self.req_directory(".")
+        self.req_rlist(Clistdir(callback).done)
+
+    def do_rlog(self, modulename, history, *options):
+        # loads the log of $modulename into $history (a Chistory),
+        # file by file as the reply comes. $options are rlog's.
+        for option in options:
+            self.req_argument(option)
+        self.req_argument(modulename)
+        self.req_directory(".")
+        self.req_rlog(Crlogparser(self.cvsroot, history.add), history.done)
+
+    def do_rdiff(self, modulename, fromtag, totag, sync):
+        # the unified diff of $modulename between two tags, applied
+        # by $sync (a Csynctag) file by file as the reply comes.
+        self.req_argument("-u")
+        self.req_argument("-r" + fromtag)
+        self.req_argument("-r" + totag)
+        self.req_argument(modulename)
+        self.req_directory(".")
+        self.req_rdiff(sync.parser, sync.diffdone)
+
+    def do_listentries(self, path, callback, *options):
+        # lists the directory $path with rlist -e, the M lines of the
+        # reply in the output of the request given to callback(request,
+        # reply). $options are rlist's (-r tag..).
+        for option in options:
+            self.req_argument(option)
+        self.req_argument("-e")
+        self.req_argument(path)
+        self.req_directory(".")
+        self.req_rlist(callback)
+
+    def do_printfile(self, path, output, callback, *options):
+        # the contents of the file $path, printed by co -p: the
+        # Mbinary body (or the M lines of servers without Mbinary)
+        # go to $output.append(). $options are co's (-r tag..).
+        self.req_argument("-p")
+        for option in options:
+            self.req_argument(option)
+        self.req_argument(path)
+        self.req_directory(".")
+        self.req_co(callback, output)
 
-    def do_checkout(self, *args):
-        modulename = args[0]
+    def do_export(self, modulename, *options):
+        # like do_checkout, the files come with no CVS administrative
+        # files in mind. cvs wants a -r tag or -D date in $options.
+        for option in options:
+            self.req_argument(option)
         self.req_argument("-N")
         self.req_argument(modulename)
         self.req_directory(".")
-        self.req_co()
+        self.req_export()
+
+    def do_fetch(self, paths, options=(), callback=None):
+        # checks out the files (repository paths) $paths, with the
+        # co $options, in one request. callback(request, reply) is
+        # called once it is replied.
+        for option in options:
+            self.req_argument(option)
+        for path in paths:
+            self.req_argument(path)
+        self.req_directory(".")
+        self.req_co(callback)
 
     # cvs requests ################################################
 
     def req_validresponses(self):
         # tell the server which responses we accept
-        return
+        # response expected?: no
+        names = [x for x in self.responses if x not in self.unadvertised]
+        myreq = "Valid-responses " + " ".join(names) + "\n"
+
+        try:
+            self.sendrequest(Crequest(myreq))
+        except ProtocolException as x:
+            g_logproto.error("%s", x)
+            return
 
     def req_validrequests(self):
         # ask the server to send back what requests it accepts.
@@ -795,9 +3555,9 @@ class Cprotocvs:
         myreq = "valid-requests " + "\n"
 
         try:
-            self.sendrequest(Crequest(myreq))
+            self.sendrequest(Crequest(myreq, 1))
         except ProtocolException as x:
-            print(x)
+            g_logproto.error("%s", x)
             return
 
     def req_root(self):
@@ -809,21 +3569,69 @@ class Cprotocvs:
         try:
             self.sendrequest(Crequest(myreq))
         except ProtocolException as x:
-            print(x)
+            g_logproto.error("%s", x)
             return
 
-    def req_directory(self, workingdirectory):
+    def req_directory(self, workingdirectory, repository=None):
         # tell the server what base directory to use.
         # we send the directory name and then attach the base path.
         # (the base directory is relative to the attached base path)
         # response expected?: no
+        if repository is None:
+            repository = self.workingpath
         myreq = "Directory " + workingdirectory + "\n" + \
-            self.workingpath + "\n"
+            repository + "\n"
+
+        try:
+            self.sendrequest(Crequest(myreq))
+        except ProtocolException as x:
+            g_logproto.error("%s", x)
+            return
+
+    def req_entry(self, entryline):
+        # tell the server the version of a file we have, as written
+        # in CVS/Entries. refers to the last Directory.
+        # response expected?: no
+        myreq = "Entry " + entryline + "\n"
+        try:
+            self.sendrequest(Crequest(myreq))
+        except ProtocolException as x:
+            g_logproto.error("%s", x)
+            return
 
+    def req_unchanged(self, filename):
+        # the file of the last Entry wasn't modified locally.
+        # response expected?: no
+        myreq = "Unchanged " + filename + "\n"
+        try:
+            self.sendrequest(Crequest(myreq))
+        except ProtocolException as x:
+            g_logproto.error("%s", x)
+            return
+
+    def req_modified(self, filename, mode, data):
+        # the file of the last Entry was modified locally, we send
+        # its contents.
+        # response expected?: no
+        header = "Modified " + filename + "\n" + mode + "\n" + \
+            "%d" % len(data) + "\n"
+        myreq = header.encode(g_encoding, "surrogateescape") + bytes(data)
         try:
             self.sendrequest(Crequest(myreq))
         except ProtocolException as x:
-            print(x)
+            g_logproto.error("%s", x)
+            return
+
+    def req_update(self):
+        # bring the working directories described by Directory/Entry
+        # up to date.
+        # (arguments-command) arguments taken: options, files
+        # response expected?: yes
+        myreq = "update " + "\n"
+        try:
+            self.sendrequest(Crequest(myreq, 1))
+        except ProtocolException as x:
+            g_logproto.error("%s", x)
             return
 
     def req_useunchanged(self):
@@ -834,7 +3642,7 @@ class Cprotocvs:
         try:
             self.sendrequest(Crequest(myreq))
         except ProtocolException as x:
-            print(x)
+            g_logproto.error("%s", x)
             return
 
     def req_argument(self, arg):
@@ -845,7 +3653,7 @@ class Cprotocvs:
         try:
             self.sendrequest(Crequest(myreq))
         except ProtocolException as x:
-            print(x)
+            g_logproto.error("%s", x)
             return
 
     def req_argumentx(self, arg):
@@ -857,7 +3665,7 @@ class Cprotocvs:
         try:
             self.sendrequest(Crequest(myreq))
         except ProtocolException as x:
-            print(x)
+            g_logproto.error("%s", x)
             return
 
     def req_set(self, variable, value):
@@ -867,7 +3675,7 @@ class Cprotocvs:
         try:
             self.sendrequest(Crequest(myreq))
         except ProtocolException as x:
-            print(x)
+            g_logproto.error("%s", x)
             return
 
     def req_expandmodules(self):
@@ -877,20 +3685,79 @@ class Cprotocvs:
         # response expected?: yes
         myreq = "expand-modules " + "\n"
         try:
-            self.sendrequest(Crequest(myreq))
+            self.sendrequest(Crequest(myreq, 1))
         except ProtocolException as x:
-            print(x)
+            g_logproto.error("%s", x)
             return
 
-    def req_co(self):
-        # get files from the repository.
+    def req_co(self, callback=None, output=None):
+        # get files from the repository. with co -p the files are
+        # printed, and given to $output.append() (see Crequest).
         # (arguments-command) arguments taken: module names
         # response expected?: yes
         myreq = "co " + "\n"
+        try:
+            self.sendrequest(Crequest(myreq, 1, callback, output=output))
+        except ProtocolException as x:
+            g_logproto.error("%s", x)
+            return
+
+    def req_rlist(self, callback=None):
+        # list files in the repository, like ls. with -e the output
+        # is in CVS/Entries format (D/name//// for directories).
+        # (arguments-command) arguments taken: module or path names
+        # response expected?: yes
+        myreq = "rlist " + "\n"
+        try:
+            self.sendrequest(Crequest(myreq, 1, callback, 1))
+        except ProtocolException as x:
+            g_logproto.error("%s", x)
+            return
+
+    def req_rlog(self, output, callback=None):
+        # the revision history of files in the repository. the text
+        # of the reply is given to $output.append() a line at a time.
+        # (arguments-command) arguments taken: options, module or
+        # path names
+        # response expected?: yes
+        myreq = "rlog " + "\n"
+        try:
+            self.sendrequest(Crequest(myreq, 1, callback, output=output))
+        except ProtocolException as x:
+            g_logproto.error("%s", x)
+            return
+
+    def req_rdiff(self, output, callback=None):
+        # the differences between two releases, as a patch. the text
+        # of the reply is given to $output.append() a line at a time.
+        # (arguments-command) arguments taken: options, module or
+        # path names
+        # response expected?: yes
+        myreq = "rdiff " + "\n"
+        try:
+            self.sendrequest(Crequest(myreq, 1, callback, output=output))
+        except ProtocolException as x:
+            g_logproto.error("%s", x)
+            return
+
+    def req_gzipstream(self, level):
+        # everything after this request is zlib compressed, both ways.
+        # response expected?: no
+        myreq = "Gzip-stream %d" % level + "\n"
+        try:
+            self.sendrequest(Crequest(myreq, 0, self.gzipstarted))
+        except ProtocolException as x:
+            g_logproto.error("%s", x)
+            return
+
+    def req_gzipfilecontents(self, level):
+        # file bodies are sent gzipped, with their size prefixed by z.
+        # response expected?: no
+        myreq = "gzip-file-contents %d" % level + "\n"
         try:
             self.sendrequest(Crequest(myreq))
         except ProtocolException as x:
-            print(x)
+            g_logproto.error("%s", x)
             return
 
     def req_export(self):
@@ -900,27 +3767,27 @@ class Cprotocvs:
         # response expected?: yes
         myreq = "export " + "\n"
         try:
-            self.sendrequest(Crequest(myreq))
+            self.sendrequest(Crequest(myreq, 1))
         except ProtocolException as x:
-            print(x)
+            g_logproto.error("%s", x)
             return
 
     # cvs responses ################################################
 
     def res_auth(self, authorized):
         # set ourselves as authorized for sending requests.
-        print("authorization response received")
-
         if not self.get_authorized():
             if not authorized:
-                print("authorization request DENIED")
+                g_logproto.warning("authorization request DENIED")
             else:
-                print("authorization request GRANTED")
+                g_logproto.debug("authorization request GRANTED")
                 self.set_authorized(1)
         else:
-            print("res_auth: received double authorization!")
+            g_logproto.warning("res_auth: received double authorization!")
 
     def res_login(self, reply):
+        self.loginpending = 0
+
         # close the connection to the server. we are authenticated.
         try:
             self.objnet.close()
@@ -930,13 +3797,8 @@ class Cprotocvs:
         if reply == 1:
             self.set_loggedin(1)
 
-            # finish the protocol negotiation..
-
-            # send the Root request
-            self.req_root()
-
-            # send our accepted valid responses
-            # self.req_validresponses()
+            # finish the protocol negotiation.. the first request
+            # connects again and sends Root and Valid-responses.
 
             # ask for the server's valid requests
             self.req_validrequests()
@@ -949,37 +3811,288 @@ class Cprotocvs:
             self.set_loggedin(0)
             self.adapter(Cresponse("loginfail"))
 
+    def res_ok(self, rest=""):
+        # the oldest request waiting for a reply completed successfully.
+        if self.inflight and self.inflight[0].sinkerror:
+            # not all of it made it to the file sink
+            self.res_error("file sink: %s" % self.inflight[0].sinkerror)
+            return
+        if self.replycallback:
+            self.replycallback("ok")
+
+        # the oldest request in flight is the one replied.
+        if self.inflight:
+            req = self.inflight.popleft()
+            req.set_replied()
+            self.attempts = 0
+            self.extenddeadline()
+            self.metrics.replied(req, 1)
+            if g_logproto.isEnabledFor(logging.DEBUG):
+                g_logproto.debug("ok: %s", firstline(req.get_data()))
+            self.checkinflate(req)
+            if req.get_callback():
+                req.get_callback()(req, "ok")
+
+    def res_error(self, message):
+        # the oldest request waiting for a reply failed.
+        g_logproto.info("error: %s", message)
+        if self.inflight:
+            req = self.inflight.popleft()
+            req.set_replied()
+            self.attempts = 0
+            self.extenddeadline()
+            self.metrics.replied(req, 0)
+            self.checkinflate(req)
+            if req.get_callback():
+                req.get_callback()(req, "error")
+        if self.replycallback:
+            self.replycallback("error")
+
     def res_validrequests(self, requestlist):
         # what requests the server is willing to accept.
-        print("the server is willing to accept the "
-              "following requests:\n%s" % (requestlist))
+        g_logproto.debug("valid requests: %s", requestlist)
+        self.validrequests = set(requestlist.split())
+        if self.compression:
+            self.startcompression()
+
+    def startcompression(self):
+        # asks for compression, the whole stream if the server can,
+        # else at least the file bodies.
+        if self.objnet.compressor:
+            return
+        if "Gzip-stream" in self.validrequests:
+            self.req_gzipstream(self.compression)
+        elif "gzip-file-contents" in self.validrequests:
+            self.req_gzipfilecontents(self.compression)
+
+    def gzipstarted(self, request, reply):
+        # Gzip-stream is out: we compress what follows, the server
+        # compresses its responses to whatever comes after the
+        # requests already waiting for a reply.
+        self.objnet.set_compression(self.compression)
+        if self.inflight:
+            self.inflateafter = self.inflight[-1]
+        else:
+            self.startinflate()
+
+    def checkinflate(self, request):
+        # called as $request is replied
+        if request is self.inflateafter:
+            self.inflateafter = None
+            self.startinflate()
+
+    def startinflate(self):
+        # what follows, including what was received and not parsed
+        # yet, is compressed.
+        self.objnet.set_decompression()
+        self.parser.rewrite(self.objnet.inflate)
+
+    def res_i(self, rest):
+        # "I LOVE YOU" or "I HATE YOU", the answer to a login
+        # (verification) or to an authorization request.
+        if rest == "LOVE YOU":
+            if self.get_loggedin():
+                """ authorization reply """
+                self.res_auth(1)
+            else:
+                """ login successfull """
+                self.res_login(1)
+
+        elif rest == "HATE YOU":
+            if self.get_loggedin():
+                """ authorization denied """
+                self.res_auth(0)
+            else:
+                """ login failed """
+                self.res_login(0)
+        else:
+            raise ServerException("unknown answer during login: I %s\n"
+                                  % (rest))
 
     def res_updated(self, pathname):
         # update the local client-side copy of the received files
-        # with this new lastest revision.
-        fullpath = self.objnet.read_nl()
-        newentries = self.objnet.read_nl()
-        mode = self.objnet.read_nl()
-        filesize = self.objnet.read_nl()
-
-        # read the whole incoming file data
-        filedata = ""
-        toread = int(filesize)
-        while toread:
-            try:
-                tmp = self.objnet.read(toread)
-                toread -= len(tmp)
-                filedata += tmp
-            except:
-                pass
-
+        # with this new lastest revision. Created, Update-existing
+        # and Merged come the same way.
+        fullpath, newentries, mode, filesize = self.headerlines
+
+        # a z before the size means a gzipped body of that size
+        gzipped = filesize.startswith("z")
+        size = int(filesize.lstrip("z"))
+        cfile = self.newfile(fullpath, newentries, mode, size, None,
+                             pathname)
+        if self.filesink:
+            # stream the file to the sink as it comes
+            return Csinkbody(self.filesink, cfile, gzipped,
+                             self.fileupdated)
+
+        # else it is read whole into its own buffer
+        def done(data):
+            cfile.data = data
+            cfile.size = len(data)
+            self.fileupdated(cfile)
+        return Cbody(size, gzipped, done)
+
+    def fileupdated(self, cfile):
         # send the incoming file to the adapter
-        self.adapter(Cresponse("updatedfile",
-                               Cfile(fullpath, newentries, mode,
-                                     filesize, filedata)))
+        self.metrics.received(cfile.get_size())
+        self.adapter(Cresponse("updatedfile", cfile))
+
+    def res_patched(self, pathname):
+        # like Updated, but the body is a diff against the file we have.
+        fullpath, newentries, mode, filesize = self.headerlines
+        cfile = self.newfile(fullpath, newentries, mode, 0, None, pathname)
+
+        def done(data):
+            cfile.data = data
+            cfile.size = len(data)
+            if self.filesink and cfile.get_response() == "Rcs-diff":
+                self.filesink.patch(cfile)
+            self.metrics.received(cfile.get_size())
+            self.adapter(Cresponse("patchedfile", cfile))
+        return Cbody(int(filesize.lstrip("z")), filesize.startswith("z"),
+                     done)
+
+    def res_checkedin(self, pathname):
+        # Checked-in and New-entry: a new entries line, no file body.
+        fullpath, newentries = self.headerlines
+
+        cfile = self.newfile(fullpath, newentries, self.nextmode, 0, None,
+                             pathname)
+        if self.filesink:
+            self.filesink.newentry(cfile)
+        self.adapter(Cresponse("newentry", cfile))
+
+    def res_removed(self, pathname):
+        # Removed (remove the file too) and Remove-entry (only
+        # the entry), the file name is the last part of fullpath.
+        fullpath, = self.headerlines
+
+        cfile = self.newfile(fullpath, "", "", 0, None, pathname)
+        if self.filesink:
+            self.filesink.remove(cfile)
+        self.adapter(Cresponse("removedfile", cfile))
+
+    def res_copyfile(self, pathname):
+        # the client should copy the file before it is updated. we
+        # don't merge locally, nothing to keep.
+        return
+
+    def res_dirinfo(self, pathname):
+        # Set/Clear-static-directory, Clear-sticky, Clear-template and
+        # Notified: the local directory and its repository path.
+        fullpath, = self.headerlines
+        if self.filesink:
+            self.filesink.dirinfo(self.response, pathname, fullpath, "")
+        self.adapter(Cresponse("dirinfo",
+                               (self.response, pathname, fullpath, "")))
+
+    def res_setsticky(self, pathname):
+        fullpath, tagspec = self.headerlines
+        if self.filesink:
+            self.filesink.dirinfo(self.response, pathname, fullpath, tagspec)
+        self.adapter(Cresponse("dirinfo",
+                               (self.response, pathname, fullpath, tagspec)))
+
+    def res_template(self, pathname):
+        # a template for commit messages, dropped as it comes.
+        return
+
+    def res_setprog(self, dirname):
+        # Set-checkin-prog / Set-update-prog, the program name follows.
+        return
+
+    def res_mode(self, mode):
+        # the mode of the next file mentioned in Checked-in.
+        self.nextmode = mode
+
+    def res_modtime(self, modtime):
+        # the modification time of the next file received.
+        self.nextmodtime = parsecvsdate(modtime)
+
+    def res_checksum(self, checksum):
+        # the checksum of the next file, we trust TCP.
+        return
+
+    def res_moduleexpansion(self, pathname):
+        self.adapter(Cresponse("moduleexpansion", pathname))
+
+    def res_m(self, text):
+        # the text goes to the request being replied if it asked for it
+        if self.inflight and self.inflight[0].get_output() is not None:
+            self.inflight[0].get_output().append(text)
+            return
+        self.adapter(Cresponse("message", text))
+
+    def res_e(self, text):
+        self.adapter(Cresponse("errormessage", text))
+
+    def res_mt(self, rest):
+        # tagged text: "MT tagname data" or "MT +tag" / "MT -tag".
+        tag, sep, data = rest.partition(" ")
+        if self.inflight and self.inflight[0].get_output() is not None:
+            # a request collecting text gets it as lines, like M
+            if tag == "newline":
+                self.inflight[0].get_output().append(self.mtline)
+                self.mtline = ""
+            elif tag[:1] not in ("+", "-"):
+                self.mtline += data
+            return
+        self.adapter(Cresponse("taggedmessage", (tag, data)))
+
+    def res_mbinary(self, rest):
+        request = self.inflight[0] if self.inflight else None
+
+        def done(data):
+            if request and request.get_output() is not None:
+                request.get_output().append(bytes(data))
+                return
+            self.adapter(Cresponse("binarymessage", data))
+        return Cbody(int(self.headerlines[0]), 0, done)
+
+    def res_ignore(self, rest):
+        # responses we accept but have no use for.
+        return
+
+    def newfile(self, fullpath, entries, mode, size, data, pathname):
+        # builds a Cfile, consuming what Mod-time said about it.
+        cfile = Cfile(fullpath, entries, mode, size, data, pathname,
+                      self.response, self.nextmodtime)
+        self.nextmodtime = None
+        return cfile
 
     # properties ################################################
 
+    def set_filesink(self, filesink, chunksize=65536):
+        # the sink is written what each read brings, up to $chunksize
+        self.filesink = filesink
+        self.chunksize = chunksize
+        self.objnet.bufsize = chunksize
+
+    def get_filesink(self):
+        return self.filesink
+
+    def get_rootspec(self):
+        # our CVSROOT, as written in CVS/Root
+        if self.port == 2401:
+            return ":pserver:%s@%s:%s" % (self.username, self.address,
+                                          self.cvsroot)
+        return ":pserver:%s@%s:%d%s" % (self.username, self.address,
+                                        self.port, self.cvsroot)
+
+    def get_metrics(self):
+        # snapshot of our Cmetrics, the traffic of our socket and
+        # the depth of our queues.
+        stats = self.metrics.snapshot()
+        stats.update({
+            "bytes_in": self.objnet.bytesin,
+            "bytes_out": self.objnet.bytesout,
+            "socket_wait_s": round(self.objnet.waittime, 6),
+            "connects": self.objnet.connects,
+            "sendqueue": len(self.sendqueue),
+            "inflight": len(self.inflight),
+        })
+        return stats
+
     def get_authorized(self):
         return self.authorized
 
@@ -1017,23 +4130,44 @@ class Cservercvs:
         self.objprotocvs = Cprotocvs(self.hprotocolin, address,
                                      port, replycallback)
 
+        # the sessions of our last parallel checkout, for get_metrics()
+        self.workers = []
+
         self.exiting = 0
 
     def addevent(self, eventname, handler, priority=0):
         """ wrapper for addeventhook in the dispatcher object """
-        self.objdispa.addeventhook(eventname, handler, priority)
+        return self.objdispa.addeventhook(eventname, handler, priority)
+
+    def removeevent(self, eventname, handler):
+        """ wrapper for removeeventhook in the dispatcher object """
+        return self.objdispa.removeeventhook(eventname, handler)
 
     def throwevent(self, eventname, data):
         """ wrapper for calleventhook in the dispatcher object """
-        print("triggering event name: %s" % eventname)
-        self.objdispa.calleventhook(Cevent(eventname, data, self))
+        start = time.perf_counter()
+        try:
+            self.objdispa.calleventhook(Cevent(eventname, data, self))
+        finally:
+            self.objprotocvs.metrics.handlertime += \
+                time.perf_counter() - start
+
+    def set_executor(self, executor, maxqueue=256, events=None, ordered=1):
+        """ wrapper for set_executor in the dispatcher object """
+        self.objdispa.set_executor(executor, maxqueue, events, ordered)
+
+    def drain(self):
+        """ waits for the handlers of the events thrown so far """
+        self.objdispa.drain()
 
     """ ADAPTER IN - called by the protocol obj """
     def hprotocolin(self, response):
         """ receives a response from the protocol obj and throws
         the respective events. """
 
-        print(response.get_name(), response.get_data())
+        if g_logevents.isEnabledFor(logging.DEBUG):
+            g_logevents.debug("%s: %s", response.get_name(),
+                              describe(response.get_data()))
         # in our library implementation, we use the response names
         # as the same names of the events we trigger.
         self.throwevent(response.get_name(), response.get_data())
@@ -1047,6 +4181,33 @@ class Cservercvs:
         """ add here any other methods to call """
         self.objprotocvs.cycle_check(timeout)
 
+    def checkio_send(self):
+        """ sends the pending requests without waiting for replies """
+        self.objprotocvs.processrequests()
+
+    def checkio_ready(self):
+        """ reads a response, our socket must be ready to be read """
+        self.objprotocvs.cycle_ready()
+
+    def cork(self):
+        """ holds back the requests sent from now on until uncork(),
+        so several operations go out in one write. """
+        self.objprotocvs.objnet.cork()
+
+    def uncork(self):
+        """ sends everything held back since cork() """
+        self.objprotocvs.objnet.uncork()
+
+    def flush(self):
+        """ sends everything held back, even if corked """
+        self.objprotocvs.processrequests()
+        self.objprotocvs.objnet.flush()
+
+    def set_selector(self, selector):
+        """ registers our socket in $selector, with ourselves as data,
+        so a multiplexer can find who is ready. """
+        self.objprotocvs.objnet.set_selector(selector, self)
+
     def checkio_loop(self, timeout=0.2):
         """ block looping inside checkio with a sleeping timeout.  """
         while 1 and not self.exiting:
@@ -1063,16 +4224,905 @@ class Cservercvs:
         return self.hprotocolout("do_login", cvsroot, username, password)
 
     def logout(self):
-        return
-
-    def checkout(self, modulename):
+        """ ends the session, keeping the connection in the pool
+        for the next login with the same credentials if possible """
+        self.objprotocvs.do_logout()
+
+    def set_timeout(self, timeout, backoff=0.5, maxbackoff=30.0):
+        """ gives every request $timeout seconds for its reply to
+        start once the replies before it are in, and for each part of
+        it to follow; connecting and each read get as long. a request
+        out of time has the connection closed and, if idempotent, is
+        sent again (up to its retries) with the requests before it on
+        a new connection, after a random delay doubling from $backoff
+        up to $maxbackoff. None waits forever. """
+        proto = self.objprotocvs
+        proto.timeout = timeout
+        proto.backoff = backoff
+        proto.maxbackoff = maxbackoff
+        proto.objnet.set_timeout(timeout)
+
+    def set_compression(self, level=6):
+        """ asks the server to compress its traffic with zlib $level
+        (1-9, 0 turns it off for the next connections) """
+        proto = self.objprotocvs
+        proto.compression = level
+        if level and proto.get_loggedin() and proto.validrequests:
+            proto.startcompression()
+
+    def set_connpool(self, connpool):
+        """ the Cconnpool to reuse connections from, None to always
+        open new ones """
+        self.objprotocvs.connpool = connpool
+
+    def get_metrics(self):
+        """ a dict of what this server did so far: request latency
+        per request name, bytes, files, errors, reconnects, seconds
+        waiting for the socket and running handlers, queue depths.
+        the handler time of offloaded events is the time spent
+        queueing them. """
+        stats = self.objprotocvs.get_metrics()
+        stats["server"] = "%s:%s" % (self.objprotocvs.address,
+                                     self.objprotocvs.port)
+        stats["eventqueue"] = self.objdispa.queued
+        if self.workers:
+            stats["workers"] = [x.get_metrics() for x in self.workers]
+        return stats
+
+    def set_revcache(self, revcache):
+        """ keeps the revisions written by our Cdirsinks in $revcache
+        (a Crevcache) and checks out from it when it can """
+        proto = self.objprotocvs
+        proto.revcache = revcache
+        if isinstance(proto.filesink, Cdirsink):
+            proto.filesink.revcache = revcache
+
+    def checkout(self, modulename, *options):
+        """ checks out $modulename, $options being co's (-r tag..).
+        with a revcache and a Cdirsink, and no options, the files the
+        cache holds are laid out first and only what changed since is
+        asked for, with an update. """
+        proto = self.objprotocvs
+        sink = proto.filesink
+        if options:
+            return self.hprotocolout("do_checkout", modulename, *options)
+        if isinstance(sink, Cdirsink) and sink.admin and sink.revcache:
+            if not sink.cvsroot:
+                sink.cvsroot = proto.get_rootspec()
+            basedir = proto.cvsroot.rstrip("/")
+            if Centries(os.path.join(sink.destdir, modulename)).exists() \
+               or sink.materialize(basedir, basedir + "/" + modulename):
+                return self.hprotocolout("do_updatemodule", sink.destdir,
+                                         modulename)
         return self.hprotocolout("do_checkout", modulename)
 
     def checkoutall(self):
         return self.hprotocolout("do_checkoutall")
 
+    def update(self, localdir, *options):
+        """ brings the working copy below $localdir up to date (see
+        Cprotocvs.do_update). the files are written by our Cdirsink
+        if it keeps the administrative files of $localdir, else by a
+        new one on $localdir, keeping the chunk size of the current
+        sink. """
+        proto = self.objprotocvs
+        sink = proto.filesink
+        if not isinstance(sink, Cdirsink) or not sink.admin or \
+           os.path.abspath(sink.destdir) != os.path.abspath(localdir):
+            sink = Cdirsink(localdir, 1, "", proto.revcache)
+            proto.set_filesink(sink, proto.chunksize)
+        if not sink.cvsroot:
+            sink.cvsroot = proto.get_rootspec()
+        return self.hprotocolout("do_update", localdir, *options)
+
+    def rlog(self, modulename, history, *options):
+        """ loads the log of $modulename into $history, a Chistory,
+        see Cprotocvs.do_rlog. history.updateoptions() as $options
+        only fetches what changed since the last time. """
+        return self.hprotocolout("do_rlog", modulename, history, *options)
+
+    def export(self, modulename, *options):
+        """ exports $modulename to our file sink, $options being
+        export's (-r tag, -D date). with a Ctarsink or a Czipsink the
+        files go straight into an archive; call its finish() once
+        everything it should hold is exported. """
+        return self.hprotocolout("do_export", modulename, *options)
+
+    def lazytree(self, modulename, revision=None, cachesize=64 << 20,
+                 prefetch=8):
+        """ a Clazytree of $modulename, fetching files as they are
+        read instead of checking it out """
+        return Clazytree(self, modulename, revision, cachesize, prefetch)
+
+    def sync_to_tag(self, modulename, fromtag, totag):
+        """ moves the checkout of $modulename at $fromtag in the
+        destination of our Cdirsink to $totag, applying what rdiff
+        says changed instead of checking out again (see Csynctag).
+        returns the Csynctag once done, the asynchronous version
+        throws "syncdone" with it then. """
+        sync = Csynctag(self, modulename, fromtag, totag)
+        sync.chain = self.asyncversion
+        self.hprotocolout("do_rdiff", modulename, fromtag, totag, sync)
+        if not self.asyncversion:
+            if sync.reply == "ok" and sync.fetch:
+                self.hprotocolout("do_fetch", sync.fetch, ("-r" + totag,),
+                                  sync.fetchdone)
+            sync.finish()
+        return sync
+
+    def parallelcheckout(self, modulename, connections=4):
+        """ checks out $modulename over $connections connections at
+        once, see Cparallelcheckout. the synchronous version returns
+        when it is done, the asynchronous one throws "checkoutdone". """
+        shards = Cparallelcheckout(self, modulename, connections)
+        self.workers = []
+
+        if "rlist" in self.objprotocvs.validrequests:
+            self.hprotocolout("do_listdir", modulename, shards.start)
+        else:
+            shards.start(None)
+
+        if not self.asyncversion:
+            shards.wait()
+        return shards
+
+    def is_idle(self):
+        """ logged in with nothing left to send or to be replied """
+        proto = self.objprotocvs
+        if proto.loginpending or proto.retryat is not None:
+            return 0
+        return not proto.get_loggedin() or \
+            ((proto.get_authorized() or not proto.objnet.get_connected())
+             and not proto.sendqueue and not proto.inflight)
+
+    def checkio_until(self, predicate, timeout=None):
+        """ loops inside checkio until predicate() is true, for at
+        most $timeout seconds. returns the last predicate() value. """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not predicate() and not self.exiting:
+            if timeout is not None and time.time() > deadline:
+                break
+            # what is sent may be all we waited for (Gzip-stream has
+            # no reply), no need to wait for the socket then
+            self.checkio_send()
+            if predicate():
+                break
+            # no connection and nothing to retry on a new one: what
+            # we wait for won't come
+            proto = self.objprotocvs
+            if not proto.objnet.get_connected() and proto.retryat is None:
+                proto.connectionlost()
+                break
+            self.checkio(0.2)
+        return predicate()
+
+    def set_filesink(self, filesink, chunksize=65536):
+        """ streams the received files to $filesink in chunks of
+        $chunksize bytes instead of keeping them in memory.
+        $filesink is a Cfilesink, a destination directory or a
+        writable object. """
+        if isinstance(filesink, str):
+            filesink = Cdirsink(filesink, 1, "", self.objprotocvs.revcache)
+        elif filesink is not None and not isinstance(filesink, Cfilesink):
+            filesink = Cstreamsink(filesink)
+        self.objprotocvs.set_filesink(filesink, chunksize)
+
     def is_loggedin(self):
-        return self.objcvsproto.get_loggedin()
+        return self.objprotocvs.get_loggedin()
+
+
+class Clistdir:
+    """
+    Class name: Clistdir
+    Description: turns the reply of an rlist -e into directory names
+
+    """
+    def __init__(self, callback):
+        self.callback = callback
+
+    def done(self, request, reply):
+        if reply != "ok":
+            self.callback(None)
+            return
+
+        dirs = []
+        for line in request.get_output():
+            if line.startswith("D/"):
+                dirs.append(line.split("/")[1])
+        self.callback(dirs)
+
+
+class Crlogparser:
+    """
+    Class name: Crlogparser
+    Description:
+        turns the reply of an rlog into revision records as it comes,
+        one line at a time, being the output of the request (see
+        Crequest). at the end of each file $callback(path, head, tags,
+        revisions) is called with its path relative to $cvsroot, its
+        head revision, its {tag: revision} (None when there were no
+        symbolic names, rlog -N) and the revisions selected, as dicts
+        of revision, date (seconds since the epoch), author, state,
+        lines ((added, removed) or None), commitid and message. only
+        the file being read is kept.
+
+    """
+    separator = "-" * 28
+    fileend = "=" * 77
+
+    def __init__(self, cvsroot, callback):
+        self.cvsroot = cvsroot.rstrip("/") + "/"
+        self.callback = callback
+        self.files = 0
+        self.clear()
+
+    def clear(self):
+        # starts over, the request is being sent again
+        self.state = None
+        self.path = None
+        self.head = None
+        self.tags = None
+        self.revisions = []
+        self.revision = None
+
+    def relpath(self, rcsfile):
+        # /cvsroot/mod/Attic/f.c,v -> mod/f.c
+        path = rcsfile
+        if path.startswith(self.cvsroot):
+            path = path[len(self.cvsroot):]
+        if path.endswith(",v"):
+            path = path[:-2]
+        dirname, name = posixpath.split(path)
+        if posixpath.basename(dirname) == "Attic":
+            path = posixpath.join(posixpath.dirname(dirname), name)
+        return path
+
+    def append(self, line):
+        state = self.state
+        if state == "message":
+            if line == self.separator:
+                self.state = "revision"
+            elif line == self.fileend:
+                self.endfile()
+            elif not self.revision["message"] and \
+                    line.startswith("branches:"):
+                pass
+            else:
+                self.revision["message"].append(line)
+            return
+
+        if line == self.fileend:
+            self.endfile()
+        elif line.startswith("RCS file: "):
+            self.clear()
+            self.path = self.relpath(line[10:].strip())
+            self.state = "header"
+        elif state == "tags" and line.startswith("\t"):
+            tag, sep, rev = line[1:].partition(": ")
+            self.tags[tag] = rev.strip()
+        elif state in ("header", "tags"):
+            self.state = "header"
+            if line.startswith("head:"):
+                self.head = line[5:].strip()
+            elif line.startswith("symbolic names:"):
+                self.tags = {}
+                self.state = "tags"
+            elif line.startswith("description:"):
+                self.state = "description"
+        elif state == "description":
+            if line == self.separator:
+                self.state = "revision"
+        elif state == "revision":
+            if line.startswith("revision "):
+                self.revision = {"revision": line.split()[1],
+                                 "date": None, "author": None,
+                                 "state": None, "lines": None,
+                                 "commitid": None, "message": []}
+            elif line.startswith("date: ") and self.revision:
+                self.revisions.append(self.revision)
+                self.parsefields(line)
+                self.state = "message"
+
+    def parsefields(self, line):
+        # date: 2026/10/18 10:00:00;  author: x;  state: Exp;  lines: +1 -0;
+        rev = self.revision
+        for field in line.split(";"):
+            key, sep, value = field.strip().partition(": ")
+            if key == "date":
+                rev["date"] = parselogdate(value)
+            elif key == "lines":
+                try:
+                    added, removed = value.split()
+                    rev["lines"] = (int(added), -int(removed))
+                except ValueError:
+                    pass
+            elif key in ("author", "state", "commitid"):
+                rev[key] = value
+
+    def endfile(self):
+        if self.path is not None:
+            for rev in self.revisions:
+                rev["message"] = "\n".join(rev["message"])
+            self.files += 1
+            self.callback(self.path, self.head, self.tags, self.revisions)
+        self.clear()
+
+
+class Crdiffparser:
+    """
+    Class name: Crdiffparser
+    Description:
+        turns the reply of an rdiff -u into file patches as it comes,
+        one line at a time, being the output of the request. at the
+        end of each file $callback(path, oldrev, newrev, hunks) is
+        called: oldrev is None for a new file, newrev None for one
+        removed, and hunks a list of (old start, old count, lines)
+        for applyunifieddiff, or None if the diff can't be applied
+        (binary files). only the file being read is kept.
+
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.files = 0
+        self.clear()
+
+    def clear(self):
+        # starts over, the request is being sent again
+        self.path = None
+        self.specs = None
+        self.hunks = []
+        self.lines = None
+        # old and new lines the hunk being read still has
+        self.oldleft = self.newleft = 0
+
+    def append(self, line):
+        if self.lines is not None:
+            if self.oldleft > 0 or self.newleft > 0:
+                kind = line[:1] or " "
+                if kind in (" ", "-"):
+                    self.oldleft -= 1
+                if kind in (" ", "+"):
+                    self.newleft -= 1
+                self.lines.append(kind + line[1:])
+                return
+            if line.startswith("\\"):
+                self.lines.append(line)
+                return
+            self.lines = None
+
+        if line.startswith("Index: "):
+            self.endfile()
+            self.path = line[7:].strip()
+        elif line.startswith("diff "):
+            if self.specs:
+                self.endfile()
+            self.specs = line.split()[-2:]
+        elif line.startswith("@@ ") and self.specs and \
+                self.hunks is not None:
+            try:
+                old, new = line.split()[1:3]
+                start, count = self.parserange(old)
+                newstart, newcount = self.parserange(new)
+            except ValueError:
+                self.hunks = None
+                return
+            self.lines = []
+            self.oldleft, self.newleft = count, newcount
+            self.hunks.append((start, count, self.lines))
+        elif line.startswith("Binary files") and self.specs:
+            self.hunks = None
+
+    def parserange(self, text):
+        # -12,3 or +12 (one line)
+        start, sep, count = text[1:].partition(",")
+        return int(start), int(count) if sep else 1
+
+    def revision(self, spec):
+        # mod/f.c:1.2, /dev/null or mod/f.c:removed
+        if spec == "/dev/null":
+            return None
+        path, sep, revision = spec.rpartition(":")
+        return None if revision == "removed" else revision
+
+    def endfile(self):
+        if self.specs and len(self.specs) == 2:
+            oldspec, newspec = self.specs
+            path = self.path
+            if path is None:
+                spec = newspec if newspec != "/dev/null" else oldspec
+                path = spec.rpartition(":")[0]
+            self.files += 1
+            self.callback(path, self.revision(oldspec),
+                          self.revision(newspec), self.hunks)
+        self.clear()
+
+
+class Cparallelcheckout:
+    """
+    Class name: Cparallelcheckout
+    Description:
+        checks a module out over several connections. the module is
+        split in its top level files (co -l) and one shard per
+        subdirectory; $connections worker threads, each with its own
+        session, take shards until none is left. the events of the
+        workers are thrown by the parent server, one at a time, and
+        "checkoutdone" is thrown with (modulename, failed shards)
+        when all of them finished.
+
+    """
+    def __init__(self, server, modulename, connections=4):
+        self.server = server
+        self.modulename = modulename
+        self.connections = connections
+
+        self.work = deque()
+        self.failed = []
+        self.threads = []
+        self.running = 0
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def start(self, dirs):
+        """ called with the subdirectories of the module (None if they
+        couldn't be listed, then the whole module is one shard). """
+        if dirs:
+            self.work.append((self.modulename, ("-l",)))
+            for name in dirs:
+                self.work.append((self.modulename + "/" + name, ()))
+        else:
+            self.work.append((self.modulename, ()))
+
+        self.running = min(self.connections, len(self.work))
+        for i in range(self.running):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            self.threads.append(t)
+            t.start()
+
+    def wait(self, timeout=None):
+        """ blocks until every shard is done """
+        return self.finished.wait(timeout)
+
+    def worker(self):
+        parent = self.server.objprotocvs
+        worker = Casyncservercvs(parent.address, parent.port)
+        self.server.workers.append(worker)
+        worker.set_connpool(parent.connpool)
+        worker.objprotocvs.compression = parent.compression
+        worker.set_timeout(parent.timeout, parent.backoff,
+                           parent.maxbackoff)
+        if parent.filesink:
+            worker.set_filesink(parent.filesink, parent.chunksize)
+
+        for eventname in ("updatedfile", "patchedfile", "removedfile",
+                          "message", "errormessage"):
+            worker.addevent(eventname, self.forwardevent)
+
+        proto = worker.objprotocvs
+        # the shard being checked out, it failed if we don't finish it
+        path = None
+        try:
+            proto.do_login(parent.cvsroot, parent.username, parent.password)
+            worker.checkio_until(worker.is_idle)
+
+            while proto.get_loggedin():
+                try:
+                    path, options = self.work.popleft()
+                except IndexError:
+                    break
+
+                replies = []
+                proto.replycallback = replies.append
+                proto.do_checkout(path, *options)
+                worker.checkio_until(worker.is_idle)
+                if replies != ["ok"]:
+                    self.failed.append(path)
+                path = None
+
+            worker.logout()
+
+        except Exception as x:
+            g_logserver.error("parallel checkout worker failed: %s", x)
+            if path is not None:
+                self.failed.append(path)
+
+        self.workerdone()
+
+    def forwardevent(self, event):
+        with self.lock:
+            self.server.throwevent(event.get_name(), event.get_params())
+
+    def workerdone(self):
+        with self.lock:
+            self.running -= 1
+            if self.running:
+                return
+
+            """ the last one. whatever is left couldn't be done """
+            self.failed.extend(x[0] for x in self.work)
+            self.work.clear()
+            # the files are handled before we say we are done
+            self.server.objdispa.drain(0)
+            self.server.throwevent("checkoutdone",
+                                   (self.modulename, self.failed))
+        self.finished.set()
+
+
+class Csynctag:
+    """
+    Class name: Csynctag
+    Description:
+        moves a checkout of $modulename from tag $fromtag to $totag,
+        the destination of the Cdirsink of $server holding it. the
+        unified diffs of an rdiff between the tags are applied to
+        the files as they come; the files a patch doesn't apply to,
+        or that aren't at the revision of $fromtag, are fetched whole
+        afterwards with one co -r $totag. files modified locally are
+        left alone. patched, added, removed, fetched and skipped list
+        the repository paths of each kind, reply is the last reply.
+
+    """
+    def __init__(self, server, modulename, fromtag, totag):
+        proto = server.objprotocvs
+        if not isinstance(proto.filesink, Cdirsink) or \
+                not proto.filesink.admin:
+            raise ServerCVSException("sync_to_tag: needs a Cdirsink "
+                                     "with the administrative files")
+        self.server = server
+        self.sink = proto.filesink
+        self.cvsroot = proto.cvsroot.rstrip("/")
+        self.modulename = modulename
+        self.fromtag = fromtag
+        self.totag = totag
+        self.parser = Crdiffparser(self.applyfile)
+        # fetch the files to fetch from diffdone(), for the servers
+        # that don't wait for each reply
+        self.chain = 0
+
+        self.patched = []
+        self.added = []
+        self.removed = []
+        self.fetch = []
+        self.skipped = []
+        self.reply = None
+        self.finished = threading.Event()
+
+    def applyfile(self, path, oldrev, newrev, hunks):
+        # a file of the rdiff, path is its repository path
+        dirname, name = posixpath.split(path)
+        cfile = Cfile(self.cvsroot + "/" + path, "", "", 0, None,
+                      dirname + "/")
+        entries = self.sink.entries(cfile)
+        fullpath = os.path.join(entries.dirpath, name)
+        line = entries.files.get(name)
+        if line and entries.filestate(name) == "modified":
+            self.skipped.append(path)
+            return
+
+        if newrev is None:
+            cfile.response = "Removed"
+            self.sink.remove(cfile)
+            self.removed.append(path)
+            self.server.throwevent("removedfile", cfile)
+            return
+
+        revision = line.split("/")[2] if line else None
+        if hunks is None or revision != oldrev:
+            self.fetch.append(path)
+            return
+        try:
+            data = b""
+            if oldrev is not None:
+                with open(fullpath, "rb") as fd:
+                    data = fd.read()
+            data = applyunifieddiff(data, hunks)
+            mode = unparsemode(os.stat(fullpath).st_mode) \
+                if oldrev is not None else "u=rw,g=r,o=r"
+        except (OSError, SinkException) as x:
+            g_logproto.info("%s: fetching it whole, %s", path, x)
+            self.fetch.append(path)
+            return
+
+        options = line.split("/")[4] if line else ""
+        cfile.entries = "/%s/%s//%s/T%s" % (name, newrev, options,
+                                            self.totag)
+        cfile.mode = mode
+        cfile.size = len(data)
+        cfile.response = "Patched" if oldrev else "Created"
+        fd = self.sink.create(fullpath)
+        fd.write(data)
+        self.sink.close(cfile, fd)
+        if oldrev:
+            self.patched.append(path)
+            self.server.throwevent("patchedfile", cfile)
+        else:
+            self.added.append(path)
+            self.server.throwevent("updatedfile", cfile)
+
+    def diffdone(self, request, reply):
+        self.parser.endfile()
+        self.reply = reply
+        if not self.chain:
+            return
+        if reply == "ok" and self.fetch:
+            self.server.objprotocvs.do_fetch(self.fetch, ("-r" + self.totag,),
+                                             self.fetchdone)
+        else:
+            self.finish()
+
+    def fetchdone(self, request, reply):
+        self.reply = reply
+        if self.chain:
+            self.finish()
+
+    def finish(self):
+        # every directory and file of the checkout sticks to the new
+        # tag, the files that didn't change between the tags too
+        if self.reply == "ok":
+            top = os.path.join(self.sink.destdir, self.modulename)
+            for dirpath, dirnames, filenames in os.walk(top):
+                if "CVS" in dirnames:
+                    dirnames.remove("CVS")
+                    self.sink.dirinfo("Set-sticky", os.path.relpath(
+                        dirpath, self.sink.destdir), "", "T" + self.totag)
+                    self.stick(dirpath)
+        self.server.objdispa.drain(0)
+        self.server.throwevent("syncdone", self)
+        self.finished.set()
+
+    def stick(self, dirpath):
+        # rewrites the sticky tag of every entry of $dirpath, with its
+        # Entries.Log folded in
+        with self.sink.lock:
+            entries = self.sink.dirs.get(os.path.normpath(dirpath)) or \
+                Centries(dirpath)
+            entries.load()
+            for name, line in entries.files.items():
+                fields = line.split("/")
+                if len(fields) >= 6:
+                    fields[5] = "T" + self.totag
+                    entries.files[name] = "/".join(fields)
+            entries.save()
+
+    def wait(self, timeout=None):
+        """ blocks until the sync is done """
+        return self.finished.wait(timeout)
+
+
+class Cprintedfile:
+    """
+    Class name: Cprintedfile
+    Description: the output of a co -p, the file printed. Mbinary
+        bodies are kept as they are, M lines get their newline back.
+
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def append(self, data):
+        if isinstance(data, str):
+            data = data.encode(g_encoding, "surrogateescape") + b"\n"
+        self.chunks.append(data)
+
+    def clear(self):
+        self.chunks = []
+
+    def getvalue(self):
+        return b"".join(self.chunks)
+
+
+class Clazytree:
+    """
+    Class name: Clazytree
+    Description:
+        a read-only view of the module $modulename, at $revision (a
+        tag, the head by default), that fetches nothing up front. a
+        directory is listed with rlist -e the first time it is looked
+        at, and a file fetched with co -p the first time it is read,
+        along with up to $prefetch of the siblings after it, all
+        pipelined on a session of its own opened like the ones of
+        $server. up to $cachesize bytes of bodies are kept, the least
+        recently read go first. paths are relative to the module.
+
+    """
+    def __init__(self, server, modulename, revision=None,
+                 cachesize=64 << 20, prefetch=8):
+        self.server = server
+        self.modulename = modulename.strip("/")
+        self.options = ("-r" + revision,) if revision else ()
+        self.cachesize = cachesize
+        self.prefetch = prefetch
+        self.session = None
+
+        # path -> (files {name: revision}, subdirectory names), or
+        # None if it is no directory
+        self.dirs = {}
+        # path -> body, the least recently read first, and the paths
+        # asked for and not replied yet
+        self.bodies = OrderedDict()
+        self.size = 0
+        self.pending = set()
+        self.failed = set()
+        # the path read() waits for, and its body once it came
+        self.waiting = None
+        self.received = None
+
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+        self.prefetched = 0
+
+    def connect(self):
+        # the session, logged in the first time it is needed
+        if self.session:
+            return self.session
+        parent = self.server.objprotocvs
+        session = Casyncservercvs(parent.address, parent.port)
+        session.set_connpool(parent.connpool)
+        session.objprotocvs.compression = parent.compression
+        session.set_timeout(parent.timeout, parent.backoff,
+                            parent.maxbackoff)
+        session.objprotocvs.do_login(parent.cvsroot, parent.username,
+                                     parent.password)
+        session.checkio_until(session.is_idle)
+        if not session.is_loggedin():
+            raise ServerCVSException("lazytree: login failed")
+        self.session = session
+        return session
+
+    def repopath(self, path):
+        path = path.strip("/")
+        return self.modulename + "/" + path if path else self.modulename
+
+    def wait(self, predicate):
+        session = self.connect()
+        session.checkio_until(lambda: predicate() or (
+            session.is_idle() and not session.objprotocvs.inflight))
+
+    # directories #################################################
+
+    def listing(self, path):
+        path = path.strip("/")
+        if path in self.dirs:
+            return self.dirs[path]
+
+        def listed(request, reply):
+            if reply != "ok":
+                self.dirs[path] = None
+                return
+            files = {}
+            subdirs = []
+            for line in request.get_output():
+                fields = line.split("/")
+                if line.startswith("D/") and len(fields) > 1:
+                    subdirs.append(fields[1])
+                elif line.startswith("/") and len(fields) > 2:
+                    files[fields[1]] = fields[2]
+            self.dirs[path] = (files, sorted(subdirs))
+
+        self.connect().objprotocvs.do_listentries(self.repopath(path), listed,
+                                                  *self.options)
+        self.wait(lambda: path in self.dirs)
+        return self.dirs.get(path)
+
+    def listdir(self, path=""):
+        """ the names of the files and subdirectories of $path """
+        listing = self.listing(path)
+        if listing is None:
+            raise ServerCVSException("lazytree: no directory %s" % path)
+        return sorted(list(listing[0]) + listing[1])
+
+    def isdir(self, path):
+        return self.listing(path) is not None
+
+    def isfile(self, path):
+        dirname, name = posixpath.split(path.strip("/"))
+        listing = self.listing(dirname)
+        return listing is not None and name in listing[0]
+
+    def revision(self, path):
+        """ the revision of file $path, None if there is none """
+        dirname, name = posixpath.split(path.strip("/"))
+        listing = self.listing(dirname)
+        return listing[0].get(name) if listing else None
+
+    def walk(self, path=""):
+        """ like os.walk, top down, listing each directory when it is
+        reached """
+        listing = self.listing(path)
+        if listing is None:
+            return
+        files, subdirs = listing
+        yield path, list(subdirs), sorted(files)
+        for name in subdirs:
+            yield from self.walk(posixpath.join(path, name))
+
+    # files #######################################################
+
+    def fetch(self, path):
+        # asks for $path, the reply is kept when it comes
+        output = Cprintedfile()
+
+        def printed(request, reply):
+            self.pending.discard(path)
+            if reply != "ok":
+                self.failed.add(path)
+                return
+            self.fetched += 1
+            data = output.getvalue()
+            # handed over even if it is too big to be kept
+            if path == self.waiting:
+                self.received = data
+            self.keep(path, data)
+
+        self.pending.add(path)
+        self.connect().objprotocvs.do_printfile(self.repopath(path), output,
+                                                printed, *self.options)
+
+    def keep(self, path, data):
+        if len(data) > self.cachesize:
+            return
+        self.bodies[path] = data
+        self.size += len(data)
+        while self.size > self.cachesize:
+            oldpath, old = self.bodies.popitem(last=False)
+            self.size -= len(old)
+
+    def siblings(self, path):
+        # the files after $path in its directory, not here nor asked for
+        dirname, name = posixpath.split(path)
+        listing = self.listing(dirname)
+        if not listing:
+            return []
+        names = sorted(listing[0])
+        after = names[names.index(name) + 1:] if name in names else []
+        paths = [posixpath.join(dirname, x) for x in after]
+        return [x for x in paths if x not in self.bodies and
+                x not in self.pending][:self.prefetch]
+
+    def read(self, path):
+        """ the contents of file $path, as bytes """
+        path = path.strip("/")
+        data = self.bodies.get(path)
+        if data is not None:
+            self.hits += 1
+            self.bodies.move_to_end(path)
+            return data
+
+        self.misses += 1
+        self.failed.discard(path)
+        self.waiting = path
+        self.received = None
+        if path not in self.pending:
+            self.fetch(path)
+        if self.prefetch:
+            for sibling in self.siblings(path):
+                self.prefetched += 1
+                self.fetch(sibling)
+        self.connect().checkio_send()
+
+        self.wait(lambda: self.received is not None or path in self.failed)
+        data = self.received
+        self.waiting = self.received = None
+        if data is None:
+            raise ServerCVSException("lazytree: unable to read %s" % path)
+        return data
+
+    def open(self, path):
+        """ file $path as a read-only binary file object """
+        return io.BytesIO(self.read(path))
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "fetched": self.fetched, "prefetched": self.prefetched,
+                "cached": len(self.bodies), "cached_bytes": self.size,
+                "directories": len(self.dirs)}
+
+    def close(self):
+        if self.session:
+            self.session.objprotocvs.do_logout()
+            self.session = None
 
 
 class ServerException(Exception):
@@ -1096,7 +5146,6 @@ class Casyncservercvs(Cservercvs):
 
     """ ADAPTER OUT - Implement the ASYNCHRONOUS version. """
     def hprotocolout(self, reqname, *args):
-        print("ESTOY EN LA VERSION ASYNC!")
         funcp = getattr(self.objprotocvs, reqname)
         return funcp(*args)
 
@@ -1117,20 +5166,606 @@ class Csyncservercvs(Cservercvs):
 
     """ ADAPTER OUT - Implement the SYNCHRONOUS version. """
     def hprotocolout(self, reqname, *args):
-        print("ESTOY EN LA VERSION SYNC!")
         funcp = getattr(self.objprotocvs, reqname)
-        ret1 = funcp(*args)
+        funcp(*args)
 
-        # we block on checkio
+        # we block on checkio, unless the connection is gone for good
         while self.keepwaiting:
+            if not self.objprotocvs.objnet.get_connected() and \
+               self.objprotocvs.retryat is None:
+                break
             try:
                 self.checkio(-1)
             except:
                 break
 
-        print("termino un request!")
         self.keepwaiting = 1
 
+        # the reply came, and so did everything before it
+        self.objdispa.drain()
+
     """ only for SYNCHRONOUS version. """
     def receivedreply(self, value):
         self.keepwaiting = 0
+
+
+class Caioservercvs(Cservercvs):
+    """
+    Class name: Caioservercvs
+    Description:
+        CVS asyncio version. the methods are coroutines which return
+        once the server replied, and updatedfiles() is an async
+        iterator over the files received by a checkout:
+
+            srv = Caioservercvs(address, port)
+            await srv.login(cvsroot, username, password)
+            task = asyncio.ensure_future(srv.checkout(module))
+            async for cfile in srv.updatedfiles():
+                ...
+            await task
+
+        with a Cfilesink the files are streamed to it as they arrive.
+        the files are only queued while updatedfiles() is iterated.
+
+    """
+    # the operations bringing files, their reply ends updatedfiles()
+    fileoperations = ("do_checkout", "do_checkoutall", "do_update",
+                      "do_updatemodule", "do_export", "do_fetch")
+
+    def __init__(self, address, port):
+        self.asyncversion = 1
+        Cservercvs.__init__(self, address, port, self.receivedreply)
+        self.objprotocvs.objnet = Caionetwork(self)
+        # pooled connections are plain sockets, not asyncio streams
+        self.set_connpool(None)
+
+        # (future, operation) for the requests waiting for a reply,
+        # oldest first. operation is 1 if updatedfiles() ends with it.
+        self.waiters = deque()
+        self.loginfuture = None
+        # the files for updatedfiles(), None once the operation
+        # bringing them is replied, and how many iterate over it
+        self.files = asyncio.Queue()
+        self.consumers = 0
+
+        # wakes us up for the next deadline or reconnection
+        self.timer = None
+
+    """ ADAPTER IN - also wakes up whoever is waiting """
+    def hprotocolin(self, response):
+        Cservercvs.hprotocolin(self, response)
+
+        name = response.get_name()
+        if name == "updatedfile" and self.consumers:
+            self.files.put_nowait(response.get_data())
+        elif name in ("loginok", "loginfail") and self.loginfuture:
+            if not self.loginfuture.done():
+                self.loginfuture.set_result(name == "loginok")
+
+    """ ADAPTER OUT - Implement the ASYNCIO version. returns a future
+    for the reply of the last request queued by $reqname. """
+    def hprotocolout(self, reqname, *args):
+        funcp = getattr(self.objprotocvs, reqname)
+        funcp(*args)
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((future, int(reqname in self.fileoperations)))
+        self.objprotocvs.processrequests()
+        self.armtimer()
+        return future
+
+    def armtimer(self):
+        # a timer firing early just finds nothing to do and is armed
+        # again, so an earlier one is kept.
+        wait = self.objprotocvs.nexttimer()
+        if wait is None:
+            return
+        loop = asyncio.get_running_loop()
+        when = loop.time() + wait
+        if self.timer and self.timer.when() <= when:
+            return
+        if self.timer:
+            self.timer.cancel()
+        self.timer = loop.call_at(when, self.timerfired)
+
+    def timerfired(self):
+        self.timer = None
+        try:
+            self.objprotocvs.processrequests()
+        except Exception as x:
+            self.objprotocvs.objnet.close()
+            self.aio_closed(x)
+            return
+        self.armtimer()
+
+    def receivedreply(self, value):
+        if not self.waiters:
+            return
+
+        future, operation = self.waiters.popleft()
+        if not future.done():
+            if value == "ok":
+                future.set_result(value)
+            else:
+                future.set_exception(
+                    ServerCVSException("request failed: %s" % value))
+
+        # a finished checkout ends the updatedfiles() iteration
+        if operation and self.consumers:
+            self.files.put_nowait(None)
+
+    def aio_data(self, data):
+        """ called by Caionetwork with the $data that arrived. handles
+        the responses it completes and sends what they queued. """
+        try:
+            self.objprotocvs.datareceived(data)
+            self.objprotocvs.processrequests()
+            self.armtimer()
+
+        except Exception as x:
+            self.objprotocvs.objnet.close()
+            self.aio_closed(x)
+
+    def aio_closed(self, exception):
+        """ the connection is gone, fail whoever is waiting on it.
+        with a timeout the requests not replied are sent again on
+        a new connection if they can be. """
+        proto = self.objprotocvs
+        if proto.timeout and proto.get_loggedin() and \
+           (proto.inflight or proto.batch):
+            proto.retryrequests()
+            if proto.retryat is not None:
+                self.armtimer()
+                return
+
+        if self.loginfuture and not self.loginfuture.done():
+            self.loginfuture.set_exception(exception)
+
+        waiters = self.waiters
+        self.waiters = deque()
+        for future, operation in waiters:
+            if not future.done():
+                future.set_exception(exception)
+            if operation and self.consumers:
+                self.files.put_nowait(None)
+
+    async def updatedfiles(self):
+        """ yields the received Cfiles until the next checkout, update
+        or export is replied. the files received while nobody iterates
+        aren't kept. """
+        self.consumers += 1
+        try:
+            while 1:
+                cfile = await self.files.get()
+                if cfile is None:
+                    return
+                yield cfile
+        finally:
+            self.consumers -= 1
+            if not self.consumers:
+                self.files = asyncio.Queue()
+
+    async def login(self, cvsroot, username="anonymous", password=""):
+        """ returns 1 once logged in and the protocol negotiated,
+        0 if the server rejected us. """
+        loop = asyncio.get_running_loop()
+        self.loginfuture = loop.create_future()
+
+        self.objprotocvs.do_login(cvsroot, username, password)
+        if not self.objprotocvs.objnet.get_connected():
+            raise ServerCVSException("login: unable to connect")
+
+        if not await self.loginfuture:
+            return 0
+
+        # wait for the reply of the valid-requests sent by res_login
+        future = loop.create_future()
+        self.waiters.append((future, 0))
+        self.objprotocvs.processrequests()
+        self.armtimer()
+        await future
+        return 1
+
+    async def checkout(self, modulename, *options):
+        return await self.hprotocolout("do_checkout", modulename, *options)
+
+    async def checkoutall(self):
+        return await self.hprotocolout("do_checkoutall")
+
+    async def listmodules(self):
+        return await self.hprotocolout("do_listmodules")
+
+    async def rlog(self, modulename, history, *options):
+        return await self.hprotocolout("do_rlog", modulename, history,
+                                       *options)
+
+    async def export(self, modulename, *options):
+        return await self.hprotocolout("do_export", modulename, *options)
+
+    async def sync_to_tag(self, modulename, fromtag, totag):
+        sync = Csynctag(self, modulename, fromtag, totag)
+        await self.hprotocolout("do_rdiff", modulename, fromtag, totag, sync)
+        if sync.reply == "ok" and sync.fetch:
+            await self.hprotocolout("do_fetch", sync.fetch,
+                                    ("-r" + totag,), sync.fetchdone)
+        sync.finish()
+        return sync
+
+
+# name, type, help and the get_metrics() key of the plain metrics
+g_prometheusmetrics = (
+    ("pycvs_requests_total", "counter", "requests sent", "requests"),
+    ("pycvs_replies_total", "counter", "requests replied", "replies"),
+    ("pycvs_errors_total", "counter", "requests replied with error",
+     "errors"),
+    ("pycvs_files_total", "counter", "files received", "files"),
+    ("pycvs_file_bytes_total", "counter", "bytes of the files received",
+     "file_bytes"),
+    ("pycvs_received_bytes_total", "counter",
+     "bytes read from the socket", "bytes_in"),
+    ("pycvs_sent_bytes_total", "counter", "bytes written to the socket",
+     "bytes_out"),
+    ("pycvs_socket_wait_seconds_total", "counter",
+     "seconds spent waiting for the socket", "socket_wait_s"),
+    ("pycvs_handler_seconds_total", "counter",
+     "seconds spent in event handlers", "handler_s"),
+    ("pycvs_connects_total", "counter", "connections opened", "connects"),
+    ("pycvs_reconnects_total", "counter",
+     "sessions opened after the first one", "reconnects"),
+    ("pycvs_timeouts_total", "counter",
+     "requests whose reply didn't come in time", "timeouts"),
+    ("pycvs_retries_total", "counter",
+     "times the requests not replied were sent again", "retries"),
+    ("pycvs_send_queue", "gauge", "requests waiting to be sent",
+     "sendqueue"),
+    ("pycvs_inflight_requests", "gauge",
+     "requests waiting for their reply", "inflight"),
+    ("pycvs_event_queue", "gauge",
+     "events waiting for the executor", "eventqueue"),
+)
+
+
+def prometheuslabels(labels):
+    return ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\")
+                                 .replace('"', '\\"').replace("\n", "\\n"))
+                    for name, value in labels)
+
+
+def prometheustext(servers, selectwait=None):
+    """ the metrics of the Cservercvs $servers, and of the sessions of
+    their parallel checkouts, in the Prometheus text format """
+    sessions = []
+    for i, srv in enumerate(servers):
+        sessions.append((str(i), srv))
+        for j, worker in enumerate(srv.workers):
+            sessions.append(("%d.%d" % (i, j), worker))
+
+    stats = []
+    for session, srv in sessions:
+        labels = (("server", "%s:%s" % (srv.objprotocvs.address,
+                                        srv.objprotocvs.port)),
+                  ("session", session))
+        stats.append((labels, srv.objprotocvs.get_metrics(),
+                      dict(srv.objprotocvs.metrics.latency),
+                      srv.objdispa.queued))
+
+    lines = []
+    for name, kind, text, key in g_prometheusmetrics:
+        lines.append("# HELP %s %s" % (name, text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, values, latency, queued in stats:
+            value = queued if key == "eventqueue" else values[key]
+            lines.append("%s{%s} %s" % (name, prometheuslabels(labels),
+                                        value))
+
+    name = "pycvs_request_latency_seconds"
+    lines.append("# HELP %s seconds from sending a request to its reply"
+                 % name)
+    lines.append("# TYPE %s histogram" % name)
+    for labels, values, latency, queued in stats:
+        for request, histogram in sorted(latency.items()):
+            series = labels + (("request", request),)
+            for bound, count in histogram.cumulative():
+                le = "+Inf" if bound == float("inf") else "%g" % bound
+                lines.append("%s_bucket{%s} %d" % (
+                    name, prometheuslabels(series + (("le", le),)), count))
+            lines.append("%s_sum{%s} %.6f" % (name, prometheuslabels(series),
+                                              histogram.sum))
+            lines.append("%s_count{%s} %d" % (name, prometheuslabels(series),
+                                              histogram.count))
+
+    if selectwait is not None:
+        name = "pycvs_select_wait_seconds_total"
+        lines.append("# HELP %s seconds CVS.checkio_all waited in select"
+                     % name)
+        lines.append("# TYPE %s counter" % name)
+        lines.append("%s %.6f" % (name, selectwait))
+    return "\n".join(lines) + "\n"
+
+
+class Cmetricshandler(http.server.BaseHTTPRequestHandler):
+    """
+    Class name: Cmetricshandler
+    Description: answers GET /metrics with the text of the server's
+        source()
+
+    """
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.source().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        g_log.debug("metrics: " + format, *args)
+
+
+class Cmetricsserver:
+    """
+    Class name: Cmetricsserver
+    Description: serves the Prometheus text returned by $source() on
+        http://$address:$port/metrics from a thread. port 0 picks a
+        free one, start() returns it.
+
+    """
+    def __init__(self, source, address="127.0.0.1", port=0):
+        self.source = source
+        self.address = address
+        self.port = port
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        self.httpd = http.server.ThreadingHTTPServer(
+            (self.address, self.port), Cmetricshandler)
+        self.httpd.daemon_threads = True
+        self.httpd.source = self.source
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+            self.thread.join()
+
+
+def parsecvsroot(cvsroot):
+    """ splits a :pserver:user[:password]@host[:port][:]/path CVSROOT
+    into (user, password, host, port, path) """
+    method, sep, rest = cvsroot.lstrip(":").partition(":")
+    if method != "pserver" or not sep:
+        raise CVSException("not a pserver CVSROOT: %s" % cvsroot)
+    userinfo, sep, rest = rest.rpartition("@")
+    username, sep, password = userinfo.partition(":")
+    hostport, sep, path = rest.partition("/")
+    host, sep, port = hostport.rstrip(":").partition(":")
+    return (username or "anonymous", password, host,
+            int(port) if port else 2401, "/" + path)
+
+
+def percentile(values, fraction):
+    """ the value below which $fraction of the sorted $values are """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Cclistats:
+    """
+    Class name: Cclistats
+    Description: what the command line tool reports, counted from the
+        events of the servers.
+
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.files = 0
+        self.bytes = 0
+        self.intervals = []
+        self.loginok = 0
+        self.failed = []
+        self.sinkerrors = 0
+
+    def on_loginok(self, event):
+        self.loginok = 1
+
+    def on_updatedfile(self, event):
+        now = time.perf_counter()
+        self.files += 1
+        self.bytes += event.get_params().get_size()
+        self.intervals.append(now - self.last)
+        self.last = now
+
+    on_patchedfile = on_updatedfile
+
+    def on_checkoutdone(self, event):
+        self.failed = event.get_params()[1]
+
+    def on_sinkerror(self, event):
+        print("pycvs: %s" % event.get_params(), file=sys.stderr)
+        self.sinkerrors += 1
+
+    def report(self, **extra):
+        seconds = time.perf_counter() - self.start
+        intervals = sorted(self.intervals)
+        stats = {
+            "files": self.files,
+            "bytes": self.bytes,
+            "seconds": round(seconds, 6),
+            "files_per_s": round(self.files / seconds, 3) if seconds else 0,
+            "mb_per_s": round(self.bytes / seconds / 1e6, 3)
+            if seconds else 0,
+            "file_p50_ms": round(percentile(intervals, 0.5) * 1000, 3),
+            "file_p99_ms": round(percentile(intervals, 0.99) * 1000, 3),
+            "failed": self.failed,
+            "sink_errors": self.sinkerrors,
+        }
+        stats.update(extra)
+        return stats
+
+
+def archivesink(writable, filename, prefix=""):
+    """ the Ctarsink or Czipsink for an archive named $filename,
+    written to $writable """
+    if filename.endswith(".zip"):
+        return Czipsink(writable, prefix=prefix)
+    for suffix, compression in ((".tar.gz", "gz"), (".tgz", "gz"),
+                                (".tar.bz2", "bz2"), (".tar.xz", "xz")):
+        if filename.endswith(suffix):
+            return Ctarsink(writable, compression, prefix)
+    return Ctarsink(writable, "", prefix)
+
+
+def main(argv=None):
+    """ the command line tool, python -m pycvs checkout|update|export|rlog
+    ... prints a JSON line of throughput and latency figures. """
+    parser = argparse.ArgumentParser(prog="pycvs")
+    parser.add_argument("command", choices=("checkout", "update", "export",
+                                            "rlog"))
+    parser.add_argument("module", nargs="?",
+                        help="module to check out, export or get the log of")
+    parser.add_argument("-d", "--cvsroot",
+                        default=os.environ.get("CVSROOT", ""),
+                        help=":pserver:user[:password]@host[:port]/path")
+    parser.add_argument("-C", "--dest", default=".",
+                        help="directory to check out into or to update")
+    parser.add_argument("-o", "--output", default="-",
+                        help="archive to export into, .tar[.gz|.bz2|.xz] "
+                        "or .zip, - for a tar on stdout")
+    parser.add_argument("-r", "--tag", default="HEAD",
+                        help="tag or revision to export")
+    parser.add_argument("--prefix", default="",
+                        help="prepended to the names in the archive")
+    parser.add_argument("-j", "--connections", type=int, default=1,
+                        help="connections for a parallel checkout")
+    parser.add_argument("--chunk-size", type=int, default=65536,
+                        help="bytes read and written at a time")
+    parser.add_argument("-z", "--compression", type=int, default=0,
+                        help="zlib level for the traffic, 0 is off")
+    parser.add_argument("--cache-dir", default="",
+                        help="Crevcache directory to check out from")
+    parser.add_argument("--cache-size", type=int, default=1 << 30,
+                        help="bytes the cache may grow to")
+    parser.add_argument("--no-admin", action="store_true",
+                        help="don't write the CVS administrative files")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="seconds to wait for a reply before "
+                        "reconnecting and retrying")
+    parser.add_argument("--history", default="history.db",
+                        help="Chistory database rlog loads, only what "
+                        "is newer than its latest revision is fetched")
+    parser.add_argument("--metrics", default="",
+                        help="file to write Prometheus metrics to")
+    parser.add_argument("-v", "--verbose", action="count", default=0,
+                        help="log to stderr, twice for every request")
+    # the options may come before the module, as well as after it
+    args = parser.parse_intermixed_args(argv)
+    if args.verbose:
+        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG
+                            if args.verbose > 1 else logging.INFO)
+    if args.command in ("checkout", "export", "rlog") and not args.module:
+        parser.error("%s needs a module" % args.command)
+    if not args.cvsroot:
+        parser.error("no CVSROOT, use -d or set $CVSROOT")
+    username, password, host, port, path = parsecvsroot(args.cvsroot)
+
+    stats = Cclistats()
+    cvs = CVS()
+    for eventname in ("loginok", "updatedfile", "patchedfile",
+                      "checkoutdone", "sinkerror"):
+        cvs.addevent(eventname, getattr(stats, "on_" + eventname))
+
+    revcache = None
+    if args.cache_dir:
+        revcache = Crevcache(args.cache_dir, args.cache_size)
+
+    srv = cvs.newserver(host, port, 1)
+    srv.set_compression(args.compression)
+    srv.set_timeout(args.timeout)
+    srv.set_revcache(revcache)
+    srv.login(path, username, password)
+    login = time.perf_counter() - stats.start
+    if not stats.loginok:
+        print("pycvs: login failed", file=sys.stderr)
+        return 1
+
+    proto = srv.objprotocvs
+    if args.command == "rlog":
+        history = Chistory(args.history)
+        srv.rlog(args.module, history, *history.updateoptions())
+        srv.logout()
+        history.close()
+        if args.metrics:
+            cvs.writemetrics(args.metrics)
+        print(json.dumps({"command": args.command, "module": args.module,
+                          "files": history.files,
+                          "revisions": history.revisions,
+                          "seconds": round(time.perf_counter() -
+                                           stats.start, 6)}))
+        return 0
+
+    report = sys.stdout
+    if args.command == "export":
+        if args.output == "-":
+            writable = sys.stdout.buffer
+            report = sys.stderr
+        else:
+            writable = open(args.output, "wb")
+        sink = archivesink(writable, args.output, args.prefix)
+        srv.set_filesink(sink, args.chunk_size)
+        srv.export(args.module, "-r" + args.tag)
+        sink.finish()
+        if writable is not sys.stdout.buffer:
+            writable.close()
+    elif args.command == "update":
+        # the sink update writes the files of args.dest with
+        srv.set_filesink(Cdirsink(args.dest, 1, proto.get_rootspec(),
+                                  revcache), args.chunk_size)
+        srv.update(args.dest)
+    else:
+        sink = Cdirsink(args.dest, not args.no_admin,
+                        proto.get_rootspec(), revcache)
+        srv.set_filesink(sink, args.chunk_size)
+        repository = path.rstrip("/") + "/" + args.module
+        cached = revcache and sink.admin and \
+            revcache.manifest(sink.cacheroot(), repository)
+        if args.connections > 1 and not cached:
+            srv.parallelcheckout(args.module, args.connections)
+        else:
+            srv.checkout(args.module)
+    srv.logout()
+
+    if revcache:
+        revcache.close()
+    if args.metrics:
+        cvs.writemetrics(args.metrics)
+    # the parallel checkout sessions count too
+    metrics = srv.get_metrics()
+    totals = {}
+    for session in [metrics] + metrics.get("workers", []):
+        for key in ("reconnects", "timeouts", "retries", "socket_wait_s",
+                    "handler_s"):
+            totals[key] = round(totals.get(key, 0) + session[key], 6)
+    print(json.dumps(stats.report(command=args.command,
+                                  module=args.module,
+                                  connections=args.connections,
+                                  cached_files=getattr(proto.filesink,
+                                                       "materialized", 0),
+                                  login_s=round(login, 6), **totals)),
+          file=report)
+    return 1 if stats.failed or stats.sinkerrors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
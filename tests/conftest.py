@@ -0,0 +1,26 @@
+# $id$
+# the tests run pyCVS against the fake pserver of library/fakepserver.py
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "library"))
+
+from fakepserver import Crepository, Cfakepserver
+
+
+@pytest.fixture
+def repository():
+    return Crepository(files=20, meansize=512, depth=1, fanout=2)
+
+
+@pytest.fixture
+def fakeserver(repository):
+    server = Cfakepserver(repository, users={"alice": "secret",
+                                             "bob": "hunter2"})
+    server.start()
+    yield server
+    server.stop()
@@ -0,0 +1,70 @@
+# $id$
+# Caioservercvs: the asyncio server and its updatedfiles() iterator
+
+import asyncio
+
+import pycvs
+
+
+def run(fakeserver, coroutine):
+    async def main():
+        srv = pycvs.Caioservercvs("127.0.0.1", fakeserver.port)
+        assert await srv.login("/cvsroot", "alice", "secret")
+        try:
+            return await coroutine(srv)
+        finally:
+            srv.logout()
+    return asyncio.run(main())
+
+
+def test_updatedfiles_after_listmodules(repository, fakeserver):
+    async def session(srv):
+        # no file comes with it, nor does the end of updatedfiles()
+        await srv.listmodules()
+        task = asyncio.ensure_future(srv.checkout("mod"))
+        paths = [cfile.get_path() async for cfile in srv.updatedfiles()]
+        await task
+        return paths
+
+    paths = run(fakeserver, session)
+    assert len(paths) == len(repository.files)
+
+
+def test_updatedfiles_one_checkout_each(repository, fakeserver):
+    async def session(srv):
+        counts = []
+        for i in range(3):
+            task = asyncio.ensure_future(srv.checkout("mod"))
+            counts.append(len([x async for x in srv.updatedfiles()]))
+            await task
+            await srv.listmodules()
+        return counts
+
+    assert run(fakeserver, session) == [len(repository.files)] * 3
+
+
+def test_no_files_kept_without_consumer(repository, fakeserver):
+    async def session(srv):
+        await srv.checkout("mod")
+        await srv.checkout("mod")
+        return srv.files.qsize()
+
+    assert run(fakeserver, session) == 0
+
+
+def test_checkout_options(repository, fakeserver):
+    # -r REL_1 has the files as tagged, not as they are now
+    repository.tag("REL_1")
+    repository.change(0.3, seed=3)
+
+    async def session(srv):
+        task = asyncio.ensure_future(srv.checkout("mod", "-rREL_1"))
+        files = {}
+        async for cfile in srv.updatedfiles():
+            files[cfile.get_localpath()] = cfile.get_entries().split("/")[2]
+        await task
+        return files
+
+    files = run(fakeserver, session)
+    assert sorted(files) == sorted(repository.files)
+    assert set(files.values()) == {"1.1"}
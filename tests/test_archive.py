@@ -0,0 +1,86 @@
+# $id$
+# Ctarsink and Czipsink: an export written straight into an archive
+
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+import pycvs
+import fakepserver
+
+
+class Cpipe(io.RawIOBase):
+    """ a writable which can't seek nor tell, like a pipe """
+    def __init__(self):
+        self.data = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.data.write(data)
+
+
+@pytest.fixture(params=(0, 1), ids=("plain", "gzip-file-contents"))
+def gzipfiles(request, monkeypatch):
+    # with gzip-file-contents the bodies come gzipped, their size
+    # unknown until they are inflated
+    if request.param:
+        monkeypatch.setattr(fakepserver.Cfakesession, "validrequests",
+                            tuple(x for x in fakepserver.Cfakesession
+                                  .validrequests if x != "Gzip-stream"))
+    return request.param
+
+
+def export(fakeserver, sink, gzipfiles):
+    srv = pycvs.CVS().newserver("127.0.0.1", fakeserver.port, 1)
+    srv.set_connpool(None)
+    if gzipfiles:
+        srv.set_compression(6)
+    srv.login("/cvsroot", "alice", "secret")
+    srv.set_filesink(sink, 1024)
+    srv.export("mod")
+    srv.logout()
+    sink.finish()
+    assert fakeserver.counters.get("gzip-file-contents", 0) == gzipfiles
+
+
+@pytest.mark.parametrize("compression", ("", "gz", "bz2", "xz"))
+def test_tarsink(repository, fakeserver, gzipfiles, compression):
+    out = io.BytesIO()
+    sink = pycvs.Ctarsink(out, compression, "rel/", mtime=1234567890)
+    export(fakeserver, sink, gzipfiles)
+    assert sink.files == len(repository.files)
+    if not compression:
+        assert len(out.getvalue()) % tarfile.RECORDSIZE == 0
+
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode="r:" + compression) as archive:
+        members = archive.getmembers()
+        assert sorted(x.name for x in members) == \
+            sorted("rel/" + x for x in repository.files)
+        for member in members:
+            assert member.mode == 0o644
+            assert member.mtime == 1234567890
+            assert archive.extractfile(member).read() == \
+                repository.body(member.name[4:])
+
+
+@pytest.mark.parametrize("compression", (zipfile.ZIP_STORED,
+                                         zipfile.ZIP_DEFLATED))
+def test_zipsink(repository, fakeserver, gzipfiles, compression):
+    out = Cpipe()
+    sink = pycvs.Czipsink(out, compression)
+    export(fakeserver, sink, gzipfiles)
+    assert sink.files == len(repository.files)
+
+    with zipfile.ZipFile(io.BytesIO(out.data.getvalue())) as archive:
+        assert archive.testzip() is None
+        infos = archive.infolist()
+        assert sorted(x.filename for x in infos) == sorted(repository.files)
+        for info in infos:
+            assert info.compress_type == compression
+            assert info.external_attr >> 16 == 0o100644
+            assert archive.read(info) == repository.body(info.filename)
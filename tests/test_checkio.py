@@ -0,0 +1,79 @@
+# $id$
+# driving the asynchronous servers
+
+import time
+
+import pytest
+
+import pycvs
+
+
+def test_checkio_until_compressed_login(fakeserver):
+    # Gzip-stream is still to be sent once valid-requests is replied,
+    # sending it is the last thing to wait for
+    srv = pycvs.CVS().newserver("127.0.0.1", fakeserver.port, 0)
+    srv.set_connpool(None)
+    srv.set_compression(6)
+    srv.login("/cvsroot", "alice", "secret")
+    start = time.perf_counter()
+    assert srv.checkio_until(srv.is_idle, 5)
+    seconds = time.perf_counter() - start
+    assert srv.is_loggedin()
+    assert srv.objprotocvs.objnet.compressor
+    assert seconds < 0.15
+    srv.logout()
+
+
+def login(fakeserver):
+    srv = pycvs.CVS().newserver("127.0.0.1", fakeserver.port, 0)
+    srv.set_connpool(None)
+    srv.login("/cvsroot", "alice", "secret")
+    assert srv.checkio_until(srv.is_idle, 5)
+    return srv
+
+
+def test_checkio_until_timeout(fakeserver):
+    srv = login(fakeserver)
+    start = time.perf_counter()
+    cpu = time.process_time()
+    assert not srv.checkio_until(lambda: 0, 0.3)
+    assert 0.3 <= time.perf_counter() - start < 1
+    # waiting in select, not polling
+    assert time.process_time() - cpu < 0.1
+    srv.logout()
+
+
+def test_checkio_until_connection_lost(fakeserver):
+    # no timeout, nothing sends the checkout again: it fails at once
+    srv = login(fakeserver)
+    replies = []
+    srv.objprotocvs.replycallback = replies.append
+    fakeserver.hangup("co", 200)
+    srv.objprotocvs.do_checkout("mod")
+    start = time.perf_counter()
+    assert srv.checkio_until(srv.is_idle, 5)
+    assert time.perf_counter() - start < 1
+    assert replies == ["timeout"]
+    assert not srv.objprotocvs.inflight
+
+
+def test_lazytree_connection_lost(fakeserver):
+    srv = pycvs.CVS().newserver("127.0.0.1", fakeserver.port, 1)
+    srv.set_connpool(None)
+    srv.login("/cvsroot", "alice", "secret")
+    tree = srv.lazytree("mod", prefetch=0)
+    name = [x for x in tree.listdir("") if tree.isfile(x)][0]
+    fakeserver.hangup("co", 10)
+    start = time.perf_counter()
+    with pytest.raises(pycvs.ServerCVSException):
+        tree.read(name)
+    assert time.perf_counter() - start < 1
+    tree.close()
+
+
+def test_checkio_all_no_servers():
+    # nothing to select on: the timeout is slept once
+    cvs = pycvs.CVS()
+    start = time.perf_counter()
+    cvs.checkio_all(0.2)
+    assert 0.2 <= time.perf_counter() - start < 0.35
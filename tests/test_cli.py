@@ -0,0 +1,84 @@
+# $id$
+# python -m pycvs, run as the README says
+
+import os
+import sys
+import json
+import shlex
+import tarfile
+import subprocess
+
+from fakepserver import Cfakepserver
+
+g_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def readmecommands():
+    # the python -m pycvs command lines of the README, joined
+    lines = []
+    command = ""
+    with open(os.path.join(g_root, "README.md")) as f:
+        for line in f:
+            line = line.strip()
+            if command or line.startswith("PYTHONPATH=library python -m"):
+                command += line.rstrip("\\")
+                if not line.endswith("\\"):
+                    lines.append(command)
+                    command = ""
+    return lines
+
+
+def runreadme(command, port, workdir):
+    args = []
+    for arg in shlex.split(command)[1:]:
+        if arg.startswith(":pserver:"):
+            arg = ":pserver:anonymous@127.0.0.1:%d/cvsroot" % port
+        elif arg == "module":
+            arg = "mod"
+        args.append(arg.replace("~", str(workdir)))
+    env = dict(os.environ, PYTHONPATH=os.path.join(g_root, "library"))
+    return subprocess.run([sys.executable] + args[1:], cwd=str(workdir),
+                          env=env, capture_output=True, timeout=60)
+
+
+def test_readme_commands(repository, tmp_path):
+    repository.tag("REL_1")
+    server = Cfakepserver(repository)
+    port = server.start()
+    try:
+        commands = readmecommands()
+        assert [shlex.split(x)[4] for x in commands] == \
+            ["checkout", "rlog", "export"]
+        for command in commands:
+            done = runreadme(command, port, tmp_path)
+            assert done.returncode == 0, done.stderr.decode()
+            report = json.loads(done.stdout.decode().splitlines()[-1])
+            assert report["files"] == len(repository.files)
+    finally:
+        server.stop()
+
+    assert len([x for x in os.listdir(str(tmp_path / "dest" / "mod"))
+                if x != "CVS"]) > 0
+    assert os.path.exists(str(tmp_path / "h.db"))
+    with tarfile.open(str(tmp_path / "rel.tar.gz")) as archive:
+        assert len(archive.getnames()) == len(repository.files)
+
+
+def test_update_command(repository, fakeserver, tmp_path):
+    root = ":pserver:alice:secret@127.0.0.1:%d/cvsroot" % fakeserver.port
+    env = dict(os.environ, PYTHONPATH=os.path.join(g_root, "library"))
+
+    def pycvs(*args):
+        done = subprocess.run([sys.executable, "-m", "pycvs"] + list(args) +
+                              ["-d", root, "-C", str(tmp_path / "dest")],
+                              env=env, capture_output=True, timeout=60)
+        assert done.returncode == 0, done.stderr.decode()
+        return json.loads(done.stdout.decode().splitlines()[-1])
+
+    pycvs("checkout", "mod")
+    changed = repository.change(0.3, seed=3)
+    report = pycvs("update", "--chunk-size", "256")
+    assert report["files"] == len(changed)
+    for path in repository.files:
+        with open(str(tmp_path / "dest" / path), "rb") as fd:
+            assert fd.read() == repository.body(path)
@@ -0,0 +1,125 @@
+# $id$
+# Cconnpool: the authenticated connections kept between sessions
+
+import socket
+
+import pycvs
+
+
+def newserver(fakeserver, connpool):
+    srv = pycvs.CVS().newserver("127.0.0.1", fakeserver.port, 1)
+    srv.set_connpool(connpool)
+    srv.events = []
+    for name in ("loginok", "loginfail"):
+        srv.addevent(name, lambda event: srv.events.append(event.get_name()))
+    return srv
+
+
+def login(srv, username="alice", password="secret"):
+    srv.login("/cvsroot", username, password)
+    srv.checkio_until(srv.is_idle, 5)
+    return srv.events[-1]
+
+
+def test_release_and_adopt(fakeserver):
+    pool = pycvs.Cconnpool()
+    srv = newserver(fakeserver, pool)
+    assert login(srv) == "loginok"
+    srv.logout()
+    assert sum(len(x) for x in pool.idle.values()) == 1
+    counters = dict(fakeserver.counters)
+
+    # no new connection, no new login
+    srv = newserver(fakeserver, pool)
+    assert login(srv) == "loginok"
+    assert fakeserver.counters["connections"] == counters["connections"]
+    assert fakeserver.counters["logins"] == counters["logins"]
+    assert not any(pool.idle.values())
+
+
+def test_stale_socket(fakeserver):
+    pool = pycvs.Cconnpool()
+    a, b = socket.socketpair()
+    b.close()
+    key = ("127.0.0.1", 1, "/cvsroot", "alice", "Ax")
+    pool.release(key, a)
+    # the peer closed it, it reads as readable: not given out
+    assert pool.acquire(key) is None
+    assert not pool.idle.get(key)
+
+
+def test_evict_idle(fakeserver):
+    pool = pycvs.Cconnpool(maxidle=10)
+    a, b = socket.socketpair()
+    pool.release("key", a)
+    pool.evict(now=pycvs.time.time() + 11)
+    assert not pool.idle
+    assert pool.acquire("key") is None
+    b.close()
+
+
+def test_maxperkey(fakeserver):
+    pool = pycvs.Cconnpool(maxperkey=2)
+    pairs = [socket.socketpair() for i in range(3)]
+    for a, b in pairs:
+        pool.release("key", a)
+    assert len(pool.idle["key"]) == 2
+    # newest first
+    assert pool.acquire("key") is pairs[1][0]
+    for a, b in pairs:
+        a.close()
+        b.close()
+
+
+def test_keys_per_credentials(fakeserver):
+    pool = pycvs.Cconnpool()
+    for username, password in (("alice", "secret"), ("bob", "hunter2")):
+        srv = newserver(fakeserver, pool)
+        assert login(srv, username, password) == "loginok"
+        srv.logout()
+    assert len(pool.idle) == 2
+    counters = dict(fakeserver.counters)
+
+    srv = newserver(fakeserver, pool)
+    assert login(srv, "bob", "hunter2") == "loginok"
+    assert fakeserver.counters["connections"] == counters["connections"]
+    assert [key[3] for key, conns in pool.idle.items() if conns] == \
+        ["alice"]
+
+
+def test_wrong_password_after_pooled_logout(fakeserver):
+    pool = pycvs.Cconnpool()
+    srv = newserver(fakeserver, pool)
+    assert login(srv) == "loginok"
+    srv.logout()
+    assert pool.idle
+    logins = fakeserver.counters["logins"]
+
+    # the pooled connection is alice's, not anyone's claiming to be
+    srv = newserver(fakeserver, pool)
+    assert login(srv, "alice", "wrong") == "loginfail"
+    assert not srv.is_loggedin()
+    assert fakeserver.counters["logins"] == logins + 1
+
+    # and it is still there for alice
+    srv = newserver(fakeserver, pool)
+    assert login(srv) == "loginok"
+    assert fakeserver.counters["logins"] == logins + 1
+
+
+def test_shared_across_cvs_instances(fakeserver):
+    pycvs.g_connpool.close()
+    try:
+        srv = newserver(fakeserver, pycvs.g_connpool)
+        assert login(srv) == "loginok"
+        srv.logout()
+        connections = fakeserver.counters["connections"]
+
+        # another CVS, same process: same pool
+        srv = pycvs.CVS().newserver("127.0.0.1", fakeserver.port, 1)
+        srv.login("/cvsroot", "alice", "secret")
+        srv.checkio_until(srv.is_idle, 5)
+        assert srv.is_loggedin()
+        assert fakeserver.counters["connections"] == connections
+    finally:
+        pycvs.g_connpool.close()
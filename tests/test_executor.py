@@ -0,0 +1,122 @@
+# $id$
+# Ceventdispa.set_executor: file event handlers run by worker threads
+
+import random
+import threading
+import time
+
+import pytest
+
+import pycvs
+
+
+def dispatcher(handlers, workers=4, maxqueue=256, ordered=1):
+    dispa = pycvs.Ceventdispa()
+    for name, handler in handlers.items():
+        dispa.addeventhook(name, handler)
+    dispa.set_executor(workers, maxqueue, None, ordered)
+    return dispa
+
+
+def throw(dispa, name, params):
+    dispa.calleventhook(pycvs.Cevent(name, params, None))
+
+
+def test_ordered_lanes():
+    # each event name is a lane handled in order, the lanes side by side
+    seen = {"updatedfile": [], "removedfile": []}
+    running = set()
+    overlapped = []
+    rnd = random.Random(1)
+
+    def handler(event):
+        name = event.get_name()
+        if running:
+            overlapped.append(name)
+        running.add(name)
+        time.sleep(rnd.random() / 1000)
+        seen[name].append(event.get_params())
+        running.discard(name)
+
+    dispa = dispatcher({"updatedfile": handler, "removedfile": handler})
+    for i in range(100):
+        throw(dispa, "updatedfile", i)
+        throw(dispa, "removedfile", i)
+    dispa.drain()
+    assert seen["updatedfile"] == list(range(100))
+    assert seen["removedfile"] == list(range(100))
+    assert overlapped
+
+
+def test_unbounded_queue():
+    # maxqueue 0 never makes the caller wait
+    release = threading.Event()
+    dispa = dispatcher({"updatedfile": lambda event: release.wait()},
+                       2, 0)
+    t = threading.Thread(target=lambda: [throw(dispa, "updatedfile", i)
+                                         for i in range(10)])
+    t.start()
+    t.join(5)
+    assert not t.is_alive()
+    release.set()
+    dispa.drain()
+
+
+def test_backpressure():
+    release = threading.Event()
+    dispa = dispatcher({"updatedfile": lambda event: release.wait()},
+                       2, 2)
+    t = threading.Thread(target=lambda: [throw(dispa, "updatedfile", i)
+                                         for i in range(3)])
+    t.start()
+    t.join(0.2)
+    assert t.is_alive()
+    release.set()
+    t.join(5)
+    assert not t.is_alive()
+    dispa.drain()
+
+
+def test_drain_errors():
+    # what the handlers raised comes out of drain(), once
+    def handler(event):
+        if event.get_params() % 2:
+            raise ValueError(event.get_params())
+
+    dispa = dispatcher({"updatedfile": handler})
+    for i in range(10):
+        throw(dispa, "updatedfile", i)
+    with pytest.raises(pycvs.DispaException) as x:
+        dispa.drain()
+    assert "5 event handlers failed" in str(x.value)
+    dispa.drain()
+
+    # kept for the next drain() raising them
+    throw(dispa, "updatedfile", 1)
+    dispa.drain(errors=0)
+    with pytest.raises(pycvs.DispaException) as x:
+        dispa.drain()
+    assert "1 event handlers failed" in str(x.value)
+
+
+def test_checkout(repository, fakeserver):
+    # a handler failing on a file: the synchronous checkout waits for
+    # the handlers once the reply came, and raises
+    cvs = pycvs.CVS()
+    cvs.set_executor(4)
+    paths = []
+
+    def handler(event):
+        path = event.get_params().get_localpath()
+        if path == sorted(repository.files)[0]:
+            raise pycvs.SinkException("unable to index %s" % path)
+        paths.append(path)
+    cvs.addevent("updatedfile", handler)
+
+    srv = cvs.newserver("127.0.0.1", fakeserver.port, 1)
+    srv.set_connpool(None)
+    srv.login("/cvsroot", "alice", "secret")
+    with pytest.raises(pycvs.DispaException):
+        srv.checkout("mod")
+    cvs.drain()
+    assert sorted(paths) == sorted(repository.files)[1:]
@@ -0,0 +1,116 @@
+# $id$
+# Crlogparser and Chistory: the rlog of a module, kept in SQLite
+
+import pycvs
+
+g_rlog = """
+RCS file: /cvsroot/mod/Attic/gone.c,v
+head: 1.2
+branch:
+locks: strict
+access list:
+symbolic names:
+\tREL_2: 1.2
+\tREL_1: 1.1
+keyword substitution: kv
+total revisions: 2;\tselected revisions: 2
+description:
+----------------------------
+revision 1.2
+date: 2026/10/18 10:00:00;  author: bob;  state: dead;  lines: +0 -3;  commitid: 10064A3F;
+gone
+
+for good
+----------------------------
+revision 1.1
+date: 2026/10/17 09:30:00;  author: alice;  state: Exp;
+branches:  1.1.2;
+initial revision
+=============================================================================
+
+RCS file: /cvsroot/mod/a.c,v
+head: 1.1
+branch:
+locks: strict
+access list:
+keyword substitution: kv
+total revisions: 1;\tselected revisions: 0
+description:
+=============================================================================
+"""
+
+
+def test_rlogparser():
+    files = []
+    parser = pycvs.Crlogparser("/cvsroot/",
+                               lambda *args: files.append(args))
+    for line in g_rlog.splitlines():
+        parser.append(line)
+
+    assert [x[:3] for x in files] == [
+        ("mod/gone.c", "1.2", {"REL_1": "1.1", "REL_2": "1.2"}),
+        ("mod/a.c", "1.1", None)]
+    revisions = files[0][3]
+    assert revisions == [
+        {"revision": "1.2", "date": pycvs.parselogdate("2026/10/18 10:00:00"),
+         "author": "bob", "state": "dead", "lines": (0, 3),
+         "commitid": "10064A3F", "message": "gone\n\nfor good"},
+        {"revision": "1.1", "date": pycvs.parselogdate("2026/10/17 09:30:00"),
+         "author": "alice", "state": "Exp", "lines": None,
+         "commitid": None, "message": "initial revision"}]
+    assert files[1][3] == []
+
+
+def rlog(fakeserver, history, *options):
+    srv = pycvs.CVS().newserver("127.0.0.1", fakeserver.port, 1)
+    srv.set_connpool(None)
+    srv.login("/cvsroot", "alice", "secret")
+    srv.rlog("mod", history, *options)
+    srv.logout()
+
+
+def test_history(repository, fakeserver, tmp_path):
+    repository.tag("REL_1")
+    changed = repository.change(0.3, seed=3)
+    history = pycvs.Chistory(str(tmp_path / "h.db"))
+    rlog(fakeserver, history)
+    assert history.files == len(repository.files)
+    assert history.revisions == len(repository.files) + len(changed)
+
+    path = changed[0]
+    assert [x[:3] for x in history.log(path)] == [
+        ("1.%d" % n,) + repository.loginfo(path, n)[:2] for n in (2, 1)]
+    assert history.tags(path) == {"REL_1": "1.1"}
+    assert history.tagged("REL_1") == {x: "1.1" for x in repository.files}
+
+    since = history.latest()
+    assert sorted(x[0] for x in history.changedsince(since)) == \
+        sorted(changed)
+    assert history.changedsince(since, "nothing") == []
+    assert sum(x[1] for x in history.touched("mod")) == history.revisions
+    history.close()
+
+
+def test_history_update(repository, fakeserver, tmp_path):
+    # the second rlog only asks for the files with revisions as new
+    # as the newest known, or newer
+    history = pycvs.Chistory(str(tmp_path / "h.db"))
+    assert history.updateoptions() == []
+    first = repository.change(0.3, seed=3)
+    rlog(fakeserver, history)
+    second = repository.change(0.3, seed=5)
+    history.files = history.revisions = 0
+    options = history.updateoptions()
+    assert options[0] == "-S"
+    rlog(fakeserver, history, *options)
+    assert history.files == len(set(first) | set(second))
+    assert history.revisions == len(first) + len(second)
+    for path in set(second) - set(first):
+        assert [x[0] for x in history.log(path)] == ["1.2", "1.1"]
+    history.close()
+
+    # what was loaded is kept
+    history = pycvs.Chistory(str(tmp_path / "h.db"))
+    assert len(history.changedsince(0)) == len(repository.files) + \
+        len(first) + len(second)
+    history.close()
@@ -0,0 +1,92 @@
+# $id$
+# Clazytree: a module read file by file, fetched on demand
+
+import posixpath
+
+import pytest
+
+import pycvs
+
+
+@pytest.fixture
+def tree(fakeserver):
+    srv = pycvs.CVS().newserver("127.0.0.1", fakeserver.port, 1)
+    srv.set_connpool(None)
+    srv.login("/cvsroot", "alice", "secret")
+    trees = []
+
+    def lazytree(*args, **kwargs):
+        trees.append(srv.lazytree("mod", *args, **kwargs))
+        fakeserver.counters.clear()
+        return trees[-1]
+    yield lazytree
+    for x in trees:
+        x.close()
+    srv.logout()
+
+
+def test_walk(repository, fakeserver, tree):
+    # listing reads no file
+    lazy = tree()
+    files = {}
+    for dirpath, dirnames, filenames in lazy.walk():
+        for name in filenames:
+            path = posixpath.join(dirpath, name)
+            files["mod/" + path] = lazy.revision(path)
+    assert files == {x: "1.1" for x in repository.files}
+    assert "co" not in fakeserver.counters
+    assert fakeserver.counters["rlist"] == len(repository.dirs)
+
+    path = sorted(repository.files)[0][4:]
+    assert lazy.isfile(path)
+    assert not lazy.isdir(path)
+    assert lazy.isdir(posixpath.dirname(path))
+    assert lazy.revision("nothing.c") is None
+    with pytest.raises(pycvs.ServerCVSException):
+        lazy.listdir("nothing")
+
+
+def test_read_prefetch(repository, fakeserver, tree):
+    # reading a file brings the next ones of its directory along
+    lazy = tree(prefetch=3)
+    names = [x for x in lazy.listdir("") if lazy.isfile(x)]
+    assert len(names) > 4
+    for name in names:
+        assert lazy.read(name) == repository.body("mod/" + name)
+    stats = lazy.get_stats()
+    assert stats["misses"] == -(-len(names) // 4)
+    assert stats["hits"] == len(names) - stats["misses"]
+    assert stats["fetched"] == fakeserver.counters["co"] == len(names)
+
+    # read again from the cache
+    with lazy.open(names[0]) as fd:
+        assert fd.read() == repository.body("mod/" + names[0])
+    assert fakeserver.counters["co"] == len(names)
+
+
+def test_cache_eviction(repository, fakeserver, tree):
+    # past $cachesize the least recently read bodies go
+    names = sorted(x[4:] for x in repository.files)
+    cachesize = sum(len(repository.body("mod/" + x)) for x in names[:3])
+    lazy = tree(cachesize=cachesize, prefetch=0)
+    for name in names:
+        lazy.read(name)
+        assert lazy.size <= cachesize
+    assert names[0] not in lazy.bodies
+    assert names[-1] in lazy.bodies
+
+    count = fakeserver.counters["co"]
+    assert lazy.read(names[0]) == repository.body("mod/" + names[0])
+    assert fakeserver.counters["co"] == count + 1
+
+
+def test_tag(repository, fakeserver, tree):
+    # files read at a tag are the revisions it has
+    repository.tag("REL_1")
+    changed = repository.change(0.5, seed=3)
+    lazy = tree("REL_1")
+    for path in changed:
+        assert lazy.read(path[4:]) == repository.body(path, "1.1")
+        assert lazy.read(path[4:]) != repository.body(path)
+    with pytest.raises(pycvs.ServerCVSException):
+        lazy.read("nothing.c")
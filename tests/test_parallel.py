@@ -0,0 +1,63 @@
+# $id$
+# Cparallelcheckout: a module checked out over several connections
+
+import os
+
+import pycvs
+
+
+def parallelcheckout(fakeserver, destdir, connections=4):
+    srv = pycvs.CVS().newserver("127.0.0.1", fakeserver.port, 1)
+    srv.set_connpool(None)
+    srv.login("/cvsroot", "alice", "secret")
+    srv.set_filesink(pycvs.Cdirsink(str(destdir), 1,
+                                    srv.objprotocvs.get_rootspec()))
+    shards = srv.parallelcheckout("mod", connections)
+    assert shards.wait(10)
+    return shards
+
+
+def test_checkout(repository, fakeserver, tmp_path):
+    shards = parallelcheckout(fakeserver, tmp_path)
+    assert shards.failed == []
+    for path in repository.files:
+        assert os.path.isfile(str(tmp_path / path))
+
+
+def test_failed_shard(repository, fakeserver, tmp_path):
+    # a connection lost half way through a shard
+    fakeserver.hangup("co", 100)
+    shards = parallelcheckout(fakeserver, tmp_path, 2)
+    assert len(shards.failed) == 1
+    failed = shards.failed[0]
+    for path in repository.files:
+        if os.path.dirname(path) != failed:
+            assert os.path.isfile(str(tmp_path / path))
+
+
+def test_failed_worker(repository, fakeserver, tmp_path, monkeypatch):
+    # a worker giving up on its shard, and the shards nobody took
+    def broken(self, *args):
+        raise pycvs.NetworkException("broken")
+
+    monkeypatch.setattr(pycvs.Cprotocvs, "do_checkout", broken)
+    shards = parallelcheckout(fakeserver, tmp_path, 1)
+    assert sorted(shards.failed) == \
+        sorted(["mod"] + ["mod/" + x for x in repository.listdir("mod")[1]])
+
+
+def test_admin_files(repository, fakeserver, tmp_path):
+    # every shard writes the administrative files of its directories
+    # at once, the module's Entries lists all of its subdirectories
+    files, subdirs = repository.listdir("mod")
+    for i in range(10):
+        destdir = tmp_path / str(i)
+        shards = parallelcheckout(fakeserver, destdir)
+        assert shards.failed == []
+        entries = pycvs.Centries(str(destdir / "mod")).load()
+        assert sorted(entries.subdirs) == subdirs
+        assert sorted(entries.files) == files
+        for name in subdirs:
+            entries = pycvs.Centries(str(destdir / "mod" / name)).load()
+            assert sorted(entries.files) == \
+                repository.listdir("mod/" + name)[0]
@@ -0,0 +1,165 @@
+# $id$
+# Cresponseparser: CVS responses out of bytes, no sockets
+
+import zlib
+
+import pytest
+
+import pycvs
+
+g_body = bytes(range(256)) * 3
+
+g_reply = (b"M U mod/a.txt\n"
+           b"Created mod/\n/cvsroot/mod/a.txt\n/a.txt/1.1///\n"
+           b"u=rw,g=r,o=r\n768\n" + g_body +
+           b"MT +updated\nMT text U \nMT fname mod/a.txt\nMT newline\n"
+           b"MT -updated\n"
+           b"E cvs checkout: Updating mod/sub\n"
+           b"Mbinary \n5\n\x00\xff\n\r\x01"
+           b"M \n"
+           b"Removed mod/\n/cvsroot/mod/gone.txt\n"
+           b"Updated mod/\n/cvsroot/mod/empty\n/empty/1.1///\n"
+           b"u=rw\n0\n"
+           b"ok\n"
+           b"error 1 cvs [checkout aborted]: no such tag\n")
+
+g_events = [
+    ("response", "M", "U mod/a.txt", [], None),
+    ("response", "Created", "mod/",
+     ["/cvsroot/mod/a.txt", "/a.txt/1.1///", "u=rw,g=r,o=r", "768"], 768),
+    ("body", g_body),
+    ("end", None),
+    ("response", "MT", "+updated", [], None),
+    ("response", "MT", "text U ", [], None),
+    ("response", "MT", "fname mod/a.txt", [], None),
+    ("response", "MT", "newline", [], None),
+    ("response", "MT", "-updated", [], None),
+    ("response", "E", "cvs checkout: Updating mod/sub", [], None),
+    ("response", "Mbinary", "", ["5"], 5),
+    ("body", b"\x00\xff\n\r\x01"),
+    ("end", None),
+    ("response", "M", "", [], None),
+    ("response", "Removed", "mod/", ["/cvsroot/mod/gone.txt"], None),
+    ("response", "Updated", "mod/",
+     ["/cvsroot/mod/empty", "/empty/1.1///", "u=rw", "0"], 0),
+    ("end", None),
+    ("response", "ok", "", [], None),
+    ("response", "error", "1 cvs [checkout aborted]: no such tag", [], None),
+]
+
+
+def joinbodies(events):
+    # the pieces of a body as one, they come as they were fed
+    out = []
+    for event in events:
+        if event[0] == "body":
+            assert isinstance(event[1], memoryview)
+            if out and out[-1][0] == "body":
+                out[-1] = ("body", out[-1][1] + bytes(event[1]))
+                continue
+            event = ("body", bytes(event[1]))
+        out.append(event)
+    return out
+
+
+def test_whole():
+    parser = pycvs.Cresponseparser()
+    assert joinbodies(parser.parse(g_reply)) == g_events
+    assert parser.pending() == 0
+
+
+def test_split_at_every_byte():
+    for cut in range(len(g_reply) + 1):
+        parser = pycvs.Cresponseparser()
+        events = parser.parse(g_reply[:cut])
+        events += parser.parse(g_reply[cut:])
+        assert joinbodies(events) == g_events, cut
+        assert parser.pending() == 0
+
+
+def test_byte_by_byte():
+    parser = pycvs.Cresponseparser()
+    events = []
+    for i in range(len(g_reply)):
+        events += parser.parse(g_reply[i:i + 1])
+    assert joinbodies(events) == g_events
+
+
+def test_fed_before_taken():
+    # several feeds before the events are taken out
+    parser = pycvs.Cresponseparser()
+    for i in range(0, len(g_reply), 7):
+        parser.feed(g_reply[i:i + 7])
+    assert parser.pending() == len(g_reply)
+    assert joinbodies(parser.parse(b"")) == g_events
+
+
+def test_body_not_copied():
+    parser = pycvs.Cresponseparser()
+    data = g_reply[:200]
+    events = parser.parse(data)
+    body = [x[1] for x in events if x[0] == "body"][0]
+    assert body.obj is data
+
+
+def test_bodyleft_skip():
+    # a driver receiving the rest of the body itself
+    parser = pycvs.Cresponseparser()
+    head = g_reply.index(b"768\n") + 4
+    events = parser.parse(g_reply[:head + 100])
+    assert events[-1] == ("body", g_body[:100])
+    assert parser.bodyleft() == 668
+    parser.skip(600)
+    assert parser.bodyleft() == 68
+    assert parser.parse(b"") == []
+    events = parser.parse(g_reply[head + 700:])
+    assert events[0] == ("body", g_body[700:])
+    assert joinbodies(events[1:]) == g_events[3:]
+
+    # with data fed and not taken, that is parsed first
+    parser.reset()
+    parser.feed(g_reply[:head + 100])
+    assert parser.bodyleft() == 0
+
+
+def test_gzip_switch_mid_chunk():
+    # the reply to the request before Gzip-stream is plain, what
+    # follows it in the same chunk is compressed
+    plain = b"M before\nok\n"
+    compressor = zlib.compressobj(6)
+    data = plain + compressor.compress(g_reply) + \
+        compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    for cut in range(len(data) + 1):
+        parser = pycvs.Cresponseparser()
+        decompressor = None
+        events = []
+        for chunk in (data[:cut], data[cut:]):
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            parser.feed(chunk)
+            while 1:
+                event = parser.next()
+                if event is None:
+                    break
+                events.append(event)
+                if event[1] == "ok" and not decompressor:
+                    decompressor = zlib.decompressobj()
+                    parser.rewrite(decompressor.decompress)
+        assert joinbodies(events) == \
+            [("response", "M", "before", [], None),
+             ("response", "ok", "", [], None)] + g_events
+
+
+def test_bad_size():
+    parser = pycvs.Cresponseparser()
+    with pytest.raises(pycvs.ProtocolException):
+        parser.parse(b"Mbinary \nfive\n")
+
+
+def test_gzipped_size():
+    parser = pycvs.Cresponseparser()
+    events = parser.parse(b"Updated d/\n/r/d/f\n/f/1.1///\nu=rw\nz3\nabc")
+    assert events[0][4] == 3
+    assert events[0][3][-1] == "z3"
+    assert joinbodies(events[1:]) == [("body", b"abc"), ("end", None)]
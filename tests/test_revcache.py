@@ -0,0 +1,99 @@
+# $id$
+# Crevcache: checkouts laid out from the cache of revisions
+
+import os
+
+import pycvs
+
+
+def checkout(fakeserver, destdir, revcache):
+    srv = pycvs.CVS().newserver("127.0.0.1", fakeserver.port, 1)
+    srv.set_connpool(None)
+    srv.set_revcache(revcache)
+    srv.login("/cvsroot", "alice", "secret")
+    sink = pycvs.Cdirsink(str(destdir), 1, srv.objprotocvs.get_rootspec(),
+                          revcache)
+    srv.set_filesink(sink)
+    fakeserver.counters.clear()
+    srv.checkout("mod")
+    srv.logout()
+    return sink
+
+
+def sametree(repository, destdir):
+    for path in repository.files:
+        with open(str(destdir / path), "rb") as fd:
+            assert fd.read() == repository.body(path)
+    for dirpath, dirnames, filenames in os.walk(str(destdir / "mod")):
+        if "CVS" in dirnames:
+            dirnames.remove("CVS")
+            entries = pycvs.Centries(dirpath).load()
+            for name in entries.files:
+                assert entries.filestate(name) == "unchanged"
+
+
+def test_checkout_then_update(repository, fakeserver, tmp_path):
+    # the second checkout comes from the cache, what changed since is
+    # all the server sends
+    revcache = pycvs.Crevcache(str(tmp_path / "cache"))
+    sink = checkout(fakeserver, tmp_path / "a", revcache)
+    assert sink.materialized == 0
+    assert fakeserver.counters["files"] == len(repository.files)
+
+    changed = repository.change(0.3, seed=3)
+    sink = checkout(fakeserver, tmp_path / "b", revcache)
+    assert sink.materialized == len(repository.files)
+    assert "co" not in fakeserver.counters
+    assert fakeserver.counters["update"] == 1
+    assert fakeserver.counters["files"] == len(changed)
+    sametree(repository, tmp_path / "b")
+
+    # and the changed revisions are cached too
+    sink = checkout(fakeserver, tmp_path / "c", revcache)
+    assert sink.materialized == len(repository.files)
+    assert fakeserver.counters["files"] == 0
+    sametree(repository, tmp_path / "c")
+    revcache.close()
+
+
+def test_spoilt_body(repository, fakeserver, tmp_path):
+    # a cached body not matching its hash is dropped and fetched again
+    revcache = pycvs.Crevcache(str(tmp_path / "cache"))
+    sink = checkout(fakeserver, tmp_path / "a", revcache)
+    path = sorted(repository.files)[0]
+    dirpath, name = os.path.split(str(tmp_path / "a" / path))
+    line = pycvs.Centries(dirpath).load().files[name]
+    blobhash = revcache.lookup(sink.cacheroot(), "/cvsroot/" + path,
+                               line)[0]
+    with open(revcache.blobpath(blobhash), "r+b") as fd:
+        fd.write(b"X")
+
+    sink = checkout(fakeserver, tmp_path / "b", revcache)
+    assert sink.materialized == len(repository.files) - 1
+    assert fakeserver.counters["files"] == 1
+    sametree(repository, tmp_path / "b")
+    # kept again, as the server sent it
+    with open(revcache.blobpath(blobhash), "rb") as fd:
+        assert fd.read() == repository.body(path)
+    revcache.close()
+
+
+def test_lru_eviction(tmp_path):
+    # past $maxsize the bodies used least recently go
+    revcache = pycvs.Crevcache(str(tmp_path / "cache"), maxsize=10000)
+    hashes = []
+    for i in range(4):
+        if i == 3:
+            # f0 used since, f1 is the least recently used
+            assert revcache.place(hashes[0], str(tmp_path / "out"))
+        src = tmp_path / ("f%d" % i)
+        src.write_bytes(bytes([i]) * 3000)
+        hashes.append(revcache.store("root", "/cvsroot/mod/f%d" % i,
+                                     "/f%d/1.1///" % i, str(src)))
+
+    kept = [os.path.exists(revcache.blobpath(x)) for x in hashes]
+    assert kept == [True, False, True, True]
+    assert revcache.size == 9000
+    assert revcache.lookup("root", "/cvsroot/mod/f1", "/f1/1.1///") is None
+    assert revcache.lookup("root", "/cvsroot/mod/f0", "/f0/1.1///")
+    revcache.close()
@@ -0,0 +1,68 @@
+# $id$
+# a file sink failing on a file: the request fails, the rest goes on
+
+import io
+import errno
+
+import pytest
+
+import pycvs
+
+
+class Cfailingsink(pycvs.Cfilesink):
+    """ keeps the files, but can't open $badopen nor write $badwrite """
+    def __init__(self, badopen, badwrite):
+        self.badopen = badopen
+        self.badwrite = badwrite
+        self.files = {}
+
+    def open(self, cfile):
+        if cfile.get_path().endswith(self.badopen):
+            raise pycvs.SinkException("unable to write %s" % self.badopen)
+        fd = io.BytesIO()
+        if cfile.get_path().endswith(self.badwrite):
+            def write(data):
+                raise OSError(errno.ENOSPC, "No space left on device")
+            fd.write = write
+        return fd
+
+    def close(self, cfile, fd):
+        self.files[cfile.get_path()] = fd.getvalue()
+
+
+@pytest.mark.parametrize("sync", (1, 0))
+def test_sink_error(repository, fakeserver, sync):
+    paths = sorted(repository.files)
+    sink = Cfailingsink(paths[0], paths[1])
+    srv = pycvs.CVS().newserver("127.0.0.1", fakeserver.port, sync)
+    srv.set_connpool(None)
+    srv.login("/cvsroot", "alice", "secret")
+    srv.checkio_until(srv.is_idle, 5)
+    srv.set_filesink(sink, 256)
+    errors = []
+    srv.addevent("sinkerror", lambda event: errors.append(event.get_params()))
+    replies = []
+    receivedreply = srv.objprotocvs.replycallback
+
+    def replied(value):
+        replies.append(value)
+        if receivedreply:
+            receivedreply(value)
+    srv.objprotocvs.replycallback = replied
+
+    srv.checkout("mod")
+    srv.checkio_until(srv.is_idle, 5)
+    assert replies == ["error"]
+    assert len(errors) == 2
+    assert "No space left" in errors[1]
+    assert sorted(sink.files) == ["/cvsroot/" + x for x in paths[2:]]
+    for path in paths[2:]:
+        assert sink.files["/cvsroot/" + path] == repository.body(path)
+
+    # the session goes on
+    replies[:] = []
+    sink.badopen = sink.badwrite = "none"
+    srv.checkout("mod")
+    srv.checkio_until(srv.is_idle, 5)
+    assert replies == ["ok"]
+    assert len(sink.files) == len(paths)
@@ -0,0 +1,155 @@
+# $id$
+# Csynctag: moving a checkout between tags with rdiff
+
+import os
+
+import pytest
+
+import pycvs
+
+
+@pytest.fixture
+def tagged(repository):
+    # REL_1, then a third of the files changed, one added and one
+    # removed in REL_2
+    repository.tag("REL_1")
+    changed = repository.change(0.3, seed=3)
+    repository.add("mod/d0/new.c", b"new\n")
+    gone = sorted(set(repository.files) - set(changed))[0]
+    repository.remove(gone)
+    repository.tag("REL_2")
+    return changed, gone
+
+
+def session(fakeserver, destdir):
+    srv = pycvs.CVS().newserver("127.0.0.1", fakeserver.port, 1)
+    srv.set_connpool(None)
+    srv.login("/cvsroot", "alice", "secret")
+    srv.set_filesink(pycvs.Cdirsink(str(destdir), 1,
+                                    srv.objprotocvs.get_rootspec()))
+    return srv
+
+
+def tree(destdir):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(str(destdir)):
+        if "CVS" in dirnames:
+            dirnames.remove("CVS")
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            with open(path, "rb") as fd:
+                files[os.path.relpath(path, str(destdir))] = fd.read()
+    return files
+
+
+def entrylines(destdir):
+    # the entries lines of every directory, Entries.Log folded in
+    lines = {}
+    for dirpath, dirnames, filenames in os.walk(str(destdir)):
+        if "CVS" in dirnames:
+            dirnames.remove("CVS")
+            entries = pycvs.Centries(dirpath).load()
+            for name, line in entries.files.items():
+                lines[os.path.relpath(os.path.join(dirpath, name),
+                                      str(destdir))] = line
+    return lines
+
+
+def test_sync(repository, fakeserver, tagged, tmp_path):
+    changed, gone = tagged
+    srv = session(fakeserver, tmp_path / "a")
+    srv.checkout("mod", "-rREL_1")
+    sync = srv.sync_to_tag("mod", "REL_1", "REL_2")
+    assert sync.reply == "ok"
+    assert sorted(sync.patched) == sorted(changed)
+    assert sync.added == ["mod/d0/new.c"]
+    assert sync.removed == [gone]
+    assert sync.fetch == [] and sync.skipped == []
+
+    srv.set_filesink(pycvs.Cdirsink(str(tmp_path / "b"), 1,
+                                    srv.objprotocvs.get_rootspec()))
+    srv.checkout("mod", "-rREL_2")
+    assert tree(tmp_path / "a") == tree(tmp_path / "b")
+
+
+def test_sticky(repository, fakeserver, tagged, tmp_path):
+    # the files that didn't change stick to the new tag too
+    srv = session(fakeserver, tmp_path)
+    srv.checkout("mod", "-rREL_1")
+    srv.sync_to_tag("mod", "REL_1", "REL_2")
+    lines = entrylines(tmp_path)
+    assert sorted(lines) == sorted(repository.files)
+    for path, line in lines.items():
+        fields = line.split("/")
+        assert fields[2] == repository.revision(path)
+        assert fields[5] == "TREL_2", line
+    for dirpath, dirnames, filenames in os.walk(str(tmp_path / "mod")):
+        if dirpath.endswith("CVS"):
+            with open(os.path.join(dirpath, "Tag")) as fd:
+                assert fd.read() == "TREL_2\n"
+    assert not os.path.exists(str(tmp_path / "mod" / "CVS" / "Entries.Log"))
+
+
+def test_fetch_whole(repository, fakeserver, tagged, tmp_path):
+    # a file the patch doesn't apply to, one at another revision and
+    # one changed locally
+    changed, gone = sorted(tagged[0]), tagged[1]
+    srv = session(fakeserver, tmp_path)
+    srv.checkout("mod", "-rREL_1")
+
+    spoiled = str(tmp_path / changed[0])
+    stat = os.stat(spoiled)
+    with open(spoiled, "rb") as fd:
+        data = fd.read()
+    with open(spoiled, "wb") as fd:
+        fd.write(data[:-2] + b"X\n")
+    os.utime(spoiled, (stat.st_atime, stat.st_mtime))
+
+    dirname, name = os.path.split(str(tmp_path / changed[1]))
+    entries = pycvs.Centries(dirname).load()
+    fields = entries.files[name].split("/")
+    fields[2] = "1.0"
+    entries.files[name] = "/".join(fields)
+    entries.save()
+
+    edited = str(tmp_path / changed[2])
+    with open(edited, "ab") as fd:
+        fd.write(b"local\n")
+    os.utime(edited, (1, 1))
+    with open(edited, "rb") as fd:
+        local = fd.read()
+
+    # the working copy as it is on disk now
+    srv.set_filesink(pycvs.Cdirsink(str(tmp_path), 1,
+                                    srv.objprotocvs.get_rootspec()))
+    sync = srv.sync_to_tag("mod", "REL_1", "REL_2")
+    assert sync.reply == "ok"
+    assert sorted(sync.fetch) == changed[:2]
+    assert sync.skipped == [changed[2]]
+    for path in changed[:2]:
+        with open(str(tmp_path / path), "rb") as fd:
+            assert fd.read() == repository.body(path)
+        assert entrylines(tmp_path)[path].split("/")[2] == \
+            repository.revision(path)
+    with open(edited, "rb") as fd:
+        assert fd.read() == local
+
+
+def test_sync_async(repository, fakeserver, tagged, tmp_path):
+    srv = session(fakeserver, tmp_path / "a")
+    srv.checkout("mod", "-rREL_1")
+    asrv = pycvs.CVS().newserver("127.0.0.1", fakeserver.port, 0)
+    asrv.set_connpool(None)
+    asrv.set_filesink(srv.objprotocvs.filesink)
+    asrv.login("/cvsroot", "alice", "secret")
+    asrv.checkio_until(asrv.is_idle, 5)
+    sync = asrv.sync_to_tag("mod", "REL_1", "REL_2")
+    asrv.checkio_until(sync.finished.is_set, 10)
+    assert sync.reply == "ok"
+
+    srv.set_filesink(pycvs.Cdirsink(str(tmp_path / "b"), 1,
+                                    srv.objprotocvs.get_rootspec()))
+    srv.checkout("mod", "-rREL_2")
+    assert tree(tmp_path / "a") == tree(tmp_path / "b")
+    assert {x.split("/")[5] for x in entrylines(tmp_path / "a").values()} \
+        == {"TREL_2"}
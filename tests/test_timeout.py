@@ -0,0 +1,84 @@
+# $id$
+# request deadlines: set_timeout() on a slow but steady server
+
+import socket
+import threading
+import time
+
+import pycvs
+
+
+class Cthrottle:
+    """ a proxy to $port sending what the server says $chunk bytes
+    every $interval seconds """
+    def __init__(self, port, chunk=1024, interval=0.005):
+        self.port = port
+        self.chunk = chunk
+        self.interval = interval
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        thread = threading.Thread(target=self.acceptloop)
+        thread.daemon = True
+        thread.start()
+
+    def get_port(self):
+        return self.sock.getsockname()[1]
+
+    def acceptloop(self):
+        while 1:
+            try:
+                client, peer = self.sock.accept()
+            except OSError:
+                return
+            server = socket.create_connection(("127.0.0.1", self.port))
+            for args in ((client, server, 0), (server, client, 1)):
+                thread = threading.Thread(target=self.pipe, args=args)
+                thread.daemon = True
+                thread.start()
+
+    def pipe(self, src, dst, throttled):
+        try:
+            while 1:
+                data = src.recv(self.chunk if throttled else 65536)
+                if not data:
+                    break
+                dst.sendall(data)
+                if throttled:
+                    time.sleep(self.interval)
+        except OSError:
+            pass
+        for sock in (src, dst):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        self.sock.close()
+
+
+def test_pipelined_requests_wait_for_the_ones_before(repository,
+                                                     fakeserver):
+    # 9 files of 16 KB at 200 KB/s: each reply comes in well within
+    # the timeout, the last one long after it was asked for
+    names = ["f%02d.c" % i for i in range(10)]
+    for i, name in enumerate(names):
+        repository.add("mod/slow/" + name, (b"%02d" % i) * 8192)
+
+    proxy = Cthrottle(fakeserver.port)
+    try:
+        srv = pycvs.CVS().newserver("127.0.0.1", proxy.get_port(), 1)
+        srv.set_connpool(None)
+        srv.set_timeout(0.5)
+        srv.login("/cvsroot", "alice", "secret")
+
+        tree = srv.lazytree("mod", prefetch=8)
+        for i, name in enumerate(names):
+            assert tree.read("slow/" + name) == (b"%02d" % i) * 8192
+        metrics = tree.session.objprotocvs.metrics
+        assert metrics.timeouts == 0
+        assert metrics.retries == 0
+        tree.close()
+    finally:
+        proxy.close()
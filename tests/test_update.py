@@ -0,0 +1,112 @@
+# $id$
+# Cservercvs.update: a working copy brought up to date
+
+import io
+import os
+
+import pytest
+
+import pycvs
+
+
+def checkout(fakeserver, destdir):
+    srv = pycvs.CVS().newserver("127.0.0.1", fakeserver.port, 1)
+    srv.set_connpool(None)
+    srv.login("/cvsroot", "alice", "secret")
+    srv.set_filesink(pycvs.Cdirsink(str(destdir), 1,
+                                    srv.objprotocvs.get_rootspec()))
+    srv.checkout("mod")
+    return srv
+
+
+def files(destdir):
+    return {os.path.relpath(os.path.join(dirpath, name), str(destdir))
+            for dirpath, dirnames, filenames in os.walk(str(destdir))
+            if os.path.basename(dirpath) != "CVS" for name in filenames}
+
+
+def test_update_unchanged(repository, fakeserver, tmp_path):
+    # unchanged files are only named, what changed comes as a diff
+    srv = checkout(fakeserver, tmp_path)
+    changed = repository.change(0.3, seed=3)
+    patched = []
+    srv.addevent("patchedfile",
+                 lambda event: patched.append(event.get_params()))
+    fakeserver.counters.clear()
+    srv.update(str(tmp_path))
+
+    assert fakeserver.counters["Unchanged"] == len(repository.files)
+    assert "Modified" not in fakeserver.counters
+    assert sorted(x.get_localpath() for x in patched) == sorted(changed)
+    assert files(tmp_path) == set(repository.files)
+    for path in repository.files:
+        with open(str(tmp_path / path), "rb") as fd:
+            assert fd.read() == repository.body(path)
+
+
+def test_update_modified(repository, fakeserver, tmp_path):
+    # a file edited since is uploaded, and kept as it is
+    srv = checkout(fakeserver, tmp_path)
+    path = sorted(repository.files)[0]
+    with open(str(tmp_path / path), "ab") as fd:
+        fd.write(b"local change\n")
+    os.utime(str(tmp_path / path), (1, 1))
+    fakeserver.counters.clear()
+    srv.update(str(tmp_path))
+
+    assert fakeserver.counters["Modified"] == 1
+    assert fakeserver.counters["Unchanged"] == len(repository.files) - 1
+    with open(str(tmp_path / path), "rb") as fd:
+        assert fd.read() == repository.body(path) + b"local change\n"
+
+
+def test_update_entries_log(repository, fakeserver, tmp_path):
+    # what Entries.Log says is folded into Entries before the entries
+    # are sent: a file it removed is sent again as a new one
+    srv = checkout(fakeserver, tmp_path)
+    path = sorted(repository.files)[0]
+    dirpath, name = os.path.split(str(tmp_path / path))
+    entries = pycvs.Centries(dirpath).load()
+    entries.remove(name)
+    os.unlink(os.path.join(dirpath, name))
+    fakeserver.counters.clear()
+    srv.update(str(tmp_path))
+
+    assert fakeserver.counters["Entry"] == len(repository.files) - 1
+    with open(os.path.join(dirpath, "CVS", "Entries")) as fd:
+        assert "/%s/" % name not in fd.read()
+    with open(os.path.join(dirpath, name), "rb") as fd:
+        assert fd.read() == repository.body(path)
+    assert name in pycvs.Centries(dirpath).load().files
+
+
+def test_patch_without_file():
+    # a sink with no files of its own can't apply an Rcs-diff
+    sink = pycvs.Cstreamsink(io.BytesIO())
+    cfile = pycvs.Cfile("/cvsroot/mod/a.c", "/a.c/1.2///", "u=rw", 3,
+                        b"d1 1", "mod/", "Rcs-diff")
+    with pytest.raises(pycvs.SinkException):
+        sink.patch(cfile)
+
+
+def test_update_sink(repository, fakeserver, tmp_path):
+    # the sink set on the working copy is the one written to, in
+    # chunks of the size it was set with
+    srv = checkout(fakeserver, tmp_path)
+    repository.change(0.3, seed=3)
+    sink = pycvs.Cdirsink(str(tmp_path), 1)
+    srv.set_filesink(sink, 256)
+    srv.update(str(tmp_path))
+
+    proto = srv.objprotocvs
+    assert proto.filesink is sink
+    assert proto.chunksize == 256
+    assert sink.cvsroot == proto.get_rootspec()
+    for path in repository.files:
+        with open(str(tmp_path / path), "rb") as fd:
+            assert fd.read() == repository.body(path)
+
+    # another directory gets a sink of its own
+    srv.update(str(tmp_path / "mod"))
+    assert proto.filesink is not sink
+    assert proto.chunksize == 256